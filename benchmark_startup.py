@@ -0,0 +1,152 @@
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+from datetime import UTC, datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from statistics import median
+from tempfile import TemporaryDirectory
+from threading import Thread
+
+# modules needed only by the stages doing actual work, a run without any must not import them
+LAZY_MODULES = (
+    'concurrent.futures.process',
+    'geopy',
+    'multiprocessing',
+    'requests',
+    'tenacity',
+    'xmltodict',
+)
+
+RUNS = int(os.getenv('STARTUP_RUNS', '10'))
+BUDGET = float(os.getenv('STARTUP_BUDGET', '100'))  # milliseconds, importing main
+CYCLE_BUDGET = float(os.getenv('STARTUP_CYCLE_BUDGET', '500'))  # milliseconds, a whole no-op run
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+IMPORT_TIME_RE = re.compile(r'^import time:\s+\d+ \|\s+(\d+) \| main$', re.MULTILINE)
+
+# the cursors are placed right at the database state, so there is nothing to query
+SEED_STATE = '''
+import sys
+sys.path.insert(0, {root!r})
+from state import State
+with State() as s:
+    for cursor in s.cursors.values():
+        cursor.end_ts = {timestamp} - 1
+    s.write_state()
+'''
+
+
+class OverpassStandIn(BaseHTTPRequestHandler):
+    '''
+    Local Overpass interpreter reporting a fixed database state and no elements.
+    '''
+    timestamp_osm_base = ''
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        body = json.dumps({'osm3s': {'timestamp_osm_base': self.timestamp_osm_base}, 'elements': []}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def measure() -> float:
+    '''
+    Import the entry point in a fresh interpreter, returning the cumulative import time in milliseconds.
+    '''
+    r = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import main'],
+        cwd=ROOT, capture_output=True, text=True, check=True)
+
+    return int(IMPORT_TIME_RE.search(r.stderr).group(1)) / 1000
+
+
+def loaded_lazy_modules() -> list[str]:
+    r = subprocess.run(
+        [sys.executable, '-c', f'import sys, main; print(*(m for m in {LAZY_MODULES!r} if m in sys.modules))'],
+        cwd=ROOT, capture_output=True, text=True, check=True)
+
+    return r.stdout.split()
+
+
+def measure_cycle(path: str, env: dict) -> float:
+    '''
+    Run main in `path` with nothing to do, returning the wall time in milliseconds.
+    '''
+    time_start = time.perf_counter()
+    r = subprocess.run([sys.executable, os.path.join(ROOT, 'main.py')],
+                       cwd=path, env=env, capture_output=True, text=True, check=True)
+    result = (time.perf_counter() - time_start) * 1000
+
+    assert 'Overpass is updating' in r.stdout, f'The run was not a no-op:\n{r.stdout}'
+    assert 'Logging in' not in r.stdout, 'A no-op run must not log in to OpenStreetMap'
+    return result
+
+
+def measure_cycles() -> list[float]:
+    timestamp = int(time.time())
+    OverpassStandIn.timestamp_osm_base = datetime.fromtimestamp(timestamp, UTC).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), OverpassStandIn)
+    Thread(target=server.serve_forever, daemon=True).start()
+
+    env = {k: v for k, v in os.environ.items() if k not in ('DRY_RUN', 'CATCHUP', 'MODE', 'PROFILE_DIR')}
+    env['OVERPASS_API_INTERPRETER'] = f'http://127.0.0.1:{server.server_port}/api/interpreter'
+
+    try:
+        with TemporaryDirectory() as path:
+            subprocess.run([sys.executable, '-c', SEED_STATE.format(root=ROOT, timestamp=timestamp)],
+                           cwd=path, env=env, capture_output=True, check=True)
+
+            # the first run warms up the bytecode cache
+            measure_cycle(path, env)
+            return [measure_cycle(path, env) for _ in range(RUNS)]
+    finally:
+        server.shutdown()
+
+
+def main():
+    # the first run warms up the bytecode cache
+    measure()
+    times = [measure() for _ in range(RUNS)]
+    result = median(times)
+
+    print(f'⏱️ Startup: {result:.1F} ms median of {RUNS} runs '
+          f'(min {min(times):.1F} ms, max {max(times):.1F} ms, budget {BUDGET:.0F} ms)')
+
+    cycles = measure_cycles()
+    cycle_result = median(cycles)
+
+    print(f'⏱️ No-op run: {cycle_result:.1F} ms median of {RUNS} runs '
+          f'(min {min(cycles):.1F} ms, max {max(cycles):.1F} ms, budget {CYCLE_BUDGET:.0F} ms)')
+
+    ok = True
+
+    if loaded := loaded_lazy_modules():
+        print(f'❌ Imported eagerly: {", ".join(loaded)}')
+        ok = False
+
+    if result > BUDGET:
+        print('❌ Over the startup budget')
+        ok = False
+
+    if cycle_result > CYCLE_BUDGET:
+        print('❌ Over the no-op run budget')
+        ok = False
+
+    if not ok:
+        sys.exit(1)
+
+    print('✅ Within the startup budget')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,30 @@
 from collections.abc import Sequence
 from dataclasses import dataclass
+from functools import partial
 from typing import Iterable
 
+from aliases import Identifier, Tags
 from check import Check
 from check_base import CheckBase
 from overpass_entry import OverpassEntry
+from parallel import get_executor, map_sharded
+
+
+def _select_checks(cat_identifier: Identifier, tags_list: list[Tags]) -> list[list[Identifier]]:
+    '''
+    Process pool entry point, returns the identifiers of the checks selecting each tags.
+    '''
+    from checks import ALL_CATEGORIES_BY_ID
+
+    cat = ALL_CATEGORIES_BY_ID[cat_identifier]
+
+    return [
+        [] if cat.selectors and not cat.is_selected(tags) else [
+            c.identifier for c in cat.checks
+            if c.is_selected(tags) and (c.pre_fn is None or c.pre_fn(tags))
+        ]
+        for tags in tags_list
+    ]
 
 
 @dataclass(frozen=True, kw_only=True, slots=True)
@@ -18,6 +38,11 @@ class Category(CheckBase):
     checks: Sequence[Check]
 
     def map_checks(self, entries: Iterable[OverpassEntry]) -> dict[Check, list[OverpassEntry]]:
+        entries = list(entries)
+
+        if executor := get_executor(len(entries)):
+            return self._map_checks_parallel(executor, entries)
+
         # filter with category selectors if set
         if self.selectors:
             entries = [e for e in entries if self.is_selected(e.tags)]
@@ -29,3 +54,16 @@ class Category(CheckBase):
                 result[c] = value
 
         return result
+
+    def _map_checks_parallel(self, executor, entries: list[OverpassEntry]) -> dict[Check, list[OverpassEntry]]:
+        # only the tags are sent to the workers and only the check identifiers are sent back
+        selected = map_sharded(executor, partial(_select_checks, self.identifier),
+                               [e.tags for e in entries], [e.changeset_id for e in entries])
+
+        result = {}
+
+        for c in self.checks:
+            if value := [e for e, ids in zip(entries, selected) if c.identifier in ids]:
+                result[c] = value
+
+        return result
@@ -22,6 +22,13 @@ class Check(CheckBase):
     pre_fn: Callable[[Tags], bool] | None = None
     post_fn: Callable[['Overpass', list[OverpassEntry]], list[OverpassEntry]] | None = None
 
+    # name of the Overpass post query, fused with the other checks' ones into shared requests
+    post_query: str | None = None
+
+    @property
+    def has_post(self) -> bool:
+        return self.post_fn is not None or self.post_query is not None
+
     def map_title_entries(self, entries: Iterable[OverpassEntry]) -> dict[str, list[OverpassEntry]]:
         result = defaultdict(list)
 
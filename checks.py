@@ -44,7 +44,7 @@ OVERPASS_CATEGORIES: list[Category] = [
 
                 selectors=('addr:city', 'addr:place'),
                 pre_fn=lambda t: (t['addr:city'] != t['addr:place']),
-                post_fn=lambda o, i: o.query_place_not_in_area(i)
+                post_query='place_not_in_area'
             ),
 
             Check(
@@ -88,7 +88,7 @@ OVERPASS_CATEGORIES: list[Category] = [
                 docs=None,
 
                 selectors=('addr:housenumber',),
-                post_fn=lambda o, i: o.query_duplicates(i)
+                post_query='duplicates'
             ),
 
             # Check(
@@ -132,7 +132,7 @@ OVERPASS_CATEGORIES: list[Category] = [
                 docs=None,
 
                 selectors=('addr:place',),
-                post_fn=lambda o, i: o.query_place_mistype(i)
+                post_query='place_mistype'
             ),
 
             Check(
@@ -162,7 +162,7 @@ OVERPASS_CATEGORIES: list[Category] = [
                 docs=None,
 
                 selectors=('addr:street',),
-                post_fn=lambda o, i: o.query_street_names(i)
+                post_query='street_names'
             ),
 
             Check(
@@ -344,6 +344,8 @@ CHANGESET_CATEGORIES: list[Category] = []
 
 ALL_CATEGORIES = OVERPASS_CATEGORIES + CHANGESET_CATEGORIES
 ALL_CHECKS = tuple(chain.from_iterable(c.checks for c in ALL_CATEGORIES))
+ALL_CATEGORIES_BY_ID = {c.identifier: c for c in ALL_CATEGORIES}
+ALL_CHECKS_BY_ID = {c.identifier: c for c in ALL_CHECKS}
 ALL_IDS = tuple(c.identifier for c in chain(ALL_CATEGORIES, ALL_CHECKS))
 
 assert len(set(ALL_IDS)) == len(ALL_IDS), 'Identifiers must be unique'
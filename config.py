@@ -1,13 +1,76 @@
 import os
+import socket
 from pathlib import Path
 
+from region import Region
+
 OSM_TOKEN = os.getenv('OSM_TOKEN')
 DRY_RUN = os.getenv('DRY_RUN') == '1'
 IGNORE_ALREADY_DISCUSSED = os.getenv('IGNORE_ALREADY_DISCUSSED') == '1'
 
+# standalone: do everything in this process
+# coordinator: ingest the window and enqueue per-changeset work units
+# worker: process the enqueued work units
+# sender: only deliver the comments waiting in the outbox, the other modes also do it in the background
+MODE = os.getenv('MODE', 'standalone')
+assert MODE in ('standalone', 'coordinator', 'worker', 'sender'), f'Unknown mode {MODE!r}'
+
+# seconds after the start when the remaining work is deferred to the next run, 0 disables,
+# keep it below the cron interval so that the runs never overlap
+RUN_DEADLINE = int(os.getenv('RUN_DEADLINE', '0'))
+
+QUEUE_PATH = Path(os.getenv('QUEUE_PATH', 'queue.db'))
+WORKER_ID = os.getenv('WORKER_ID', f'{socket.gethostname()}:{os.getpid()}')
+WORK_LEASE = 600  # 10 minutes
+WORK_MAX_ATTEMPTS = 5
+
+# changesets leased by a worker at once, their post queries are batched together
+WORK_BATCH_SIZE = int(os.getenv('WORK_BATCH_SIZE', '50'))
+WORK_RETENTION = 3600 * 24 * 7  # 7 days
+
+OUTBOX_PATH = Path(os.getenv('OUTBOX_PATH', 'outbox.db'))
+OUTBOX_INTERVAL = int(os.getenv('OUTBOX_INTERVAL', '10'))  # seconds between comments
+OUTBOX_LEASE = 600  # 10 minutes
+OUTBOX_MAX_ATTEMPTS = 5
+
+# process pool size for the CPU-bound stages, 0 or 1 runs everything in-process
+PROCESSES = int(os.getenv('PROCESSES', '0'))
+PARALLEL_MIN_ITEMS = int(os.getenv('PARALLEL_MIN_ITEMS', '10000'))
+
+# write per-stage cProfile stats and tracemalloc snapshots to this directory
+PROFILE_DIR = Path(os.getenv('PROFILE_DIR')) if os.getenv('PROFILE_DIR') else None
+
 USER_AGENT = f'osm-addr-bot (+https://github.com/Zaczero/osm-addr-bot)'
 
-OVERPASS_API_INTERPRETER = os.getenv('OVERPASS_API_INTERPRETER', 'https://overpass-api.de/api/interpreter')
+# comma-separated, each query goes to the best healthy interpreter that is fresh enough, failing over to the others
+OVERPASS_API_INTERPRETERS = tuple(os.getenv('OVERPASS_API_INTERPRETER', 'https://overpass-api.de/api/interpreter').split(','))
+OVERPASS_ENDPOINT_BACKOFF = 10  # seconds, doubled after each consecutive error
+OVERPASS_ENDPOINT_MAX_BACKOFF = 600  # 10 minutes
+
+# concurrent requests per endpoint, public instances allow about 2 per IP,
+# the region, catch-up and tile pools wait for a free slot
+OVERPASS_ENDPOINT_SLOTS = int(os.getenv('OVERPASS_ENDPOINT_SLOTS', '2'))
+
+# retry the busy (429) and timed out (504) requests, once every endpoint failed
+OVERPASS_BUSY_RETRIES = 3
+OVERPASS_BUSY_BACKOFF = 15  # seconds, doubled after each retry
+
+# ingest the augmented diffs, which deliver the previous element versions along with the changes,
+# so that is_editing_tags rarely needs the extra [date:] queries
+OVERPASS_ADIFF = os.getenv('OVERPASS_ADIFF') == '1'
+
+# the minutely replication interval, augmented diff windows cover whole sequences
+ADIFF_SEQUENCE_INTERVAL = 60  # seconds
+
+# split the main query into ROWSxCOLS tiles of SEARCH_BBOX, e.g. '3x3'
+OVERPASS_TILES = tuple(map(int, os.getenv('OVERPASS_TILES').split('x'))) if os.getenv('OVERPASS_TILES') else None
+OVERPASS_TILE_WORKERS = int(os.getenv('OVERPASS_TILE_WORKERS', '4'))
+OVERPASS_TILE_RETRIES = 2
+
+# cache the Overpass responses on disk, dry runs also replay the last cached timestamp_osm_base
+OVERPASS_CACHE_DIR = Path(os.getenv('OVERPASS_CACHE_DIR')) if os.getenv('OVERPASS_CACHE_DIR') else None
+OVERPASS_CACHE_MAX_SIZE = int(os.getenv('OVERPASS_CACHE_MAX_SIZE', str(1024 * 1024 * 1024)))  # 1 GiB
+OVERPASS_CACHE_BYPASS = os.getenv('OVERPASS_CACHE_BYPASS') == '1'  # refresh, don't read
 
 APP_BLACKLIST = (
     'StreetComplete',
@@ -27,24 +90,89 @@ APP_BLACKLIST = (
     'iOS',
 )
 
-SEARCH_RELATION = 49715
+SEARCH_REGIONS = {
+    'PL': Region(
+        identifier='PL',
+        relation=49715,
+        bbox={
+            'min_lat': 49.0273953,
+            'min_lon': 14.0745211,
+            'max_lat': 54.8515360,
+            'max_lon': 24.0299858
+        },
+    ),
+}
+
+# comma-separated identifiers of the regions served by this process
+REGIONS = tuple(SEARCH_REGIONS[r] for r in os.getenv('REGIONS', 'PL').split(','))
+REGION_WORKERS = int(os.getenv('REGION_WORKERS', '2'))
+
+# changesets verified concurrently before notifying
+NOTIFY_WORKERS = int(os.getenv('NOTIFY_WORKERS', '4'))
+
+# map the checks while the query is still running and prefetch the changesets and users of the issues,
+# the entries are handed over per window or tile, so this only overlaps with the ingestion
+# when it is split with CATCHUP or OVERPASS_TILES, otherwise it is a prefetch right after the query
+PIPELINE = os.getenv('PIPELINE') == '1'
+PIPELINE_WORKERS = int(os.getenv('PIPELINE_WORKERS', '4'))
+
+# covers all regions, used for the follow-up queries
 SEARCH_BBOX = {
-    'min_lat': 49.0273953,
-    'min_lon': 14.0745211,
-    'max_lat': 54.8515360,
-    'max_lon': 24.0299858
+    'min_lat': min(r.bbox['min_lat'] for r in REGIONS),
+    'min_lon': min(r.bbox['min_lon'] for r in REGIONS),
+    'max_lat': max(r.bbox['max_lat'] for r in REGIONS),
+    'max_lon': max(r.bbox['max_lon'] for r in REGIONS)
 }
 
-STATE_PATH = Path('state.json')
+STATE_PATH = Path('state.db')
+LEGACY_STATE_PATH = Path('state.json')  # imported once, if present
 STATE_MAX_BACKLOG = 3600 * 24 * 3  # 3 days
 STATE_MAX_DIFF = 3600 * 8  # 8 hours
 
+# persist the fetched pre-edit element versions between runs
+HISTORY_CACHE = os.getenv('HISTORY_CACHE') == '1'
+
+# catch-up mode: process the whole backlog in one run, querying adaptively sized windows concurrently
+CATCHUP = os.getenv('CATCHUP') == '1'
+CATCHUP_WORKERS = int(os.getenv('CATCHUP_WORKERS', '4'))
+CATCHUP_TARGET_ELEMENTS = 50_000
+CATCHUP_MIN_WINDOW = 600  # 10 minutes
+CATCHUP_MAX_WINDOW = STATE_MAX_DIFF
+
+# changesets are closed automatically after this idle time or age
+CHANGESET_IDLE_TIMEOUT = 3600  # 1 hour
+CHANGESET_MAX_AGE = 3600 * 24  # 24 hours
+
 NEW_USER_THRESHOLD = 15
 PRO_USER_THRESHOLD = 800
 
 DUPLICATE_FALSE_POSITIVE_MAX_DIST = 2  # max 1 object separation
 DUPLICATE_BFS_EXCLUDE_ADDR = True
+DUPLICATE_SEARCH_RADIUS = 100  # meters
+DUPLICATE_INDEX_CELL = 0.01  # degrees, about 1 km
 
 LARGE_ELEMENT_MAX_SIZE = 1000  # meters
 
+PLACE_SEARCH_RADIUS = 10_000  # meters
+
+# the UNKNOWN_STREET_NAME candidates with the same street in a cell are looked up together
+STREET_NAMES_GROUP_CELL = 0.002  # degrees, about 200 m
+
+# look up the nearby places in a local gazetteer stored at this path, refreshed daily
+GAZETTEER_PATH = Path(os.getenv('GAZETTEER_PATH')) if os.getenv('GAZETTEER_PATH') else None
+GAZETTEER_MAX_AGE = 3600 * 24  # 24 hours
+
+# SEARCH_BBOX extended by the search radius, about 0.1° of latitude and 0.15° of longitude in Poland
+GAZETTEER_BBOX = {
+    'min_lat': SEARCH_BBOX['min_lat'] - 0.1,
+    'min_lon': SEARCH_BBOX['min_lon'] - 0.15,
+    'max_lat': SEARCH_BBOX['max_lat'] + 0.1,
+    'max_lon': SEARCH_BBOX['max_lon'] + 0.15
+}
+
+# answer the post_fn queries from a local store built from this .osm.pbf extract instead of Overpass,
+# kept fresh with the replication diffs of the extract
+OFFLINE_PBF = Path(os.getenv('OFFLINE_PBF')) if os.getenv('OFFLINE_PBF') else None
+OFFLINE_PATH = Path(os.getenv('OFFLINE_PATH', 'offline.db'))
+
 MAX_ISSUES_PER_CHANGESET = 100
@@ -1,4 +1,9 @@
+from collections import defaultdict
+from collections.abc import Iterable
+from math import cos, floor, hypot, radians
+
 from aliases import Tags
+from config import DUPLICATE_INDEX_CELL
 from overpass_entry import OverpassEntry
 
 WHITELIST_TAGS = (
@@ -26,6 +31,9 @@ EQUAL_TAGS = (
     'addr:unit'
 )
 
+# about the size of a degree of latitude
+METERS_PER_DEGREE = 111_320
+
 
 def check_whitelist(tags: Tags) -> bool:
     return all(
@@ -37,20 +45,88 @@ def check_whitelist(tags: Tags) -> bool:
     )
 
 
-def check_equal_tag(left: Tags, right: Tags, key: str) -> bool:
-    return left.get(key, None) == right.get(key, None)
+def address_key(tags: Tags) -> tuple[str | None, ...]:
+    return tuple(tags.get(t, None) for t in EQUAL_TAGS)
+
+
+def bbox_distance(left: OverpassEntry, right: OverpassEntry) -> float:
+    '''
+    Distance between the closest points of the bounding boxes, in meters (equirectangular approximation).
+    '''
+    d_lat = max(left.bb_min.lat - right.bb_max.lat, right.bb_min.lat - left.bb_max.lat, 0)
+    d_lon = max(left.bb_min.lon - right.bb_max.lon, right.bb_min.lon - left.bb_max.lon, 0)
+    return hypot(d_lat, d_lon * cos(radians(left.bb_min.lat))) * METERS_PER_DEGREE
+
+
+class AddressIndex:
+    '''
+    Hashed index of the whitelisted addresses by their EQUAL_TAGS values and a coarse spatial cell,
+    so that only the elements with an equal address are ever compared.
+    Without `cell_size`, the bounding boxes are ignored and all the elements share a single cell.
+    '''
+
+    def __init__(self, entries: Iterable[OverpassEntry] = (), *, cell_size: float | None = DUPLICATE_INDEX_CELL):
+        self._cell_size = cell_size
+        self._index: dict[tuple, list[OverpassEntry]] = defaultdict(list)
+        self.add(entries)
+
+    def _cells(self, entry: OverpassEntry, radius: float) -> list[tuple[int, int]]:
+        if self._cell_size is None:
+            return [(0, 0)]
+
+        d_lat = radius / METERS_PER_DEGREE
+        d_lon = d_lat / max(cos(radians(entry.bb_min.lat)), 0.01)
+
+        return [
+            (lat, lon)
+            for lat in range(floor((entry.bb_min.lat - d_lat) / self._cell_size),
+                             floor((entry.bb_max.lat + d_lat) / self._cell_size) + 1)
+            for lon in range(floor((entry.bb_min.lon - d_lon) / self._cell_size),
+                             floor((entry.bb_max.lon + d_lon) / self._cell_size) + 1)
+        ]
 
+    def add(self, entries: Iterable[OverpassEntry]) -> None:
+        for e in entries:
+            if 'addr:housenumber' not in e.tags or not check_whitelist(e.tags):
+                continue
 
-def check_equal_tags(left: OverpassEntry, right: OverpassEntry) -> bool:
-    return all(check_equal_tag(left.tags, right.tags, t) for t in EQUAL_TAGS)
+            key = address_key(e.tags)
+
+            for cell in self._cells(e, 0):
+                self._index[(key, cell)].append(e)
+
+    def search(self, entry: OverpassEntry, radius: float = 0) -> list[OverpassEntry]:
+        '''
+        Find the other indexed elements with the same address, within `radius` meters if spatial.
+        '''
+        key = address_key(entry.tags)
+        result = {}
+
+        for cell in self._cells(entry, radius):
+            for e in self._index.get((key, cell), ()):
+                if e != entry and (self._cell_size is None or bbox_distance(entry, e) <= radius):
+                    result[e.uid] = e
+
+        return list(result.values())
 
 
 def duplicate_search(entry: OverpassEntry, ref: list[OverpassEntry]) -> list[OverpassEntry]:
-    assert 'addr:housenumber' in entry.tags
-
-    return [
-        e for e in ref
-        if e != entry
-        and check_whitelist(e.tags)
-        and check_equal_tags(e, entry)
-    ]
+    return duplicate_search_many([(entry, ref)])[0]
+
+
+def duplicate_search_many(pairs: list[tuple[OverpassEntry, list[OverpassEntry]]]) -> list[list[OverpassEntry]]:
+    '''
+    Search the duplicates of each entry among its references, through an index shared by all the pairs.
+    The references are already known to be nearby.
+    '''
+    index = AddressIndex({e.uid: e for _, ref in pairs for e in ref}.values(), cell_size=None)
+    result = []
+
+    for entry, ref in pairs:
+        assert 'addr:housenumber' in entry.tags
+
+        # each entry has its own copies of the references
+        ref_by_uid = {e.uid: e for e in ref}
+        result.append([ref_by_uid[e.uid] for e in index.search(entry) if e.uid in ref_by_uid])
+
+    return result
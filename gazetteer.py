@@ -0,0 +1,89 @@
+from collections import defaultdict
+from math import cos, pi, radians, sin
+from operator import itemgetter
+from typing import Iterable
+
+from overpass_entry import Point
+
+EARTH_RADIUS = 6_371_000  # meters
+
+Vector = tuple[float, float, float]
+
+
+def _to_vector(point: Point) -> Vector:
+    lat, lon = radians(point.lat), radians(point.lon)
+    return cos(lat) * cos(lon), cos(lat) * sin(lon), sin(lat)
+
+
+def _chord(distance: float) -> float:
+    '''
+    Straight-line distance between two unit vectors that are `distance` meters apart on the surface.
+    '''
+    return 2 * sin(min(distance / EARTH_RADIUS, pi) / 2)
+
+
+class KDTree:
+    '''
+    Static 3-d tree over unit vectors, stored in place as a median-split array.
+    '''
+
+    def __init__(self, points: Iterable[Vector]):
+        self.points = list(points)
+        self._build(0, len(self.points), 0)
+
+    def _build(self, lo: int, hi: int, axis: int) -> None:
+        if hi - lo <= 1:
+            return
+
+        self.points[lo:hi] = sorted(self.points[lo:hi], key=itemgetter(axis))
+        mid = (lo + hi) // 2
+        self._build(lo, mid, (axis + 1) % 3)
+        self._build(mid + 1, hi, (axis + 1) % 3)
+
+    def any_within(self, p: Vector, r: float) -> bool:
+        return self._any_within(p, r, r * r, 0, len(self.points), 0)
+
+    def _any_within(self, p: Vector, r: float, r2: float, lo: int, hi: int, axis: int) -> bool:
+        if lo >= hi:
+            return False
+
+        mid = (lo + hi) // 2
+        q = self.points[mid]
+
+        if (p[0] - q[0]) ** 2 + (p[1] - q[1]) ** 2 + (p[2] - q[2]) ** 2 <= r2:
+            return True
+
+        d = p[axis] - q[axis]
+        next_axis = (axis + 1) % 3
+        near, far = ((lo, mid), (mid + 1, hi)) if d < 0 else ((mid + 1, hi), (lo, mid))
+
+        if self._any_within(p, r, r2, *near, next_axis):
+            return True
+
+        # the other side can only match if the splitting plane is within reach
+        return abs(d) <= r and self._any_within(p, r, r2, *far, next_axis)
+
+
+class Gazetteer:
+    '''
+    Named place=* features with a spatial index per name, for the radius-by-name lookups.
+    '''
+
+    def __init__(self, places: Iterable[tuple[str, float, float]]):
+        by_name: dict[str, list[Vector]] = defaultdict(list)
+
+        for name, lat, lon in places:
+            by_name[name].append(_to_vector(Point(lat, lon)))
+
+        self._trees = {name: KDTree(points) for name, points in by_name.items()}
+
+    def __len__(self) -> int:
+        return sum(len(tree.points) for tree in self._trees.values())
+
+    def has_place_near(self, name: str, point: Point, distance: float) -> bool:
+        tree = self._trees.get(name)
+
+        if tree is None:
+            return False
+
+        return tree.any_within(_to_vector(point), _chord(distance))
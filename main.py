@@ -1,20 +1,31 @@
 import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 from datetime import UTC, datetime
 from itertools import chain
+from threading import Event, Thread
+from typing import Literal
 
 from cachetools import cached
 from cachetools.keys import hashkey
 
+from aliases import Identifier
 from category import Category
 from check import Check
-from checks import OVERPASS_CATEGORIES
-from config import (APP_BLACKLIST, DRY_RUN, IGNORE_ALREADY_DISCUSSED, MAX_ISSUES_PER_CHANGESET,
-                    NEW_USER_THRESHOLD, PRO_USER_THRESHOLD)
+from checks import ALL_CATEGORIES_BY_ID, OVERPASS_CATEGORIES
+from config import (APP_BLACKLIST, DRY_RUN, HISTORY_CACHE, IGNORE_ALREADY_DISCUSSED, MAX_ISSUES_PER_CHANGESET,
+                    MODE, NEW_USER_THRESHOLD, NOTIFY_WORKERS, OUTBOX_INTERVAL, PIPELINE, PIPELINE_WORKERS,
+                    PRO_USER_THRESHOLD, PROFILE_DIR, REGION_WORKERS, RUN_DEADLINE, WORK_BATCH_SIZE, WORK_RETENTION,
+                    WORKER_ID)
 from osmapi import OsmApi
+from outbox import Outbox
 from overpass import Overpass
 from overpass_entry import OverpassEntry
-from state import State
-from utils import group_by_changeset
+from pipeline import Pipeline
+from profiling import profile_stage
+from state import State, StateLockedError, predict_close
+from utils import group_by_changeset, is_overdue, parse_timestamp
+from work_queue import WorkQueue
 
 LINK_SORT_DICT = {
     'node': 0,
@@ -23,6 +34,16 @@ LINK_SORT_DICT = {
 }
 
 
+def check_sort_key(check: Check) -> tuple:
+    return not check.critical, -check.priority
+
+
+def changeset_sort_key(changeset_issues: dict[Check, list[OverpassEntry]]) -> tuple:
+    # critical first, then the oldest
+    return (not any(c.critical for c in changeset_issues),
+            min(i.timestamp for ii in changeset_issues.values() for i in ii))
+
+
 @cached(cache={}, key=lambda osm, changeset_id: hashkey(changeset_id))
 def should_discuss(osm: OsmApi, changeset_id: int) -> bool:
     changeset = osm.get_changeset(changeset_id)
@@ -66,20 +87,128 @@ def filter_should_not_discuss(osm: OsmApi, issues: dict[Check, list[OverpassEntr
             issues.pop(check)
 
 
-def filter_post_fn(overpass: Overpass, issues: dict[Check, list[OverpassEntry]]) -> None:
-    check_post = [(c, i) for c, i in issues.items() if c.post_fn]
+def prune_changesets(osm: OsmApi, cat: Category,
+                     issues: dict[Check, list[OverpassEntry]]) -> dict[int, dict[Check, list[OverpassEntry]]]:
+    '''
+    Skip the changesets that verify_changeset would skip regardless of the post queries, before paying for them.
+    Returns the open changesets, they are removed from `issues` to be rescheduled.
+    '''
+    groups = group_by_changeset(issues)
+    open_groups = {}
+    pruned = set()
+
+    for changeset_id, changeset_issues in groups.items():
+        changeset = osm.get_changeset(changeset_id)
+
+        if changeset['open']:
+            print(f'🔓️ Rescheduled {changeset_id}: Open changeset')
+            open_groups[changeset_id] = changeset_issues
+            pruned.add(changeset_id)
+            continue
+
+        user = osm.get_user(changeset['uid'])
+
+        if user is None:
+            print(f'❌ Skipped {changeset_id}: User not found')
+            pruned.add(changeset_id)
+            continue
+
+        if user['changesets']['count'] < cat.min_changesets:
+            print(f'🌱 Skipped {changeset_id}: New user')
+            pruned.add(changeset_id)
+            continue
+
+        # the post queries only ever remove issues, the others are certain to stay
+        min_issues = len({i for c, ii in changeset_issues.items() if not c.has_post for i in ii})
+
+        if min_issues > MAX_ISSUES_PER_CHANGESET:
+            print(f'📝 Skipped {changeset_id}: Too many issues')
+            pruned.add(changeset_id)
+            continue
+
+    for check, check_issues in list(issues.items()):
+        new_issues = [i for i in check_issues if i.changeset_id not in pruned]
+
+        if new_issues:
+            issues[check] = new_issues
+        else:
+            issues.pop(check)
+
+    return open_groups
+
+
+def reschedule_open(osm: OsmApi, s: State, cat: Category, open_groups: dict[int, dict[Check, list[OverpassEntry]]]) -> None:
+    '''
+    Reschedule the open changesets pruned before the post queries.
+    Their issues needing the post queries are deferred until the next poll, the rescheduled ones are not post-filtered.
+    '''
+    for changeset_id, changeset_issues in open_groups.items():
+        s.reschedule_issues(cat.identifier, changeset_id, {c: i for c, i in changeset_issues.items() if not c.has_post})
+        s.defer_issues(cat.identifier, {c: i for c, i in changeset_issues.items() if c.has_post})
+        s.schedule_poll(osm.get_changeset(changeset_id),
+                        max(i.timestamp for ii in changeset_issues.values() for i in ii))
+
+
+def filter_post_fn(overpass: Overpass, issues: dict[Check, list[OverpassEntry]],
+                   deadline: float | None = None) -> dict[Check, list[OverpassEntry]]:
+    '''
+    Filter the issues with the post queries, the most important checks first.
+    Returns the issues of the changesets left unfiltered past the deadline, they are removed from `issues`.
+    '''
+    check_post = sorted(((c, i) for c, i in issues.items() if c.post_fn), key=lambda t: check_sort_key(t[0]))
+    check_fused = sorted(((c, i) for c, i in issues.items() if c.post_query), key=lambda t: check_sort_key(t[0]))
+    total = len(check_post) + bool(check_fused)
+    results = []
+    deferred = {}
+
+    if check_fused and is_overdue(deadline):
+        deferred.update(check_fused)
+    elif check_fused:
+        print(f'[3/{2 + total}] Filtering '
+              f'{", ".join(f"{len(i)} × {c.identifier}" for c, i in check_fused)}…', end='')
+
+        time_start = time.perf_counter()
+        fused_issues, unresolved = overpass.query_fused([(c.post_query, i) for c, i in check_fused], deadline)
+        print(f' ({time.perf_counter() - time_start:.1F} sec)')
+
+        results.extend(zip((c for c, _ in check_fused), fused_issues))
+        deferred.update((c, u) for (c, _), u in zip(check_fused, unresolved) if u)
+
+    for i, (check, check_issues) in enumerate(check_post, 3 + bool(check_fused)):
+        if is_overdue(deadline):
+            deferred[check] = check_issues
+            continue
 
-    for i, (check, check_issues) in enumerate(check_post):
-        print(f'[{3 + i}/{2 + len(check_post)}] Filtering {len(check_issues)} × {check.identifier}…', end='')
+        print(f'[{i}/{2 + total}] Filtering {len(check_issues)} × {check.identifier}…', end='')
 
         time_start = time.perf_counter()
         new_issues = check.post_fn(overpass, check_issues)
         print(f' ({time.perf_counter() - time_start:.1F} sec)')
 
+        results.append((check, new_issues))
+
+    for check in deferred:
+        issues.pop(check)
+
+    # the partially resolved checks keep their resolved issues
+    for check, new_issues in results:
         if new_issues:
             issues[check] = new_issues
         else:
-            issues.pop(check)
+            issues.pop(check, None)
+
+    # a changeset is notified once, with all of its issues
+    if deferred_ids := {i.changeset_id for check_issues in deferred.values() for i in check_issues}:
+        for check, check_issues in list(issues.items()):
+            if moved := [i for i in check_issues if i.changeset_id in deferred_ids]:
+                deferred[check] = deferred.get(check, []) + moved
+
+                if kept := [i for i in check_issues if i.changeset_id not in deferred_ids]:
+                    issues[check] = kept
+                else:
+                    issues.pop(check)
+
+    return deferred
 
 
 def filter_priority(issues: dict[Check, list[OverpassEntry]], *, consider_post_fn: bool) -> None:
@@ -94,7 +223,7 @@ def filter_priority(issues: dict[Check, list[OverpassEntry]], *, consider_post_f
         for check_issue in check_issues:
             if max_priorities.get(check_issue, 0) <= check.priority:
 
-                if not consider_post_fn or check.post_fn is None:
+                if not consider_post_fn or not check.has_post:
                     max_priorities[check_issue] = check.priority
 
                 new_issues.append(check_issue)
@@ -162,99 +291,401 @@ def compose_message(cat: Category, user: dict, issues: dict[Check, list[Overpass
     return message
 
 
-def main():
-    time_start = time.perf_counter()
+def is_already_notified(osm: OsmApi, cat: Category, changeset: dict) -> bool:
+    bot_uid = osm.get_authorized_user()['id']
 
-    if DRY_RUN:
-        print('🌵 This is a dry run')
+    return any(
+        discussion['uid'] == bot_uid and (cat.header in discussion['text'] or cat.header_critical in discussion['text'])
+        for discussion in changeset.get('discussion', []))
+
+
+def verify_changeset(osm: OsmApi, overpass: Overpass, cat: Category, changeset_id: int,
+                     changeset_issues: dict[Check, list[OverpassEntry]], deadline: float | None = None
+                     ) -> tuple[Literal['open', 'skipped', 'notify', 'overdue'], str]:
+    '''
+    Decide whether to notify the changeset. Never prints nor touches the state, so it can run concurrently.
+    Returns the composed message to notify with, or the log line to skip with.
+    Past the deadline, no more requests are made and the verification is abandoned as overdue.
+    '''
+    if is_overdue(deadline):
+        return 'overdue', ''
+
+    changeset = osm.get_changeset(changeset_id)
+
+    if changeset['open']:
+        return 'open', f'🔓️ Rescheduled {changeset_id}: Open changeset'
+
+    if is_overdue(deadline):
+        return 'overdue', ''
+
+    # this must be done after post_fn - issues may change because of it
+    if not overpass.is_editing_tags(cat, changeset_issues):
+        return 'skipped', f'😇 Skipped {changeset_id}: Not guilty'
+
+    filter_priority(changeset_issues, consider_post_fn=False)
+
+    if is_overdue(deadline):
+        return 'overdue', ''
+
+    user = osm.get_user(changeset['uid'])
+
+    # deleted users will not read the discussion
+    if user is None:
+        return 'skipped', f'❌ Skipped {changeset_id}: User not found'
+
+    # check changesets count
+    if user['changesets']['count'] < cat.min_changesets:
+        return 'skipped', f'🌱 Skipped {changeset_id}: New user'
+
+    # check number of issues
+    num_issues = sum(len(i) for i in changeset_issues.values())
+    if num_issues > MAX_ISSUES_PER_CHANGESET:
+        return 'skipped', f'📝 Skipped {changeset_id}: Too many issues'
+
+    if is_overdue(deadline):
+        return 'overdue', ''
+
+    # work may be retried after a crash, don't comment twice
+    if is_already_notified(osm, cat, changeset):
+        return 'skipped', f'🔁 Skipped {changeset_id}: Already notified'
+
+    return 'notify', compose_message(cat, user, changeset_issues)
+
+
+def deliver(outbox: Outbox, cat: Category, changeset_id: int,
+            verdict: tuple[Literal['open', 'skipped', 'notify'], str]) -> Literal['open', 'skipped', 'notified']:
+    result, text = verdict
+
+    if result != 'notify':
+        if result == 'skipped':
+            print(text)
+
+        return result
+
+    if not DRY_RUN:
+        outbox.put(cat.identifier, changeset_id, text)
+        print(f'📮 Queued https://www.openstreetmap.org/changeset/{changeset_id}')
+    else:
+        print(text)
+        print(f'✅ Notified https://www.openstreetmap.org/changeset/{changeset_id} [DRY_RUN]')
+
+    # TODO: s.add_to_summary(changeset_id, changeset_issues)
+    return 'notified'
+
+
+def notify_changeset(osm: OsmApi, overpass: Overpass, outbox: Outbox, cat: Category, changeset_id: int,
+                     changeset_issues: dict[Check, list[OverpassEntry]]) -> Literal['open', 'skipped', 'notified']:
+    return deliver(outbox, cat, changeset_id, verify_changeset(osm, overpass, cat, changeset_id, changeset_issues))
+
+
+def notify(osm: OsmApi, overpass: Overpass, outbox: Outbox, s: State, cat: Category,
+           groups: dict[int, dict[Check, list[OverpassEntry]]], deadline: float | None = None) -> None:
+    '''
+    Verify the changesets concurrently, then deliver the results in order on the calling thread,
+    which alone prints and touches the state and the outbox.
+    '''
+    groups = sorted(groups.items(), key=lambda t: changeset_sort_key(t[1]))
+
+    # the profiler is not thread-safe
+    with ThreadPoolExecutor(NOTIFY_WORKERS if PROFILE_DIR is None else 1) as executor:
+        futures = [executor.submit(verify_changeset, osm, overpass, cat, changeset_id, changeset_issues, deadline)
+                   for changeset_id, changeset_issues in groups]
+
+        for n, ((changeset_id, changeset_issues), future) in enumerate(zip(groups, futures)):
+            verdict = ('overdue', '') if is_overdue(deadline) else future.result()
+
+            # the rescheduled issues without a poll are merged in the next run,
+            # the running verifications stop before their next request
+            if verdict[0] == 'overdue':
+                executor.shutdown(wait=False, cancel_futures=True)
+
+                for overdue_id, overdue_issues in groups[n:]:
+                    s.reschedule_issues(cat.identifier, overdue_id, overdue_issues)
+
+                print(f'⏰ Rescheduled {len(groups) - n} changeset{"" if len(groups) - n == 1 else "s"}: Run deadline')
+                break
+
+            if deliver(outbox, cat, changeset_id, verdict) == 'open':
+                print(verdict[1])
+                s.reschedule_issues(cat.identifier, changeset_id, changeset_issues)
+                s.schedule_poll(osm.get_changeset(changeset_id),
+                                max(i.timestamp for ii in changeset_issues.values() for i in ii))
 
+
+def work(osm: OsmApi, overpass: Overpass, deadline: float | None = None) -> None:
+    '''
+    Process the work units enqueued by the coordinator until there are none available or the deadline passes.
+    '''
+    with WorkQueue() as queue, Outbox() as outbox:
+        while not is_overdue(deadline) and (units := queue.lease(WORKER_ID, WORK_BATCH_SIZE)):
+            cat = ALL_CATEGORIES_BY_ID[units[0].category]
+            print(f'📦 Work unit{"" if len(units) == 1 else "s"} {", ".join(str(u.id) for u in units)}: '
+                  f'{cat.identifier} {", ".join(str(u.changeset_id) for u in units)}')
+
+            # the post queries of all the leased changesets share the requests
+            issues = {}
+
+            for unit in units:
+                for check, check_issues in unit.issues.items():
+                    issues.setdefault(check, []).extend(check_issues)
+
+            filter_post_fn(overpass, issues)
+            groups = group_by_changeset(issues)
+            results = {}
+
+            for unit in units:
+                changeset_issues = groups.get(unit.changeset_id)
+
+                if not changeset_issues:
+                    queue.complete(unit, WORKER_ID, 'skipped')
+                    continue
+
+                # a changeset enqueued again shares the verdict, its issues were merged
+                if (result := results.get(unit.changeset_id)) is None:
+                    result = results[unit.changeset_id] = \
+                        notify_changeset(osm, overpass, outbox, cat, unit.changeset_id, changeset_issues)
+
+                if result == 'open':
+                    changeset = osm.get_changeset(unit.changeset_id)
+                    last_activity = max(i.timestamp for ii in changeset_issues.values() for i in ii)
+                    not_before = predict_close(parse_timestamp(changeset['created_at']), last_activity)
+                    print(f'🔓️ Deferred {unit.changeset_id}: Open changeset')
+                    queue.defer(unit, WORKER_ID, not_before)
+                elif not queue.complete(unit, WORKER_ID, result):
+                    print(f'⚠️ Lost the lease on work unit {unit.id}')
+
+        queue.purge(WORK_RETENTION)
+
+
+def send(osm: OsmApi, stop: Event) -> None:
+    '''
+    Deliver the comments waiting in the outbox, at most one per OUTBOX_INTERVAL seconds.
+    Returns once `stop` is set and no more comments are due.
+    '''
+    with Outbox() as outbox:
+        last_sent = -OUTBOX_INTERVAL
+
+        while True:
+            message = outbox.lease()
+
+            if message is None:
+                if stop.is_set():
+                    break
+
+                stop.wait(1)
+                continue
+
+            # the previous attempt may have been posted before failing
+            if message.attempts > 1 and is_already_notified(
+                    osm, ALL_CATEGORIES_BY_ID[message.category], osm.fetch_changeset(message.changeset_id)):
+                outbox.sent(message)
+                continue
+
+            time.sleep(max(0.0, last_sent + OUTBOX_INTERVAL - time.monotonic()))
+
+            try:
+                osm.post_comment(message.changeset_id, message.text)
+            except Exception as e:
+                print(f'⚠️ Commenting {message.changeset_id} failed, retrying later: {e!r}')
+                outbox.retry(message)
+                continue
+            finally:
+                last_sent = time.monotonic()
+
+            outbox.sent(message)
+            print(f'✅ Notified https://www.openstreetmap.org/changeset/{message.changeset_id}')
+
+        outbox.purge(WORK_RETENTION)
+
+
+def login(osm: OsmApi) -> None:
     print('🔒️ Logging in to OpenStreetMap')
-    osm = OsmApi()
     user = osm.get_authorized_user()
     print(f'👤 Welcome, {user["display_name"]}!')
 
-    with State() as s:
-        overpass = Overpass(s)
-        s.configure_end_ts(overpass.get_timestamp_osm_base() - 1)
 
-        start_date = datetime.fromtimestamp(s.start_ts, UTC)
-        end_date = datetime.fromtimestamp(s.end_ts, UTC)
+def query_regions(overpass: Overpass, s: State) -> dict[Identifier, list[OverpassEntry]]:
+    '''
+    Query the regions on a shared pool, the ones furthest behind are scheduled first.
+    Regions that failed or have nothing to query yet are omitted from the result.
+    '''
+    cursors = sorted(s.cursors.values(), key=lambda c: c.start_ts)
+    result = {}
+    error = None
+
+    # the profiler is not thread-safe
+    with ThreadPoolExecutor(REGION_WORKERS if PROFILE_DIR is None else 1) as executor:
+        futures = [(c, executor.submit(overpass.query, c)) for c in cursors]
+
+    for cursor, future in futures:
+        if e := future.exception():
+            print(f'⚠️ [{cursor.region.identifier}] Query failed: {e!r}')
+            cursor.end_ts = cursor.start_ts
+            error = e
+            continue
 
-        print(f'Time range: {start_date} - {end_date}')
-        print(f'[1/?] Querying issues…')
-        changed = overpass.query()
+        changed = future.result()
 
         if changed is False:
+            continue
+
+        assert isinstance(changed, list)
+        result[cursor.region.identifier] = changed
+
+    if error is not None and not result:
+        raise error
+
+    return result
+
+
+def run(osm: OsmApi, deadline: float | None = None) -> None:
+    # the workers fetch the changesets themselves, profiled runs stay sequential
+    pipelined = PIPELINE and MODE != 'coordinator' and PROFILE_DIR is None
+
+    with State() as s, (WorkQueue() if MODE == 'coordinator' else nullcontext()) as queue, Outbox() as outbox, \
+            (Pipeline(osm, PIPELINE_WORKERS) if pipelined else nullcontext()) as pipeline:
+        overpass = Overpass()
+
+        if pipeline is not None:
+            overpass.on_entries = pipeline.feed
+
+        if HISTORY_CACHE:
+            overpass.history.update(s.load_history())
+
+        # a replayed state behind the cursors would leave nothing to query
+        timestamp_osm_base = overpass.get_timestamp_osm_base(max(c.start_ts for c in s.cursors.values()))
+
+        for cursor in s.cursors.values():
+            cursor.configure_end_ts(timestamp_osm_base - 1)
+
+            start_date = datetime.fromtimestamp(cursor.start_ts, UTC)
+            end_date = datetime.fromtimestamp(cursor.end_ts, UTC)
+
+            print(f'[{cursor.region.identifier}] Time range: {start_date} - {end_date}')
+
+        print(f'[1/?] Querying issues…')
+
+        with profile_stage('query'):
+            changed_by_region = query_regions(overpass, s)
+
+        if not changed_by_region:
             print('🕒️ Overpass is updating, try again shortly')
             return
 
-        assert isinstance(changed, list)
+        login(osm)
 
         # TODO: fix progress numbering
         for cat in OVERPASS_CATEGORIES:
+            regions = [r for r in changed_by_region if s.cursors[r].region.has_category(cat.identifier)]
+
+            if not regions:
+                continue
+
             print(f'📂 Category: {cat.identifier}')
 
-            subset = cat.map_checks(changed)
+            # changesets crossing the region borders are processed once
+            changed = list({e.uid: e for r in regions for e in changed_by_region[r]}.values())
+
+            with profile_stage(f'{cat.identifier}.map_checks'):
+                subset = pipeline.map_checks(cat, changed) if pipeline is not None else cat.map_checks(changed)
+
+            if pipeline is not None:
+                pipeline.join_changesets()
+
+            with profile_stage(f'{cat.identifier}.filter_should_not_discuss'):
+                filter_should_not_discuss(osm, subset)
+
+            if deferred_len := s.merge_deferred_issues(cat.identifier, subset):
+                print(f'⏰ Merged {deferred_len} deferred issue{"" if deferred_len == 1 else "s"}')
 
-            filter_should_not_discuss(osm, subset)
             filter_priority(subset, consider_post_fn=True)
-            filter_post_fn(overpass, subset)
+
+            with profile_stage(f'{cat.identifier}.prune_changesets'):
+                open_groups = prune_changesets(osm, cat, subset)
+
+            # the workers do the rest
+            if queue is not None:
+                groups = group_by_changeset(subset)
+                s.merge_rescheduled_issues(cat.identifier, groups)
+
+                # only after the merge, which would take them back in
+                reschedule_open(osm, s, cat, open_groups)
+
+                if not DRY_RUN:
+                    enqueued = queue.enqueue_all(cat.identifier, groups)
+                    print(f'📥 Enqueued {enqueued} changeset{"" if enqueued == 1 else "s"}')
+                else:
+                    print(f'📥 Enqueued {len(groups)} changeset{"" if len(groups) == 1 else "s"} [DRY_RUN]')
+
+                continue
+
+            with profile_stage(f'{cat.identifier}.filter_post_fn'):
+                deferred = filter_post_fn(overpass, subset, deadline)
+
+            if deferred:
+                s.defer_issues(cat.identifier, deferred)
+                deferred_len = sum(len(i) for i in deferred.values())
+                print(f'⏰ Deferred {deferred_len} issue{"" if deferred_len == 1 else "s"}: Run deadline')
 
             groups = group_by_changeset(subset)
             discovered_len = len(groups)
             merged_len = s.merge_rescheduled_issues(cat.identifier, groups)
 
+            # the rescheduled issues of the deferred changesets wait for them
+            for changeset_id in {i.changeset_id for ii in deferred.values() for i in ii} & groups.keys():
+                s.defer_issues(cat.identifier, groups.pop(changeset_id))
+                merged_len -= 1
+
+            # only after the merge, which would take them back in
+            reschedule_open(osm, s, cat, open_groups)
+
             if merged_len:
                 print(f'Total changesets: {discovered_len}+{merged_len}')
             else:
                 print(f'Total changesets: {discovered_len}')
 
-            for changeset_id, changeset_issues in groups.items():
-                changeset = osm.get_changeset(changeset_id)
-
-                if changeset['open']:
-                    print(f'🔓️ Rescheduled {changeset_id}: Open changeset')
-                    s.reschedule_issues(cat.identifier, changeset_id, changeset_issues)
-                    continue
-
-                # this must be done after post_fn - issues may change because of it
-                if not overpass.is_editing_tags(cat, changeset_issues):
-                    print(f'😇 Skipped {changeset_id}: Not guilty')
-                    continue
-
-                filter_priority(changeset_issues, consider_post_fn=False)
+            with profile_stage(f'{cat.identifier}.notify'):
+                notify(osm, overpass, outbox, s, cat, groups, deadline)
 
-                user = osm.get_user(changeset['uid'])
+        if not DRY_RUN:
+            if HISTORY_CACHE:
+                s.save_history(overpass.history)
 
-                # deleted users will not read the discussion
-                if user is None:
-                    print(f'❌ Skipped {changeset_id}: User not found')
-                    continue
+            s.write_state()
 
-                # check changesets count
-                if user['changesets']['count'] < cat.min_changesets:
-                    print(f'🌱 Skipped {changeset_id}: New user')
-                    continue
 
-                # check number of issues
-                num_issues = sum(len(i) for i in changeset_issues.values())
-                if num_issues > MAX_ISSUES_PER_CHANGESET:
-                    print(f'📝 Skipped {changeset_id}: Too many issues')
-                    continue
-
-                message = compose_message(cat, user, changeset_issues)
+def main():
+    time_start = time.perf_counter()
+    deadline = time.monotonic() + RUN_DEADLINE if RUN_DEADLINE else None
 
-                if not DRY_RUN:
-                    osm.post_comment(changeset_id, message)
-                    print(f'✅ Notified https://www.openstreetmap.org/changeset/{changeset_id}')
-                else:
-                    print(message)
-                    print(f'✅ Notified https://www.openstreetmap.org/changeset/{changeset_id} [DRY_RUN]')
+    if DRY_RUN:
+        print('🌵 This is a dry run')
 
-                # TODO: s.add_to_summary(changeset_id, changeset_issues)
+    osm = OsmApi()
 
-        if not DRY_RUN:
-            s.write_state()
+    # the runs log in once there is work to do
+    if MODE in ('worker', 'sender'):
+        login(osm)
+
+    # analysis is never held back by the comment delivery
+    stop = Event()
+    sender = Thread(target=send, args=(osm, stop)) if not DRY_RUN and MODE != 'coordinator' else None
+
+    if sender is not None:
+        sender.start()
+
+    try:
+        if MODE == 'worker':
+            work(osm, Overpass(), deadline)
+        elif MODE != 'sender':
+            run(osm, deadline)
+    except StateLockedError as e:
+        print(f'🔒️ Skipped the run: {e}')
+    finally:
+        stop.set()
+
+        if sender is not None:
+            sender.join()
 
     print(f'🏁 Finished in {time.perf_counter() - time_start:.1F} sec')
     print()
@@ -0,0 +1,462 @@
+import gzip
+import json
+import re
+import sqlite3
+from array import array
+from collections.abc import Iterable
+from math import cos, hypot, radians
+from pathlib import Path
+from threading import Lock
+
+from aliases import ElementType, Tags
+from config import DUPLICATE_SEARCH_RADIUS, GAZETTEER_PATH, PLACE_SEARCH_RADIUS
+from overpass_entry import OverpassEntry
+from pbf import PbfElement, read_pbf
+from utils import get_http_client
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS node (
+    id INTEGER PRIMARY KEY,
+    lat REAL NOT NULL,
+    lon REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS way (
+    id INTEGER PRIMARY KEY,
+    nodes BLOB NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS feature (
+    fid INTEGER PRIMARY KEY,
+    type TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    tags TEXT NOT NULL,
+    rings TEXT,
+    UNIQUE (type, id)
+);
+
+CREATE VIRTUAL TABLE IF NOT EXISTS housenumber_idx USING rtree(id, min_lat, max_lat, min_lon, max_lon);
+CREATE VIRTUAL TABLE IF NOT EXISTS street_idx USING rtree(id, min_lat, max_lat, min_lon, max_lon);
+CREATE VIRTUAL TABLE IF NOT EXISTS place_idx USING rtree(id, min_lat, max_lat, min_lon, max_lon);
+CREATE VIRTUAL TABLE IF NOT EXISTS area_idx USING rtree(id, min_lat, max_lat, min_lon, max_lon);
+'''
+
+INDEXES = ('housenumber', 'street', 'place', 'area')
+
+# about the size of a degree of latitude
+METERS_PER_DEGREE = 111_320
+
+SEQUENCE_RE = re.compile(r'^sequenceNumber=(\d+)$', re.MULTILINE)
+
+BBox = tuple[float, float, float, float]  # min_lat, max_lat, min_lon, max_lon
+Coords = tuple[float, float]  # lat, lon
+
+
+def _indexes(element_type: ElementType, tags: Tags, rings: list | None) -> list[str]:
+    '''
+    The tag indexes the element belongs to, mirroring the selectors of the post_fn queries.
+    '''
+    result = []
+
+    if 'addr:housenumber' in tags:
+        result.append('housenumber')
+
+    if element_type != 'node' and 'highway' in tags and 'name' in tags:
+        result.append('street')
+
+    if 'place' in tags and 'name' in tags:
+        result.append('place')
+
+    # the administrative areas are never queried
+    if rings and 'name' in tags and 'admin_level' not in tags:
+        result.append('area')
+
+    return result
+
+
+def _bbox(points: Iterable[Coords]) -> BBox:
+    lats, lons = zip(*points)
+    return min(lats), max(lats), min(lons), max(lons)
+
+
+def _bbox_distance(a: BBox, b: BBox) -> float:
+    '''
+    Distance between the closest points of two bounding boxes, in meters (equirectangular approximation).
+    '''
+    d_lat = max(a[0] - b[1], b[0] - a[1], 0)
+    d_lon = max(a[2] - b[3], b[2] - a[3], 0)
+    return hypot(d_lat, d_lon * cos(radians((a[0] + a[1]) / 2))) * METERS_PER_DEGREE
+
+
+def _expand(bbox: BBox, meters: float) -> BBox:
+    d_lat = meters / METERS_PER_DEGREE
+    d_lon = d_lat / max(cos(radians((bbox[0] + bbox[1]) / 2)), 0.01)
+    return bbox[0] - d_lat, bbox[1] + d_lat, bbox[2] - d_lon, bbox[3] + d_lon
+
+
+def _is_inside(point: Coords, rings: list[list[Coords]]) -> bool:
+    '''
+    Even-odd rule over all the rings, so the inner rings cut the holes.
+    '''
+    lat, lon = point
+    inside = False
+
+    for ring in rings:
+        for (lat1, lon1), (lat2, lon2) in zip(ring, ring[1:]):
+            if (lat1 > lat) != (lat2 > lat) and lon < lon1 + (lat - lat1) * (lon2 - lon1) / (lat2 - lat1):
+                inside = not inside
+
+    return inside
+
+
+def _assemble_rings(ways: list[list[int]]) -> list[list[int]]:
+    '''
+    Join the member ways into closed rings, the unclosed leftovers are dropped.
+    '''
+    ways = [w for w in ways if len(w) >= 2]
+    rings = []
+
+    while ways:
+        ring = list(ways.pop())
+
+        while ring[0] != ring[-1]:
+            for i, w in enumerate(ways):
+                if w[0] == ring[-1]:
+                    ring.extend(w[1:])
+                elif w[-1] == ring[-1]:
+                    ring.extend(reversed(w[:-1]))
+                else:
+                    continue
+
+                ways.pop(i)
+                break
+            else:
+                break
+
+        if ring[0] == ring[-1] and len(ring) >= 4:
+            rings.append(ring)
+
+    return rings
+
+
+def _section_item(element_type: ElementType, element_id: int, tags: str) -> dict:
+    return {'type': element_type, 'id': element_id, 'tags': json.loads(tags)}
+
+
+class OfflineStore:
+    '''
+    Local spatial backend for the post_fn queries, built from a regional .osm.pbf extract
+    and kept fresh with the replication diffs. The SQLite store is memory-mapped.
+
+    Nodes and ways are stored in full, relations only as features. Element geometry is approximated
+    by the bounding box (and by its center for is_in), and a moved node only updates the features
+    that were themselves part of the same diff.
+    '''
+
+    def __init__(self, path: Path):
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode = WAL')
+        self._db.execute('PRAGMA mmap_size = 17179869184')  # 16 GiB
+        self._db.executescript(SCHEMA)
+        self._lock = Lock()
+
+    def _get_meta(self, key: str):
+        row = self._db.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row is not None else None
+
+    def _set_meta(self, key: str, value) -> None:
+        self._db.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, value))
+
+    def sync(self, pbf_path: Path) -> None:
+        '''
+        Import the extract if it changed since the last import, then apply the pending diffs.
+        '''
+        with self._lock:
+            if self._get_meta('source_mtime') != pbf_path.stat().st_mtime:
+                self._import_pbf(pbf_path)
+
+            try:
+                self._update()
+            except Exception as e:
+                print(f'⚠️ Offline store update failed, using stale data: {e!r}')
+
+    def _import_pbf(self, path: Path) -> None:
+        print(f'📦 Importing {path} into the offline store…')
+        header, elements = read_pbf(path)
+
+        for table in ('node', 'way', 'feature', *(f'{index}_idx' for index in INDEXES)):
+            self._db.execute(f'DELETE FROM {table}')
+
+        nodes = []
+        ways = []
+
+        for e in elements:
+            if e.type == 'node':
+                nodes.append((e.id, e.lat, e.lon))
+            elif e.type == 'way':
+                ways.append((e.id, array('q', e.nodes).tobytes()))
+
+            # the way and relation geometry is looked up in the already stored elements
+            if nodes and (len(nodes) >= 100_000 or e.type != 'node'):
+                self._db.executemany('INSERT OR REPLACE INTO node (id, lat, lon) VALUES (?, ?, ?)', nodes)
+                nodes.clear()
+
+            if ways and (len(ways) >= 10_000 or e.type == 'relation'):
+                self._db.executemany('INSERT OR REPLACE INTO way (id, nodes) VALUES (?, ?)', ways)
+                ways.clear()
+
+            if e.tags:
+                self._upsert_feature(e)
+
+        self._db.executemany('INSERT OR REPLACE INTO node (id, lat, lon) VALUES (?, ?, ?)', nodes)
+        self._db.executemany('INSERT OR REPLACE INTO way (id, nodes) VALUES (?, ?)', ways)
+
+        self._set_meta('source_mtime', path.stat().st_mtime)
+
+        # extracts without the replication info are never updated
+        if header.replication_url and header.replication_sequence is not None:
+            self._set_meta('replication_url', header.replication_url)
+            self._set_meta('sequence', header.replication_sequence)
+        else:
+            self._db.execute('DELETE FROM meta WHERE key IN (\'replication_url\', \'sequence\')')
+
+        self._db.commit()
+
+    def _node_coords(self, node_ids: Iterable[int]) -> dict[int, Coords]:
+        node_ids = list(set(node_ids))
+        result = {}
+
+        # stay below the SQLite variables limit
+        for i in range(0, len(node_ids), 500):
+            chunk = node_ids[i:i + 500]
+            result.update(
+                (node_id, (lat, lon)) for node_id, lat, lon in self._db.execute(
+                    f'SELECT id, lat, lon FROM node WHERE id IN ({",".join("?" * len(chunk))})', chunk))
+
+        return result
+
+    def _way_nodes(self, way_id: int) -> list[int]:
+        row = self._db.execute('SELECT nodes FROM way WHERE id = ?', (way_id,)).fetchone()
+
+        if row is None:
+            return []
+
+        nodes = array('q')
+        nodes.frombytes(row[0])
+        return nodes.tolist()
+
+    def _geometry(self, e: PbfElement) -> tuple[list[Coords], list[list[Coords]] | None]:
+        '''
+        Returns the element points and its area rings, if it is an area.
+        '''
+        if e.type == 'node':
+            return [(e.lat, e.lon)], None
+
+        if e.type == 'way':
+            coords = self._node_coords(e.nodes)
+            points = [coords[n] for n in e.nodes if n in coords]
+            is_closed = len(e.nodes) >= 4 and e.nodes[0] == e.nodes[-1] and e.tags.get('area') != 'no'
+            return points, [points] if is_closed and len(points) == len(e.nodes) else None
+
+        member_ways = [self._way_nodes(ref) for t, ref, _ in e.members if t == 'way']
+        member_nodes = [ref for t, ref, _ in e.members if t == 'node']
+        coords = self._node_coords([n for w in member_ways for n in w] + member_nodes)
+        points = list(coords.values())
+
+        if e.tags.get('type') not in ('multipolygon', 'boundary'):
+            return points, None
+
+        rings = [[coords[n] for n in ring if n in coords] for ring in _assemble_rings(member_ways)]
+        return points, rings or None
+
+    def _upsert_feature(self, e: PbfElement) -> None:
+        row = self._db.execute('SELECT fid FROM feature WHERE type = ? AND id = ?', (e.type, e.id)).fetchone()
+
+        if row is not None:
+            for index in INDEXES:
+                self._db.execute(f'DELETE FROM {index}_idx WHERE id = ?', row)
+
+        # skip the geometry lookups for the irrelevant elements, even if they were areas
+        if not e.tags or not _indexes(e.type, e.tags, rings=[[]]):
+            self._delete_feature(e.type, e.id)
+            return
+
+        points, rings = self._geometry(e)
+        indexes = _indexes(e.type, e.tags, rings)
+
+        if not points or not indexes:
+            self._delete_feature(e.type, e.id)
+            return
+
+        fid, = self._db.execute(
+            'INSERT INTO feature (type, id, tags, rings) VALUES (?, ?, ?, ?) '
+            'ON CONFLICT (type, id) DO UPDATE SET tags = excluded.tags, rings = excluded.rings '
+            'RETURNING fid',
+            (e.type, e.id, json.dumps(e.tags, ensure_ascii=False, separators=(',', ':')),
+             json.dumps(rings, separators=(',', ':')) if 'area' in indexes else None)).fetchone()
+
+        bbox = _bbox(points)
+
+        for index in indexes:
+            self._db.execute(
+                f'INSERT INTO {index}_idx (id, min_lat, max_lat, min_lon, max_lon) VALUES (?, ?, ?, ?, ?)',
+                (fid, *bbox))
+
+    def _delete_feature(self, element_type: ElementType, element_id: int) -> None:
+        row = self._db.execute(
+            'DELETE FROM feature WHERE type = ? AND id = ? RETURNING fid', (element_type, element_id)).fetchone()
+
+        if row is not None:
+            for index in INDEXES:
+                self._db.execute(f'DELETE FROM {index}_idx WHERE id = ?', row)
+
+    def _update(self) -> None:
+        url = self._get_meta('replication_url')
+        sequence = self._get_meta('sequence')
+
+        if not url or sequence is None:
+            return
+
+        c = get_http_client()
+        r = c.get(f'{url}/state.txt')
+        r.raise_for_status()
+        latest = int(SEQUENCE_RE.search(r.text).group(1))
+
+        if latest <= sequence:
+            return
+
+        for sequence in range(sequence + 1, latest + 1):
+            path = f'{sequence:09d}'
+            r = c.get(f'{url}/{path[0:3]}/{path[3:6]}/{path[6:9]}.osc.gz')
+            r.raise_for_status()
+
+            self._apply_diff(gzip.decompress(r.content))
+            self._set_meta('sequence', sequence)
+            self._db.commit()
+
+        print(f'🗺️ Offline store updated to sequence {latest}')
+
+    def _apply_diff(self, data: bytes) -> None:
+        import xmltodict
+
+        doc = xmltodict.parse(data, force_list=('create', 'modify', 'delete', 'node', 'way', 'relation',
+                                                'tag', 'nd', 'member'))
+
+        # only the latest version of each element matters
+        latest: dict[tuple[ElementType, int], tuple[int, str, dict]] = {}
+
+        for action in ('create', 'modify', 'delete'):
+            for block in doc['osmChange'].get(action, []):
+                for element_type in ('node', 'way', 'relation'):
+                    for d in (block or {}).get(element_type, []):
+                        key = (element_type, int(d['@id']))
+                        version = int(d.get('@version', 0))
+
+                        if key not in latest or latest[key][0] <= version:
+                            latest[key] = (version, action, d)
+
+        # nodes first, the way geometry depends on them
+        for (element_type, element_id), (_, action, d) in sorted(
+                latest.items(), key=lambda t: ('node', 'way', 'relation').index(t[0][0])):
+            if action == 'delete':
+                if element_type != 'relation':
+                    self._db.execute(f'DELETE FROM {element_type} WHERE id = ?', (element_id,))
+
+                self._delete_feature(element_type, element_id)
+                continue
+
+            e = PbfElement(
+                type=element_type,
+                id=element_id,
+                tags={t['@k']: t['@v'] for t in d.get('tag', [])},
+                lat=float(d.get('@lat', 0)),
+                lon=float(d.get('@lon', 0)),
+                nodes=tuple(int(nd['@ref']) for nd in d.get('nd', [])),
+                members=tuple((m['@type'], int(m['@ref']), m.get('@role', '')) for m in d.get('member', [])),
+            )
+
+            if element_type == 'node':
+                self._db.execute('INSERT OR REPLACE INTO node (id, lat, lon) VALUES (?, ?, ?)', (e.id, e.lat, e.lon))
+            elif element_type == 'way':
+                self._db.execute('INSERT OR REPLACE INTO way (id, nodes) VALUES (?, ?)',
+                                 (e.id, array('q', e.nodes).tobytes()))
+
+            self._upsert_feature(e)
+
+    def _around(self, index: str, bbox: BBox, meters: float) -> list[tuple[ElementType, int, str, str | None]]:
+        min_lat, max_lat, min_lon, max_lon = _expand(bbox, meters)
+
+        rows = self._db.execute(
+            f'SELECT f.type, f.id, f.tags, f.rings, i.min_lat, i.max_lat, i.min_lon, i.max_lon '
+            f'FROM {index}_idx i JOIN feature f ON f.fid = i.id '
+            f'WHERE i.max_lat >= ? AND i.min_lat <= ? AND i.max_lon >= ? AND i.min_lon <= ?',
+            (min_lat, max_lat, min_lon, max_lon)).fetchall()
+
+        return [row[:4] for row in rows if _bbox_distance(bbox, row[4:]) <= meters]
+
+    def _is_in(self, point: Coords) -> list[tuple[ElementType, int, str]]:
+        lat, lon = point
+
+        return [
+            (element_type, element_id, tags)
+            for element_type, element_id, tags, rings in self._around('area', (lat, lat, lon, lon), 0)
+            if _is_inside(point, json.loads(rings))
+        ]
+
+    def _section(self, name: str, issue: OverpassEntry, tier: int | None) -> list[dict]:
+        bbox = (issue.bb_min.lat, issue.bb_max.lat, issue.bb_min.lon, issue.bb_max.lon)
+        center = ((bbox[0] + bbox[1]) / 2, (bbox[2] + bbox[3]) / 2)
+
+        if name == 'duplicates':
+            types = ('way', 'relation') if issue.element_type == 'node' else ('node',)
+            return [_section_item(t, i, tags) for t, i, tags, _ in self._around('housenumber', bbox, DUPLICATE_SEARCH_RADIUS)
+                    if t in types]
+
+        if name == 'place_not_in_area':
+            place = issue.tags['addr:place']
+            result = [_section_item(t, i, tags) for t, i, tags in self._is_in(center)
+                      if json.loads(tags)['name'] == place]
+
+            # the nearby places are looked up in the gazetteer instead
+            if GAZETTEER_PATH is None:
+                result.extend(_section_item(t, i, tags)
+                              for t, i, tags, _ in self._around('place', bbox, PLACE_SEARCH_RADIUS)
+                              if json.loads(tags)['name'] == place)
+
+            return result
+
+        if name == 'place_mistype':
+            return [_section_item(t, i, tags) for t, i, tags in self._is_in(center)]
+
+        if name == 'street_names':
+            return [_section_item(t, i, tags) for t, i, tags, _ in self._around('street', bbox, tier)]
+
+        assert False, f'Unsupported offline query {name!r}'
+
+    def query_fused(self, elements: list[tuple[list[OverpassEntry], list[int]]],
+                    tasks: dict[int, tuple[str, int | None]]) -> list[tuple[tuple[int, tuple], list[dict]]]:
+        with self._lock:
+            return [((t, tuple(i.uid for i in members)), self._group_section(tasks[t][0], members, tasks[t][1]))
+                    for members, task_indexes in elements
+                    for t in task_indexes]
+
+    def _group_section(self, name: str, members: list[OverpassEntry], tier: int | None) -> list[dict]:
+        if len(members) == 1:
+            return self._section(name, members[0], tier)
+
+        # the union of the member sections, like the around filter of a multi-element set
+        return list({(e['type'], e['id']): e for i in members for e in self._section(name, i, tier)}.values())
+
+    def places(self) -> list[tuple[str, float, float]]:
+        with self._lock:
+            return [
+                (json.loads(tags)['name'], (min_lat + max_lat) / 2, (min_lon + max_lon) / 2)
+                for tags, min_lat, max_lat, min_lon, max_lon in self._db.execute(
+                    'SELECT f.tags, i.min_lat, i.max_lat, i.min_lon, i.max_lon '
+                    'FROM place_idx i JOIN feature f ON f.fid = i.id')
+            ]
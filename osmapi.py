@@ -1,11 +1,28 @@
-from functools import cache
-
-from tenacity import retry, stop_after_attempt, wait_exponential
+from functools import cache, wraps
 
 from config import OSM_TOKEN
 from utils import get_http_client
 
 
+def retry(func):
+    '''
+    Retry with an exponential backoff, tenacity is only imported on the first call.
+    '''
+    retrying = None
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        nonlocal retrying
+
+        if retrying is None:
+            from tenacity import retry, stop_after_attempt, wait_exponential
+            retrying = retry(stop=stop_after_attempt(5), wait=wait_exponential())(func)
+
+        return retrying(*args, **kwargs)
+
+    return wrapper
+
+
 class OsmApi:
     def __init__(self):
         self.base_url = 'https://api.openstreetmap.org/api/0.6'
@@ -19,8 +36,11 @@ class OsmApi:
         return r.json()['user']
 
     @cache
-    @retry(stop=stop_after_attempt(5), wait=wait_exponential())
     def get_changeset(self, changeset_id: int) -> dict:
+        return self.fetch_changeset(changeset_id)
+
+    @retry
+    def fetch_changeset(self, changeset_id: int) -> dict:
         r = self.c.get(f'{self.base_url}/changeset/{changeset_id}.json?include_discussion=true')
         r.raise_for_status()
         data = r.json()
@@ -33,7 +53,7 @@ class OsmApi:
             return data['elements'][0]
 
     @cache
-    @retry(stop=stop_after_attempt(5), wait=wait_exponential())
+    @retry
     def get_user(self, user_id: int) -> dict | None:
         r = self.c.get(f'{self.base_url}/user/{user_id}.json')
 
@@ -44,7 +64,7 @@ class OsmApi:
 
         return r.json()['user']
 
-    @retry(stop=stop_after_attempt(5), wait=wait_exponential())
+    # not retried here, the outbox retries after checking that the comment was not posted already
     def post_comment(self, changeset_id: int, message: str) -> None:
         r = self.c.post(f'{self.base_url}/changeset/{changeset_id}/comment', data={
             'text': message
@@ -0,0 +1,118 @@
+import sqlite3
+from dataclasses import dataclass
+from time import time
+
+from aliases import Identifier
+from config import DRY_RUN, OUTBOX_LEASE, OUTBOX_MAX_ATTEMPTS, OUTBOX_PATH
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS message (
+    id INTEGER PRIMARY KEY,
+    category TEXT NOT NULL,
+    changeset_id INTEGER NOT NULL,
+    text TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    not_before INTEGER NOT NULL DEFAULT 0,
+    lease_until INTEGER NOT NULL DEFAULT 0,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    finished_at INTEGER,
+    UNIQUE (category, changeset_id)
+);
+
+CREATE INDEX IF NOT EXISTS message_pending_idx ON message (status, not_before);
+'''
+
+
+@dataclass(frozen=True, kw_only=True, slots=True)
+class Message:
+    id: int
+    category: Identifier
+    changeset_id: int
+    text: str
+    attempts: int
+
+
+class Outbox:
+    '''
+    Composed comments waiting for delivery, at most one per category and changeset.
+    Messages are leased for OUTBOX_LEASE seconds while being sent, an expired lease makes the message available again.
+    In a dry run, nothing is ever written.
+    '''
+    _db: sqlite3.Connection
+
+    def __enter__(self):
+        # dry runs never touch outbox.db
+        if DRY_RUN:
+            self._db = sqlite3.connect(':memory:', isolation_level=None)
+        else:
+            self._db = sqlite3.connect(OUTBOX_PATH, timeout=60, isolation_level=None)
+            self._db.execute('PRAGMA journal_mode = WAL')
+
+        self._db.executescript(SCHEMA)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._db.close()
+
+    def put(self, cat: Identifier, changeset_id: int, text: str) -> bool:
+        if DRY_RUN:
+            return True
+
+        # the same changeset analysed again (e.g. after a crash) is ignored
+        cursor = self._db.execute(
+            'INSERT OR IGNORE INTO message (category, changeset_id, text) VALUES (?, ?, ?)',
+            (cat, changeset_id, text))
+
+        return cursor.rowcount > 0
+
+    def lease(self) -> Message | None:
+        if DRY_RUN:
+            return None
+
+        now = int(time())
+        self._db.execute('BEGIN IMMEDIATE')
+
+        try:
+            while True:
+                row = self._db.execute(
+                    'SELECT id, category, changeset_id, text, attempts FROM message '
+                    'WHERE status = \'pending\' AND not_before <= ? AND lease_until <= ? '
+                    'ORDER BY not_before, id LIMIT 1', (now, now)).fetchone()
+
+                if row is None:
+                    return None
+
+                message_id, cat, changeset_id, text, attempts = row
+
+                if attempts < OUTBOX_MAX_ATTEMPTS:
+                    break
+
+                print(f'💀 Gave up on commenting {changeset_id}: {cat}')
+                self._db.execute(
+                    'UPDATE message SET status = \'failed\', finished_at = ? WHERE id = ?', (now, message_id))
+
+            self._db.execute(
+                'UPDATE message SET lease_until = ?, attempts = attempts + 1 WHERE id = ?',
+                (now + OUTBOX_LEASE, message_id))
+        finally:
+            self._db.execute('COMMIT')
+
+        return Message(id=message_id, category=cat, changeset_id=changeset_id, text=text, attempts=attempts + 1)
+
+    def sent(self, message: Message) -> None:
+        self._db.execute(
+            'UPDATE message SET status = \'sent\', finished_at = ?, lease_until = 0 WHERE id = ?',
+            (int(time()), message.id))
+
+    def retry(self, message: Message) -> None:
+        # exponential backoff, starting at a minute
+        self._db.execute(
+            'UPDATE message SET not_before = ?, lease_until = 0 WHERE id = ?',
+            (int(time()) + 60 * 2 ** (message.attempts - 1), message.id))
+
+    def purge(self, max_age: int) -> None:
+        if DRY_RUN:
+            return
+
+        self._db.execute(
+            'DELETE FROM message WHERE status != \'pending\' AND finished_at < ?', (int(time()) - max_age,))
@@ -1,30 +1,57 @@
+import json
+import re
+import time
 from collections import defaultdict
-from typing import Iterable
-
-from geopy.distance import distance
-
-from aliases import ElementType, Tags
+from concurrent.futures import ThreadPoolExecutor, wait
+from dataclasses import dataclass, replace
+from fnmatch import fnmatch
+from math import cos, floor, hypot, radians
+from threading import Lock
+from typing import Callable
+
+from aliases import ElementType, Selectors, Tags
 from category import Category
 from check import Check
-from config import (LARGE_ELEMENT_MAX_SIZE, OVERPASS_API_INTERPRETER,
-                    SEARCH_BBOX, SEARCH_RELATION)
-from duplicate_search import check_whitelist, duplicate_search
+from check_base import CheckBase, group_selectors
+from checks import OVERPASS_CATEGORIES
+from config import (CATCHUP, CATCHUP_MAX_WINDOW, CATCHUP_MIN_WINDOW, CATCHUP_TARGET_ELEMENTS, CATCHUP_WORKERS,
+                    DRY_RUN, DUPLICATE_SEARCH_RADIUS, GAZETTEER_BBOX, GAZETTEER_MAX_AGE, GAZETTEER_PATH,
+                    LARGE_ELEMENT_MAX_SIZE, OFFLINE_PATH, OFFLINE_PBF, OVERPASS_ADIFF,
+                    OVERPASS_API_INTERPRETERS, OVERPASS_BUSY_BACKOFF, OVERPASS_BUSY_RETRIES,
+                    OVERPASS_CACHE_DIR, OVERPASS_CACHE_MAX_SIZE, OVERPASS_TILES, OVERPASS_TILE_RETRIES,
+                    OVERPASS_TILE_WORKERS, PLACE_SEARCH_RADIUS, PROFILE_DIR, SEARCH_BBOX,
+                    STREET_NAMES_GROUP_CELL)
+from duplicate_search import METERS_PER_DEGREE, AddressIndex, bbox_distance, check_whitelist, duplicate_search_many
+from gazetteer import Gazetteer
+from offline import OfflineStore
+from overpass_cache import OverpassCache
+from overpass_endpoints import Endpoint, EndpointPool
 from overpass_entry import OverpassEntry, Point, Size
-from state import State
+from parallel import get_executor, map_sharded
+from profiling import profiled, record_metric
+from region import Region
+from state import Cursor
 from utils import (escape_overpass, format_timestamp, get_http_client,
-                   normalize, parse_timestamp)
+                   hilbert_index, is_overdue, normalize, parse_timestamp)
 
 
-def batch(size: int = 1000):
+def batch(size: int = 1000, key: Callable | None = None):
+    '''
+    Split the task list into batches of `size`, sorted by `key` first if given.
+    Past the `deadline` keyword argument, the remaining batches are skipped and missing from the result.
+    '''
     def decorator(func):
-        def wrapper(*args, **kwargs) -> list:
+        def wrapper(*args, deadline: float | None = None, **kwargs) -> list:
             assert len(args) >= 2 and isinstance(args[0], Overpass) and isinstance(args[1], list)
 
             self = args[0]
-            task = args[1]
+            task = args[1] if key is None else sorted(args[1], key=key)
             result = []
 
             for subtask in (task[i:i + size] for i in range(0, len(task), size)):
+                if is_overdue(deadline):
+                    break
+
                 subtask_result = func(self, subtask, *args[2:], **kwargs)
                 assert isinstance(subtask_result, list)
                 result.extend(subtask_result)
@@ -34,59 +61,202 @@ def batch(size: int = 1000):
     return decorator
 
 
-def tier(*tiers: Iterable[int]):
-    def decorator(func):
-        def wrapper(*args, **kwargs) -> list:
-            assert len(args) >= 2 and isinstance(args[0], Overpass) and isinstance(args[1], list)
+def status_code(e: Exception) -> int | None:
+    # of the failed HTTP response, if any
+    response = getattr(e, 'response', None)
+    return response.status_code if response is not None else None
 
-            self = args[0]
-            task = args[1]
 
-            for tier in tiers:
-                if not task:
-                    break
+def get_bbox(e: dict = SEARCH_BBOX) -> str:
+    min_lat, max_lat = e['min_lat'], e['max_lat']
+    min_lon, max_lon = e['min_lon'], e['max_lon']
+    return f'[bbox:{min_lat},{min_lon},{max_lat},{max_lon}]'
 
-                task = func(self, task, *args[2:], **kwargs, tier=tier)
-                assert isinstance(task, list)
 
-            return task
+def split_bbox(e: dict, rows: int, cols: int) -> list[dict]:
+    lat_step = (e['max_lat'] - e['min_lat']) / rows
+    lon_step = (e['max_lon'] - e['min_lon']) / cols
 
-        return wrapper
-    return decorator
+    return [{
+        'min_lat': e['min_lat'] + lat_step * row,
+        'min_lon': e['min_lon'] + lon_step * col,
+        'max_lat': e['min_lat'] + lat_step * (row + 1),
+        'max_lon': e['min_lon'] + lon_step * (col + 1),
+    } for row in range(rows) for col in range(cols)]
 
 
-def skip_large(max_size: int = LARGE_ELEMENT_MAX_SIZE):
-    def decorator(func):
-        def wrapper(*args, **kwargs) -> list:
-            assert len(args) >= 2 and isinstance(args[0], Overpass) and isinstance(args[1], list)
+def _selector_alternatives(c: CheckBase) -> list[tuple[Selectors, Selectors]]:
+    static_selectors, dynamic_selectors = group_selectors(c.selectors)
 
-            self = args[0]
-            task = args[1]
+    if c.partial_selectors:
+        return [((s,), ()) for s in static_selectors] + [((), (s,)) for s in dynamic_selectors]
 
-            task = [e for e in task if e.bb_size[0] < max_size and e.bb_size[1] < max_size]
+    return [(static_selectors, dynamic_selectors)]
 
-            return func(self, task, *args[2:], **kwargs)
-        return wrapper
-    return decorator
 
+def _build_filter(static_selectors: Selectors, dynamic_selectors: Selectors) -> str:
+    result = ''.join(f'["{escape_overpass(s)}"]' for s in dict.fromkeys(static_selectors))
 
-def get_bbox() -> str:
-    e = SEARCH_BBOX
-    min_lat, max_lat = e['min_lat'], e['max_lat']
-    min_lon, max_lon = e['min_lon'], e['max_lon']
-    return f'[bbox:{min_lat},{min_lon},{max_lat},{max_lon}]'
+    for s in dict.fromkeys(dynamic_selectors):
+        # implied by a static selector
+        if any(fnmatch(k, s) for k in static_selectors):
+            continue
+
+        pattern = '^' + '.*'.join(re.escape(p) for p in s.split('*')) + '$'
+        result += f'[~"{escape_overpass(pattern)}"~"."]'
+
+    return result
+
+
+def compile_selectors(region: Region) -> tuple[list[str], list[str]]:
+    '''
+    Compile the category and check selectors into Overpass tag filters, one per alternative.
+    Returns the filters of the elements needing the bounding box (for post_fn), and of the others.
+    '''
+    bbox_filters = {}
+    filters = {}
+
+    for cat in OVERPASS_CATEGORIES:
+        if not region.has_category(cat.identifier):
+            continue
+
+        cat_alternatives = _selector_alternatives(cat) if cat.selectors else [((), ())]
+
+        for check in cat.checks:
+            # checks without selectors never match
+            if not check.selectors:
+                continue
 
+            for cat_static, cat_dynamic in cat_alternatives:
+                for check_static, check_dynamic in _selector_alternatives(check):
+                    f = _build_filter(cat_static + check_static, cat_dynamic + check_dynamic)
+                    (bbox_filters if check.has_post else filters)[f] = None
 
-def build_query(start_ts: int, end_ts: int, timeout: int) -> str:
+    return list(bbox_filters), [f for f in filters if f not in bbox_filters]
+
+
+def build_query(start_ts: int, end_ts: int, timeout: int, relation: int, bbox: dict,
+                filters: tuple[list[str], list[str]], *, adiff: bool = False) -> str:
     assert start_ts < end_ts
     start = format_timestamp(start_ts)
     end = format_timestamp(end_ts)
+    bbox_filters, meta_filters = filters
+
+    # only the candidate elements are returned, with the bounding box where needed
+    bbox_selector = ''.join(f'nwr.c{f};' for f in bbox_filters)
+    meta_selector = ''.join(f'nwr.c{f};' for f in meta_filters)
+
+    # augmented diffs are only available as XML
+    settings = f'[adiff:"{start}","{end}"]' if adiff else '[out:json]'
 
-    return f'[out:json][timeout:{timeout}]{get_bbox()};' \
-           f'relation(id:{SEARCH_RELATION});' \
+    return f'{settings}[timeout:{timeout}]{get_bbox(bbox)};' \
+           f'relation(id:{relation});' \
            f'map_to_area;' \
-           f'nwr(changed:"{start}","{end}")(area);' \
-           f'out meta bb;'
+           f'nwr(changed:"{start}","{end}")(area)->.c;' \
+           f'({bbox_selector})->.b;' \
+           f'(({meta_selector}); - .b;)->.m;' \
+           f'.b out meta bb;' \
+           f'.m out meta;'
+
+
+def _adiff_element(d: dict | None) -> dict | None:
+    '''
+    Convert an augmented diff element into the Overpass JSON format.
+    '''
+    if not d:
+        return None
+
+    for element_type in ('node', 'way', 'relation'):
+        if element_type in d:
+            d = d[element_type][0]
+            break
+    else:
+        return None
+
+    e = {
+        'type': element_type,
+        'id': int(d['@id']),
+        'timestamp': d.get('@timestamp'),
+        'version': int(d.get('@version', 0)),
+        'changeset': int(d.get('@changeset', 0)),
+    }
+
+    if '@lat' in d:
+        e['lat'] = float(d['@lat'])
+        e['lon'] = float(d['@lon'])
+
+    if 'bounds' in d:
+        e['bounds'] = {k[1:]: float(v) for k, v in d['bounds'].items()}
+
+    if 'nd' in d:
+        e['nodes'] = [int(nd['@ref']) for nd in d['nd']]
+
+    if 'tag' in d:
+        e['tags'] = {t['@k']: t['@v'] for t in d['tag']}
+
+    return e
+
+
+def parse_adiff(data: bytes) -> dict:
+    '''
+    Parse an augmented diff into the (old, new) element version pairs of the created and modified elements.
+    The old version is None if it is not part of the diff.
+    '''
+    import xmltodict
+
+    doc = xmltodict.parse(data, force_list=('action', 'node', 'way', 'relation', 'nd', 'tag'))
+    root = doc.get('osm') or {}
+    actions = []
+
+    for action in root.get('action', []):
+        # deleted, or no longer matching the query
+        if action['@type'] == 'delete':
+            continue
+
+        if action['@type'] == 'create':
+            old, new = None, _adiff_element(action)
+        else:
+            old, new = _adiff_element(action.get('old')), _adiff_element(action.get('new'))
+
+        if new is not None:
+            actions.append((old, new))
+
+    return {'actions': actions}
+
+
+def decode_bounds(bounds: list[tuple[str, float, float, float, float]]) -> list[tuple[int, Point, Point, Size]]:
+    '''
+    Parse the timestamps and measure the bounding boxes, the CPU-heavy part of decoding the elements.
+    '''
+    from geopy.distance import distance
+
+    result = []
+
+    for timestamp, min_lat, min_lon, max_lat, max_lon in bounds:
+        bb_min = Point(min_lat, min_lon)
+        bb_max = Point(max_lat, max_lon)
+        bb_size = Size(
+            width=distance(bb_min, Point(bb_min.lat, bb_max.lon)).meters,
+            height=distance(bb_min, Point(bb_max.lat, bb_min.lon)).meters
+        )
+
+        result.append((parse_timestamp(timestamp), bb_min, bb_max, bb_size))
+
+    return result
+
+
+def split_windows(start_ts: int, end_ts: int, density: float | None) -> list[tuple[int, int]]:
+    '''
+    Split the time range into windows of about CATCHUP_TARGET_ELEMENTS elements each,
+    based on the element density (per second) seen in the previous runs.
+    '''
+    if density:
+        size = int(CATCHUP_TARGET_ELEMENTS / density)
+        size = min(max(size, CATCHUP_MIN_WINDOW), CATCHUP_MAX_WINDOW)
+    else:
+        size = CATCHUP_MAX_WINDOW
+
+    return [(t, min(t + size, end_ts)) for t in range(start_ts, end_ts, size)]
 
 
 def build_partition_query(timestamp: int, issues: list[OverpassEntry], timeout: int) -> str:
@@ -98,94 +268,559 @@ def build_partition_query(timestamp: int, issues: list[OverpassEntry], timeout:
            f'out meta;'
 
 
-def build_duplicates_query(issues: list[OverpassEntry], timeout: int) -> str:
-    body = ''.join(
-        f'{i.element_type}(id:{i.element_id});' +
-        (f'wr["addr:housenumber"](around:100);' if i.element_type == 'node' else 'node["addr:housenumber"](around:100);') +
-        f'out body;'
-        f'out count;'
-        for i in issues)
+def _duplicates_statements(i: OverpassEntry, n: int, tier: int | None) -> str:
+    return ('wr' if i.element_type == 'node' else 'node') + f'["addr:housenumber"](around.e{n}:{DUPLICATE_SEARCH_RADIUS});' \
+           f'out body;'
 
-    return f'[out:json][timeout:{timeout}]{get_bbox()};{body}'
 
+def _place_not_in_area_statements(i: OverpassEntry, n: int, tier: int | None) -> str:
+    place = escape_overpass(i.tags['addr:place'])
 
-def build_place_not_in_area_query(issues: list[OverpassEntry], timeout: int) -> str:
-    body = ''.join(
-        f'{i.element_type}(id:{i.element_id});'
-        f'._->.a;' +
-        ('' if i.element_type == 'node' else f'node({i.element_type[0]});') +
-        f'is_in->.i;'
-        f'('
-        f'area.i[!admin_level][name="{escape_overpass(i.tags["addr:place"])}"];'
-        f'wr.i[!admin_level][name="{escape_overpass(i.tags["addr:place"])}"];'
-        f'nwr[place][name="{escape_overpass(i.tags["addr:place"])}"](around.a:10000);'
-        f');'
-        f'out tags;'
-        f'out count;'
-        for i in issues)
+    # the nearby places are looked up locally instead
+    around = f'nwr[place][name="{place}"](around.e{n}:{PLACE_SEARCH_RADIUS});' if GAZETTEER_PATH is None else ''
 
-    return f'[out:json][timeout:{timeout}]{get_bbox()};{body}'
+    return f'(' \
+           f'area.i{n}[!admin_level][name="{place}"];' \
+           f'wr.i{n}[!admin_level][name="{place}"];' + \
+           around + \
+           f');' \
+           f'out tags;'
 
 
-def build_place_mistype_query(issues: list[OverpassEntry], timeout: int) -> str:
-    body = ''.join(
-        f'{i.element_type}(id:{i.element_id});' +
-        ('' if i.element_type == 'node' else f'node({i.element_type[0]});') +
-        f'is_in;'
-        f'wr._[!admin_level][name];'
-        f'out tags;'
-        f'out count;'
-        for i in issues)
+def _place_mistype_statements(i: OverpassEntry, n: int, tier: int | None) -> str:
+    return f'wr.i{n}[!admin_level][name];' \
+           f'out tags;'
 
-    return f'[out:json][timeout:{timeout}]{get_bbox()};{body}'
 
+def _street_names_statements(i: OverpassEntry, n: int, tier: int | None) -> str:
+    return f'wr[highway][name](around.e{n}:{tier});' \
+           f'out tags;'
 
-def build_street_names_query(issues: list[OverpassEntry], timeout: int, around: int) -> str:
-    body = ''.join(
-        f'{i.element_type}(id:{i.element_id});'
-        f'wr[highway][name](around:{around});'
-        f'out tags;'
-        f'out count;'
-        for i in issues)
 
-    return f'[out:json][timeout:{timeout}]{get_bbox()};{body}'
+def _street_names_group(i: OverpassEntry) -> tuple:
+    lat = (i.bb_min.lat + i.bb_max.lat) / 2
+    lon = (i.bb_min.lon + i.bb_max.lon) / 2
+    return i.tags['addr:street'], floor(lat / STREET_NAMES_GROUP_CELL), floor(lon / STREET_NAMES_GROUP_CELL)
 
 
-class Overpass:
-    def __init__(self, state: State):
-        self.state = state
+def _parse_names(section: list[dict]) -> set[str]:
+    names = set()
+
+    for e in section:
+        for key in ('name', 'alt_name'):
+            if val := e['tags'].get(key, None):
+                names.add(val)
+
+    return names
+
+
+def _local_duplicates(overpass: 'Overpass', issues: list[OverpassEntry]) -> tuple[list[OverpassEntry], list[OverpassEntry]]:
+    '''
+    Resolve the issues duplicated by the elements changed in this run, without the query.
+    Narrower than the query: only the duplicates changed in this run are listed,
+    and only the ones the query would surely find, whole within the radius of the issue.
+    '''
+    result = {}
+    duplicates = []
+    remaining = []
+
+    for issue in issues:
+        issue_duplicates = [
+            e for e in overpass.changed_index.search(issue, DUPLICATE_SEARCH_RADIUS)
+            if (e.element_type == 'node') != (issue.element_type == 'node')
+            # the query measures from the geometry, a bounding box may be far larger
+            and bbox_distance(issue, e) + hypot(*issue.bb_size) + hypot(*e.bb_size) <= DUPLICATE_SEARCH_RADIUS
+        ]
+
+        if issue_duplicates:
+            result[issue] = None
+            duplicates.extend((issue, e) for e in issue_duplicates)
+        else:
+            remaining.append(issue)
+
+    # the duplicates changed in the same window are often issues themselves, keep their own changeset then
+    for issue, e in duplicates:
+        if e not in result:
+            # treat as the same changeset, like the remote duplicates
+            result[replace(e, timestamp=issue.timestamp, changeset_id=issue.changeset_id)] = None
+
+    return list(result), remaining
+
+
+def _parse_duplicates(overpass: 'Overpass', sections: list[tuple[OverpassEntry, list[dict]]]) -> list[OverpassEntry]:
+    result = set(i for i, _ in sections)
+    pairs = [(issue, [
+        OverpassEntry(
+            # treat as the same changeset for simpler code
+            timestamp=issue.timestamp,
+            changeset_id=issue.changeset_id,
+            element_type=e['type'],
+            element_id=e['id'],
+            tags=e['tags'],
+            nodes=e.get('nodes', []),
+            bb_min=Point(0, 0),
+            bb_max=Point(0, 0),
+            bb_size=(0, 0),
+        ) for e in section
+    ]) for issue, section in sections]
+
+    if executor := get_executor(sum(len(ref) for _, ref in pairs)):
+        duplicates = map_sharded(executor, duplicate_search_many, pairs, [i.changeset_id for i, _ in pairs])
+    else:
+        duplicates = duplicate_search_many(pairs)
+
+    for (issue, _), ref_duplicates in zip(pairs, duplicates):
+        if ref_duplicates:
+            result.update(ref_duplicates)
+        else:
+            result.discard(issue)
+
+    return list(result)
+
+
+def _parse_place_not_in_area(overpass: 'Overpass', sections: list[tuple[OverpassEntry, list[dict]]]) -> list[OverpassEntry]:
+    if GAZETTEER_PATH is None:
+        return [issue for issue, section in sections if not section]
+
+    gazetteer = overpass.get_gazetteer()
+    result = []
+
+    for issue, section in sections:
+        if section:
+            continue
+
+        # measured from the bounding box center, so extend the radius to cover the whole element
+        center = Point((issue.bb_min.lat + issue.bb_max.lat) / 2, (issue.bb_min.lon + issue.bb_max.lon) / 2)
+        radius = PLACE_SEARCH_RADIUS + hypot(*issue.bb_size) / 2
+
+        if not gazetteer.has_place_near(issue.tags['addr:place'], center, radius):
+            result.append(issue)
+
+    return result
+
+
+def _parse_place_mistype(overpass: 'Overpass', sections: list[tuple[OverpassEntry, list[dict]]]) -> list[OverpassEntry]:
+    result = []
+
+    for issue, section in sections:
+        is_in = _parse_names(section)
+
+        if issue.tags['addr:place'] not in is_in:
+            addr_place_norm = normalize(issue.tags['addr:place'])
+
+            if any(addr_place_norm == normalize(i) for i in is_in):
+                result.append(issue)
+
+    return result
+
+
+def _parse_street_names(overpass: 'Overpass', sections: list[tuple[OverpassEntry, list[dict]]]) -> list[OverpassEntry]:
+    return [issue for issue, section in sections if issue.tags['addr:street'] not in _parse_names(section)]
+
+
+def is_small(i: OverpassEntry, max_size: int = LARGE_ELEMENT_MAX_SIZE) -> bool:
+    return i.bb_size[0] < max_size and i.bb_size[1] < max_size
+
+
+@dataclass(frozen=True, kw_only=True, slots=True)
+class PostQuery:
+    '''
+    The per-element part of a post_fn query, fused with the others into a single request per batch.
+    '''
+    # the element is available as the .e<n> set, and its containing areas as the .i<n> set if `is_in`
+    statements: Callable[[OverpassEntry, int, int | None], str]
+    parse: Callable[['Overpass', list[tuple[OverpassEntry, list[dict]]]], list[OverpassEntry]]
+    accepts: Callable[[OverpassEntry], bool] = lambda _: True
+    is_in: bool = False
+
+    # resolves the issues it can from the already downloaded elements,
+    # returns the result so far and the issues left for the query
+    local: Callable[['Overpass', list[OverpassEntry]], tuple[list[OverpassEntry], list[OverpassEntry]]] | None = None
+
+    # the issues with an equal key are selected together as one .e<n> set and share the section
+    group: Callable[[OverpassEntry], tuple] | None = None
+
+    def __post_init__(self):
+        assert not (self.group and self.is_in), 'Grouped post queries cannot use is_in'
+
+    def group_issues(self, issues: list[OverpassEntry]) -> list[list[OverpassEntry]]:
+        issues = dict.fromkeys(issues)
+
+        if self.group is None:
+            return [[i] for i in issues]
+
+        groups = defaultdict(list)
+
+        for i in issues:
+            groups[self.group(i)].append(i)
+
+        return list(groups.values())
+
+    # the issues left after a tier are queried again with the next one
+    tiers: tuple[int | None, ...] = (None,)
+
+
+POST_QUERIES: dict[str, PostQuery] = {
+    'duplicates': PostQuery(
+        statements=_duplicates_statements,
+        parse=_parse_duplicates,
+        accepts=lambda i: is_small(i) and check_whitelist(i.tags),
+        local=_local_duplicates,
+    ),
+    'place_not_in_area': PostQuery(
+        statements=_place_not_in_area_statements,
+        parse=_parse_place_not_in_area,
+        accepts=is_small,
+        is_in=True,
+    ),
+    'place_mistype': PostQuery(
+        statements=_place_mistype_statements,
+        parse=_parse_place_mistype,
+        is_in=True,
+    ),
+    'street_names': PostQuery(
+        statements=_street_names_statements,
+        parse=_parse_street_names,
+        accepts=is_small,
+        tiers=(500, 1000, 3000),
+        group=_street_names_group,
+    ),
+}
+
+
+def build_places_query(timeout: int) -> str:
+    # ways and relations only have the center coordinates
+    return f'[out:json][timeout:{timeout}]{get_bbox(GAZETTEER_BBOX)};' \
+           f'node[place][name];' \
+           f'out qt;' \
+           f'wr[place][name];' \
+           f'out tags center qt;'
+
+
+def _select_members(members: list[OverpassEntry], n: int) -> str:
+    if len(members) == 1:
+        return f'{members[0].element_type}(id:{members[0].element_id})->.e{n};'
+
+    ids: dict[ElementType, list[str]] = defaultdict(list)
+
+    for i in members:
+        ids[i.element_type].append(str(i.element_id))
+
+    selector = ''.join(f'{t}(id:{",".join(t_ids)});' for t, t_ids in ids.items())
+    return f'({selector})->.e{n};'
+
+
+def build_fused_query(elements: list[tuple[list[OverpassEntry], list[int]]],
+                      tasks: dict[int, tuple[str, int | None]], timeout: int) -> str:
+    '''
+    Select each element (or group of elements) once and run the statements of all its pending tasks,
+    every output section is preceded by a marker naming its task and element.
+    '''
+    body = []
+
+    for n, (members, task_indexes) in enumerate(elements):
+        i = members[0]
+        body.append(_select_members(members, n))
+
+        if any(POST_QUERIES[tasks[t][0]].is_in for t in task_indexes):
+            if i.element_type == 'node':
+                body.append(f'.e{n} is_in->.i{n};')
+            else:
+                body.append(f'node({i.element_type[0]}.e{n});is_in->.i{n};')
+
+        for t in task_indexes:
+            name, tier = tasks[t]
+            body.append(f'make section task={t},n={n};'
+                        f'out;' +
+                        POST_QUERIES[name].statements(i, n, tier) +
+                        f'out count;')
+
+    return f'[out:json][timeout:{timeout}]{get_bbox()};{"".join(body)}'
+
+
+def element_locality(element: tuple[list[OverpassEntry], list[int]]) -> int:
+    # the batches cover compact areas, which the server's spatial index handles much better
+    i = element[0][0]
+    return hilbert_index((i.bb_min.lat + i.bb_max.lat) / 2, (i.bb_min.lon + i.bb_max.lon) / 2)
+
+
+def element_order(element: tuple[list[OverpassEntry], list[int]]) -> tuple[int, int]:
+    # the tasks are ordered by importance, their elements are queried first in case the deadline passes
+    return min(element[1]), element_locality(element)
 
-        self.base_url = OVERPASS_API_INTERPRETER
+
+def element_span(elements: list[tuple[list[OverpassEntry], list[int]]]) -> Size:
+    '''
+    Size of the area covered by the elements, in kilometers.
+    '''
+    min_lat = min(i.bb_min.lat for members, _ in elements for i in members)
+    max_lat = max(i.bb_max.lat for members, _ in elements for i in members)
+    min_lon = min(i.bb_min.lon for members, _ in elements for i in members)
+    max_lon = max(i.bb_max.lon for members, _ in elements for i in members)
+
+    return Size(width=(max_lon - min_lon) * cos(radians((min_lat + max_lat) / 2)) * METERS_PER_DEGREE / 1000,
+                height=(max_lat - min_lat) * METERS_PER_DEGREE / 1000)
+
+
+def demultiplex(data: list[dict]) -> dict[tuple[int, int], list[dict]]:
+    '''
+    Split the fused query output into sections, keyed by the task index and the element index.
+    '''
+    result = {}
+    data_iter = iter(data)
+
+    for marker in data_iter:
+        assert marker['type'] == 'section'
+        section = []
+
+        for e in data_iter:
+            # check for end of section
+            if e['type'] == 'count':
+                assert int(e['tags']['total']) == len(section)
+                break
+
+            section.append(e)
+        else:
+            raise
+
+        result[(int(marker['tags']['task']), int(marker['tags']['n']))] = section
+
+    return result
+
+
+class Overpass:
+    def __init__(self):
+        self.endpoints = EndpointPool(OVERPASS_API_INTERPRETERS)
         self.c = get_http_client()
 
-    def get_timestamp_osm_base(self) -> int:
+        # element tags right before the given timestamp, None if the element did not exist
+        self.history: dict[tuple[ElementType, int, int], Tags | None] = {}
+
+        self.gazetteer: Gazetteer | None = None
+
+        # the elements changed in this run, by address
+        self.changed_index = AddressIndex()
+        self._changed_lock = Lock()
+        self.cache = OverpassCache(OVERPASS_CACHE_DIR, OVERPASS_CACHE_MAX_SIZE) if OVERPASS_CACHE_DIR else None
+        self.timestamp_osm_base: int | None = None
+
+        # called from the query threads with the entries of each window or tile, as they arrive
+        self.on_entries: Callable[[Region, list[OverpassEntry]], None] | None = None
+
+        # the latest end_ts of the run, the endpoints must be at least as fresh
+        self.end_ts: int | None = None
+        self.offline = OfflineStore(OFFLINE_PATH) if OFFLINE_PBF else None
+
+        if self.offline is not None:
+            self.offline.sync(OFFLINE_PBF)
+
+    def _post_endpoint(self, endpoint: Endpoint, query: str, timeout: int, *, adiff: bool = False) -> dict:
+        with endpoint.slots:
+            time_start = time.monotonic()
+
+            try:
+                r = self.c.post(endpoint.url, data={'data': query}, timeout=timeout * 2)
+            except Exception:
+                self.endpoints.report_error(endpoint)
+                raise
+
+        try:
+            # a bad query fails the same everywhere, the endpoint is not at fault
+            if bad_query := r.status_code == 400:
+                self.endpoints.report_success(endpoint, time.monotonic() - time_start)
+            else:
+                r.raise_for_status()
+                data = parse_adiff(r.content) if adiff else r.json()
+        except Exception:
+            self.endpoints.report_error(endpoint)
+            raise
+
+        if bad_query:
+            r.raise_for_status()
+
+        timestamp = None if adiff else parse_timestamp(data['osm3s']['timestamp_osm_base'])
+        self.endpoints.report_success(endpoint, time.monotonic() - time_start, timestamp)
+        return data
+
+    def _post(self, query: str, timeout: int, *, adiff: bool = False, min_timestamp: int | None = None) -> dict:
+        # responses are only cached for a known database state
+        cache = self.cache if self.timestamp_osm_base is not None else None
+
+        if cache is not None and (data := cache.get(query, self.timestamp_osm_base)) is not None:
+            return data
+
+        for attempt in range(OVERPASS_BUSY_RETRIES + 1):
+            try:
+                data = self._post_failover(query, timeout, adiff=adiff, min_timestamp=min_timestamp)
+                break
+            except Exception as e:
+                if attempt == OVERPASS_BUSY_RETRIES or status_code(e) not in (429, 504):
+                    raise
+
+                backoff = OVERPASS_BUSY_BACKOFF * 2 ** attempt
+                print(f'🐢 Overpass is busy, retrying in {backoff} sec: {e}')
+                time.sleep(backoff)
+
+        if cache is not None:
+            cache.put(query, self.timestamp_osm_base, data)
+
+        return data
+
+    def _post_failover(self, query: str, timeout: int, *, adiff: bool, min_timestamp: int | None) -> dict:
+        candidates = self.endpoints.candidates(min_timestamp if min_timestamp is not None else self.end_ts)
+        assert candidates, 'No Overpass endpoint is fresh enough'
+
+        for i, endpoint in enumerate(candidates):
+            try:
+                return self._post_endpoint(endpoint, query, timeout, adiff=adiff)
+            except Exception as e:
+                if i == len(candidates) - 1 or status_code(e) == 400:
+                    raise
+
+                print(f'🔀 Overpass failed at {endpoint.url}, retrying at {candidates[i + 1].url}: {e}')
+
+    @profiled('overpass.get_timestamp_osm_base')
+    def get_timestamp_osm_base(self, min_timestamp: int | None = None) -> int:
+        '''
+        Probe the endpoints for the database state of the run.
+        Dry runs replay the cached one instead, unless it is older than `min_timestamp`, then it is refreshed.
+        '''
+        # replay the same window in dry runs
+        if DRY_RUN and self.cache is not None and (timestamp := self.cache.get_timestamp_osm_base()) is not None \
+                and (min_timestamp is None or timestamp > min_timestamp):
+            print(f'📼 Replaying Overpass at {format_timestamp(timestamp)} from the cache')
+            self.timestamp_osm_base = timestamp
+            return timestamp
+
         timeout = 30
         query = f'[out:json][timeout:{timeout}];'
+        endpoints = self.endpoints.endpoints
+
+        # probe every endpoint, which also measures their latency
+        with ThreadPoolExecutor(len(endpoints)) as executor:
+            futures = [executor.submit(self._post_endpoint, endpoint, query, timeout) for endpoint in endpoints]
+            wait(futures)
+
+        if not (up := [e for e, f in zip(endpoints, futures) if f.exception() is None]):
+            raise futures[0].exception()
+
+        # the freshest endpoint defines the run, the lagging ones serve the queries they are fresh enough for
+        self.timestamp_osm_base = max(e.timestamp_osm_base for e in up)
 
-        r = self.c.post(self.base_url, data={'data': query}, timeout=timeout * 2)
-        r.raise_for_status()
+        if len(endpoints) > 1:
+            print(f'🌐 Overpass endpoints up: {len(up)}/{len(endpoints)}, ' + ', '.join(
+                f'{e.url} ({e.latency:.1F} sec, {self.timestamp_osm_base - e.timestamp_osm_base} sec behind)' for e in up))
 
-        data = r.json()
-        return parse_timestamp(data['osm3s']['timestamp_osm_base'])
+        if self.cache is not None:
+            self.cache.set_timestamp_osm_base(self.timestamp_osm_base)
 
-    def query(self) -> list[OverpassEntry] | bool:
-        if self.state.start_ts == self.state.end_ts:
+        return self.timestamp_osm_base
+
+    @profiled('overpass.query')
+    def query(self, cursor: Cursor) -> list[OverpassEntry] | bool:
+        if cursor.start_ts == cursor.end_ts:
             return False
 
-        timeout = 300
-        query = build_query(self.state.start_ts, self.state.end_ts, timeout=timeout)
+        # regions are queried concurrently
+        with self._changed_lock:
+            self.end_ts = max(self.end_ts or 0, cursor.end_ts)
 
-        r = self.c.post(self.base_url, data={'data': query}, timeout=timeout * 2)
-        r.raise_for_status()
+        time_start = time.perf_counter()
 
-        data = r.json()['elements']
-        result = []
+        if CATCHUP:
+            result = self._query_catchup(cursor)
+        else:
+            result = self._query_window(cursor.region, cursor.start_ts, cursor.end_ts)
 
-        for e in data:
-            # skip elements without tags for faster processing
-            if 'tags' not in e:
-                continue
+        cursor.update_density(len(result), cursor.end_ts - cursor.start_ts)
+
+        # regions are queried concurrently
+        with self._changed_lock:
+            self.changed_index.add(result)
+
+        print(f'[{cursor.region.identifier}] Queried {len(result)} elements '
+              f'({time.perf_counter() - time_start:.1F} sec)')
+        return result
+
+    def _query_catchup(self, cursor: Cursor) -> list[OverpassEntry]:
+        windows = split_windows(cursor.start_ts, cursor.end_ts, cursor.density)
+        print(f'[{cursor.region.identifier}] 🏃 Catching up over {len(windows)} window{"" if len(windows) == 1 else "s"}')
+
+        # the profiler is not thread-safe
+        with ThreadPoolExecutor(CATCHUP_WORKERS if PROFILE_DIR is None else 1) as executor:
+            futures = [executor.submit(self._query_window, cursor.region, start_ts, end_ts)
+                       for start_ts, end_ts in windows]
+
+        result: dict[int, OverpassEntry] = {}
+
+        # advance only over the contiguous prefix of finished windows
+        for i, ((start_ts, end_ts), future) in enumerate(zip(windows, futures)):
+            if e := future.exception():
+                if i == 0:
+                    raise e
+
+                print(f'⚠️ Window {format_timestamp(start_ts)} failed, stopping at it: {e!r}')
+                cursor.end_ts = start_ts
+                break
+
+            for entry in future.result():
+                # the same element version may appear on both sides of a window boundary
+                result[entry.uid] = entry
+
+        return list(result.values())
+
+    def _query_window(self, region: Region, start_ts: int, end_ts: int) -> list[OverpassEntry]:
+        if OVERPASS_TILES is None:
+            return self._query_bbox(region, start_ts, end_ts, region.bbox)
+
+        tiles = split_bbox(region.bbox, *OVERPASS_TILES)
+        result: dict[int, OverpassEntry] = {}
+
+        for attempt in range(OVERPASS_TILE_RETRIES + 1):
+            if attempt:
+                time.sleep(OVERPASS_BUSY_BACKOFF * 2 ** (attempt - 1))
+
+            # the profiler is not thread-safe
+            with ThreadPoolExecutor(OVERPASS_TILE_WORKERS if PROFILE_DIR is None else 1) as executor:
+                futures = [(tile, executor.submit(self._query_bbox, region, start_ts, end_ts, tile)) for tile in tiles]
+
+            failed = []
+
+            for tile, future in futures:
+                if e := future.exception():
+                    failed.append((tile, e))
+                    continue
+
+                for entry in future.result():
+                    # elements crossing the tile borders are returned multiple times
+                    result[entry.uid] = entry
+
+            if not failed:
+                return list(result.values())
+
+            print(f'⚠️ {len(failed)} tile{"" if len(failed) == 1 else "s"} failed, retrying: {failed[0][1]!r}')
+
+            # only the timed out tiles are split, dense areas are the usual cause,
+            # more requests would not help a busy server
+            tiles = [t for tile, e in failed for t in (split_bbox(tile, 2, 2) if status_code(e) == 504 else (tile,))]
+
+        raise failed[0][1]
+
+    def _query_bbox(self, region: Region, start_ts: int, end_ts: int, bbox: dict) -> list[OverpassEntry]:
+        timeout = 300
+        query = build_query(start_ts, end_ts, timeout=timeout, relation=region.relation, bbox=bbox,
+                            filters=compile_selectors(region), adiff=OVERPASS_ADIFF)
+
+        if OVERPASS_ADIFF:
+            elements = self._remember_old_versions(self._post(query, timeout, adiff=True, min_timestamp=end_ts)['actions'])
+        else:
+            elements = self._post(query, timeout, min_timestamp=end_ts)['elements']
+
+        # skip elements without tags for faster processing
+        elements = [e for e in elements if 'tags' in e]
+        bounds = []
 
+        for e in elements:
             if e['type'] == 'node':
                 lat, lon = e['lat'], e['lon']
 
@@ -196,15 +831,28 @@ class Overpass:
                     'maxlon': lon,
                 }
 
-            bb_min = Point(e['bounds']['minlat'], e['bounds']['minlon'])
-            bb_max = Point(e['bounds']['maxlat'], e['bounds']['maxlon'])
-            bb_size = Size(
-                width=distance(bb_min, Point(bb_min.lat, bb_max.lon)).meters,
-                height=distance(bb_min, Point(bb_max.lat, bb_min.lon)).meters
-            )
+            # the bounding box is only queried where needed
+            elif 'bounds' not in e:
+                e['bounds'] = {
+                    'minlat': 0,
+                    'minlon': 0,
+                    'maxlat': 0,
+                    'maxlon': 0,
+                }
+
+            b = e['bounds']
+            bounds.append((e['timestamp'], b['minlat'], b['minlon'], b['maxlat'], b['maxlon']))
 
+        if executor := get_executor(len(elements)):
+            decoded = map_sharded(executor, decode_bounds, bounds, [e['changeset'] for e in elements])
+        else:
+            decoded = decode_bounds(bounds)
+
+        result = []
+
+        for e, (timestamp, bb_min, bb_max, bb_size) in zip(elements, decoded):
             entry = OverpassEntry(
-                timestamp=e['timestamp'],
+                timestamp=timestamp,
                 changeset_id=e['changeset'],
                 element_type=e['type'],
                 element_id=e['id'],
@@ -215,174 +863,183 @@ class Overpass:
                 bb_size=bb_size,
             )
 
-            if self.state.start_ts <= entry.timestamp <= self.state.end_ts:
+            if start_ts <= entry.timestamp <= end_ts:
                 result.append(entry)
 
-        return result
-
-    @skip_large()
-    @batch()
-    def query_duplicates(self, raw_issues: list[OverpassEntry]) -> list[OverpassEntry]:
-        issues = [i for i in raw_issues if check_whitelist(i.tags)]
-
-        if not issues:
-            return []
-
-        timeout = 300
-        query = build_duplicates_query(issues, timeout=timeout)
-
-        r = self.c.post(self.base_url, data={'data': query}, timeout=timeout * 2)
-        r.raise_for_status()
-
-        data = r.json()['elements']
-        data_iter = iter(data)
-        result = set(issues)
-
-        for issue in issues:
-            ref = []
+        if self.on_entries is not None:
+            self.on_entries(region, result)
 
-            for e in data_iter:
-                if e['type'] == 'count':
-                    assert int(e['tags']['total']) == len(ref)
-                    break
-
-                entry = OverpassEntry(
-                    # treat as the same changeset for simpler code
-                    timestamp=issue.timestamp,
-                    changeset_id=issue.changeset_id,
-                    element_type=e['type'],
-                    element_id=e['id'],
-                    tags=e['tags'],
-                    nodes=e.get('nodes', []),
-                    bb_min=Point(0, 0),
-                    bb_max=Point(0, 0),
-                    bb_size=(0, 0),
-                )
-
-                ref.append(entry)
+        return result
 
-            else:
-                raise
+    def _remember_old_versions(self, actions: list[tuple[dict | None, dict]]) -> list[dict]:
+        '''
+        Fill the history from the augmented diff, so that is_editing_tags needs no extra queries.
+        Returns the new element versions.
+        '''
+        for old, new in actions:
+            key = (new['type'], new['id'], parse_timestamp(new['timestamp']))
+
+            # the old version predates the window, it is the previous one only if edited once since
+            if old is not None and old['version'] == new['version'] - 1:
+                self.history[key] = old.get('tags', {})
+            elif new['version'] == 1:
+                self.history[key] = None
+
+        return [new for _, new in actions]
+
+    @profiled('overpass.query_fused')
+    def query_fused(self, tasks: list[tuple[str, list[OverpassEntry]]],
+                    deadline: float | None = None) -> tuple[list[list[OverpassEntry]], list[list[OverpassEntry]]]:
+        '''
+        Run the named post_fn queries over their issues, sharing the requests between them.
+        The tasks should be ordered by importance, their requests are sent in that order.
+        Returns the filtered issues and the issues left unresolved past the deadline, for each task.
+        '''
+        result = [[] for _ in tasks]
+        unresolved = [[] for _ in tasks]
+        pending = {}
+
+        for t, (name, issues) in enumerate(tasks):
+            post_query = POST_QUERIES[name]
+            pending[t] = [i for i in issues if post_query.accepts(i)]
+
+            if post_query.local is not None:
+                result[t], pending[t] = post_query.local(self, pending[t])
+
+        tier = 0
+
+        while pending := {t: issues for t, issues in pending.items() if issues}:
+            # the issues that passed the previous tiers are checked again from the start by the next run
+            if is_overdue(deadline):
+                for t, issues in pending.items():
+                    unresolved[t] = issues
+
+                break
+
+            round_tasks = {t: (tasks[t][0], POST_QUERIES[tasks[t][0]].tiers[tier]) for t in pending}
+            elements: dict[tuple[int, ...], tuple[list[OverpassEntry], list[int]]] = {}
+            element_keys: dict[tuple[int, int], tuple[int, ...]] = {}
+
+            # each element is selected once, no matter how many tasks need it,
+            # the members of a group share the verdict of their single section
+            for t, issues in pending.items():
+                for members in POST_QUERIES[tasks[t][0]].group_issues(issues):
+                    key = tuple(i.uid for i in members)
+                    elements.setdefault(key, (members, []))[1].append(t)
+                    element_keys.update(((t, i.uid), key) for i in members)
+
+            sections = dict(self._query_fused_batch(list(elements.values()), round_tasks, deadline=deadline))
+            next_pending = {}
+
+            for t, issues in pending.items():
+                post_query = POST_QUERIES[tasks[t][0]]
+                resolved = []
+
+                for i in issues:
+                    # the batches skipped past the deadline have no sections
+                    if (section := sections.get((t, element_keys[(t, i.uid)]))) is not None:
+                        resolved.append((i, section))
+                    else:
+                        unresolved[t].append(i)
+
+                new_issues = post_query.parse(self, resolved)
+
+                if tier + 1 < len(post_query.tiers):
+                    next_pending[t] = new_issues
+                else:
+                    result[t] = list(dict.fromkeys(result[t] + new_issues))
 
-            ref_duplicates = duplicate_search(issue, ref)
+            pending = next_pending
+            tier += 1
 
-            if ref_duplicates:
-                result.update(ref_duplicates)
-            else:
-                result.remove(issue)
+        return result, unresolved
 
-        return list(result)
+    @batch(key=element_order)
+    def _query_fused_batch(self, elements: list[tuple[list[OverpassEntry], list[int]]],
+                           tasks: dict[int, tuple[str, int | None]]) -> list[tuple[tuple[int, tuple], list[dict]]]:
+        if self.offline is not None:
+            return self.offline.query_fused(elements, tasks)
 
-    @skip_large()
-    @batch()
-    def query_place_not_in_area(self, issues: list[OverpassEntry]) -> list[OverpassEntry]:
         timeout = 300
-        query = build_place_not_in_area_query(issues, timeout=timeout)
-
-        r = self.c.post(self.base_url, data={'data': query}, timeout=timeout * 2)
-        r.raise_for_status()
-
-        data = r.json()['elements']
-        data_iter = iter(data)
-        result = []
-
-        for issue in issues:
-            read_size = 0
-            place_ok = False
-
-            for e in data_iter:
-                # check for end of section
-                if e['type'] == 'count':
-                    assert int(e['tags']['total']) == read_size
-                    break
-
-                read_size += 1
-                place_ok = True
+        query = build_fused_query(elements, tasks, timeout=timeout)
+        time_start = time.perf_counter()
+
+        sections = demultiplex(self._post(query, timeout)['elements'])
+
+        # the batch composition against the server time
+        elapsed = time.perf_counter() - time_start
+        span = element_span(elements)
+        record_metric('overpass.fused_batch', elements=len(elements), tasks=len(tasks),
+                      width_km=f'{span.width:.3f}', height_km=f'{span.height:.3f}', elapsed=f'{elapsed:.3f}')
+
+        return [((t, tuple(i.uid for i in members)), sections[(t, n)])
+                for n, (members, task_indexes) in enumerate(elements)
+                for t in task_indexes]
+
+    def get_gazetteer(self) -> Gazetteer:
+        if self.gazetteer is None:
+            if self.offline is not None:
+                places = self.offline.places()
+            elif GAZETTEER_PATH.is_file() and GAZETTEER_PATH.stat().st_mtime > time.time() - GAZETTEER_MAX_AGE:
+                places = json.loads(GAZETTEER_PATH.read_text())
             else:
-                raise
+                places = self.query_places()
+                tmp_path = GAZETTEER_PATH.with_name(f'{GAZETTEER_PATH.name}.tmp')
+                tmp_path.write_text(json.dumps(places, ensure_ascii=False, separators=(',', ':')))
+                tmp_path.replace(GAZETTEER_PATH)
 
-            if not place_ok:
-                result.append(issue)
+            self.gazetteer = Gazetteer(places)
+            print(f'🗺️ Loaded {len(self.gazetteer)} places')
 
-        return result
+        return self.gazetteer
 
-    @batch()
-    def query_place_mistype(self, issues: list[OverpassEntry]) -> list[OverpassEntry]:
+    @profiled('overpass.query_places')
+    def query_places(self) -> list[tuple[str, float, float]]:
         timeout = 300
-        query = build_place_mistype_query(issues, timeout=timeout)
-
-        r = self.c.post(self.base_url, data={'data': query}, timeout=timeout * 2)
-        r.raise_for_status()
-
-        data = r.json()['elements']
-        data_iter = iter(data)
+        query = build_places_query(timeout=timeout)
         result = []
 
-        for issue in issues:
-            read_size = 0
-            is_in = set()
+        for e in self._post(query, timeout)['elements']:
+            point = e['center'] if 'center' in e else e
 
-            for e in data_iter:
-                # check for end of section
-                if e['type'] == 'count':
-                    assert int(e['tags']['total']) == read_size
-                    break
-
-                read_size += 1
-
-                for key in ('name', 'alt_name'):
-                    if val := e['tags'].get(key, None):
-                        is_in.add(val)
-            else:
-                raise
-
-            if issue.tags['addr:place'] not in is_in:
-                addr_place_norm = normalize(issue.tags['addr:place'])
-
-                if any(addr_place_norm == normalize(i) for i in is_in):
-                    result.append(issue)
+            # the name filter matches the name tag only
+            result.append((e['tags']['name'], point['lat'], point['lon']))
 
         return result
 
-    @skip_large()
-    @batch()
-    @tier(500, 1000, 3000)
-    def query_street_names(self, issues: list[OverpassEntry], *, tier: int) -> list[OverpassEntry]:
-        timeout = 300
-        query = build_street_names_query(issues, timeout=timeout, around=tier)
+    @profiled('overpass.query_duplicates')
+    def query_duplicates(self, issues: list[OverpassEntry]) -> list[OverpassEntry]:
+        return self.query_fused([('duplicates', issues)])[0][0]
 
-        r = self.c.post(self.base_url, data={'data': query}, timeout=timeout * 2)
-        r.raise_for_status()
+    @profiled('overpass.query_place_not_in_area')
+    def query_place_not_in_area(self, issues: list[OverpassEntry]) -> list[OverpassEntry]:
+        return self.query_fused([('place_not_in_area', issues)])[0][0]
 
-        data = r.json()['elements']
-        data_iter = iter(data)
-        result = []
+    @profiled('overpass.query_place_mistype')
+    def query_place_mistype(self, issues: list[OverpassEntry]) -> list[OverpassEntry]:
+        return self.query_fused([('place_mistype', issues)])[0][0]
 
-        for issue in issues:
-            read_size = 0
-            street_names = set()
+    @profiled('overpass.query_street_names')
+    def query_street_names(self, issues: list[OverpassEntry]) -> list[OverpassEntry]:
+        return self.query_fused([('street_names', issues)])[0][0]
 
-            for e in data_iter:
-                # check for end of section
-                if e['type'] == 'count':
-                    assert int(e['tags']['total']) == read_size
-                    break
+    def _fetch_history(self, timestamp: int, entries: list[OverpassEntry]) -> None:
+        timeout = 300
+        query = build_partition_query(timestamp, entries, timeout=timeout)
 
-                read_size += 1
+        elements = self._post(query, timeout)['elements']
 
-                for key in ('name', 'alt_name'):
-                    if val := e['tags'].get(key, None):
-                        street_names.add(val)
-            else:
-                raise
+        if len(elements) > len(entries):
+            raise
 
-            if issue.tags['addr:street'] not in street_names:
-                result.append(issue)
+        # missing elements were created
+        for entry in entries:
+            self.history[(entry.element_type, entry.element_id, timestamp)] = None
 
-        return result
+        for element in elements:
+            self.history[(element['type'], element['id'], timestamp)] = element.get('tags', {})
 
     def is_editing_tags(self, cat: Category, issues: dict[Check, list[OverpassEntry]]) -> bool:
-        timeout = 300
         partitions: dict[int, set[OverpassEntry]] = defaultdict(set)
         entry_map: dict[ElementType, dict[int, tuple[Check, OverpassEntry]]] = defaultdict(dict)
 
@@ -392,23 +1049,19 @@ class Overpass:
                 entry_map[entry.element_type][entry.element_id] = (check, entry)
 
         for partition_time, partition_issues in partitions.items():
-            partition_query = build_partition_query(partition_time, list(partition_issues), timeout=timeout)
+            # the same versions are often needed by multiple categories
+            if missing := [i for i in partition_issues
+                           if (i.element_type, i.element_id, partition_time) not in self.history]:
+                self._fetch_history(partition_time, missing)
 
-            r = self.c.post(self.base_url, data={'data': partition_query}, timeout=timeout * 2)
-            r.raise_for_status()
+            for entry in partition_issues:
+                ref_check, ref_entry = entry_map[entry.element_type][entry.element_id]
+                tags = self.history[(entry.element_type, entry.element_id, partition_time)]
 
-            elements = r.json()['elements']
-
-            # fewer elements means some were created
-            if len(elements) < len(partition_issues):
-                return True
-
-            if len(elements) > len(partition_issues):
-                raise
+                if tags is None:
+                    return True
 
-            for element in elements:
-                ref_check, ref_entry = entry_map[element['type']][element['id']]
-                tags_diff: Tags = {k: v for k, v in set(ref_entry.tags.items()) - set(element.get('tags', {}).items())}
+                tags_diff: Tags = {k: v for k, v in set(ref_entry.tags.items()) - set(tags.items())}
 
                 # selector by category group if set
                 if cat.selectors:
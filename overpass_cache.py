@@ -0,0 +1,91 @@
+import gzip
+import hashlib
+import json
+import os
+import re
+from pathlib import Path
+from threading import Lock
+
+from config import OVERPASS_CACHE_BYPASS
+
+TIMEOUT_RE = re.compile(r'\[timeout:\d+\]')
+
+
+def normalize_query(query: str) -> str:
+    # the timeout does not affect the result
+    return TIMEOUT_RE.sub('', query).strip()
+
+
+class OverpassCache:
+    '''
+    Content-addressed, gzip-compressed Overpass responses, evicting the least recently used ones over `max_size`.
+    '''
+
+    def __init__(self, path: Path, max_size: int):
+        self.path = path
+        self.max_size = max_size
+        self._lock = Lock()
+
+        self.path.mkdir(parents=True, exist_ok=True)
+        self._size = sum(p.stat().st_size for p in self.path.glob('*.json.gz'))
+
+    def _entry_path(self, query: str, timestamp_osm_base: int) -> Path:
+        key = hashlib.sha256(f'{timestamp_osm_base}\n{normalize_query(query)}'.encode()).hexdigest()
+        return self.path / f'{key}.json.gz'
+
+    def get(self, query: str, timestamp_osm_base: int) -> dict | None:
+        if OVERPASS_CACHE_BYPASS:
+            return None
+
+        path = self._entry_path(query, timestamp_osm_base)
+
+        try:
+            with gzip.open(path, 'rt') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return None
+
+        # mark as recently used
+        path.touch()
+        return data
+
+    def put(self, query: str, timestamp_osm_base: int, data: dict) -> None:
+        path = self._entry_path(query, timestamp_osm_base)
+        tmp_path = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+
+        with gzip.open(tmp_path, 'wt', compresslevel=6) as f:
+            json.dump(data, f, separators=(',', ':'))
+
+        size = tmp_path.stat().st_size
+
+        with self._lock:
+            if path.is_file():
+                self._size -= path.stat().st_size
+
+            tmp_path.replace(path)
+            self._size += size
+
+            if self._size > self.max_size:
+                self._evict()
+
+    def _evict(self) -> None:
+        entries = sorted((p.stat().st_mtime, p.stat().st_size, p) for p in self.path.glob('*.json.gz'))
+
+        for _, size, path in entries:
+            if self._size <= self.max_size:
+                break
+
+            path.unlink(missing_ok=True)
+            self._size -= size
+
+    def get_timestamp_osm_base(self) -> int | None:
+        if OVERPASS_CACHE_BYPASS:
+            return None
+
+        try:
+            return int((self.path / 'timestamp_osm_base').read_text())
+        except FileNotFoundError:
+            return None
+
+    def set_timestamp_osm_base(self, value: int) -> None:
+        (self.path / 'timestamp_osm_base').write_text(str(value))
@@ -0,0 +1,74 @@
+import time
+from dataclasses import dataclass, field
+from threading import BoundedSemaphore, Lock
+
+from config import OVERPASS_ENDPOINT_BACKOFF, OVERPASS_ENDPOINT_MAX_BACKOFF, OVERPASS_ENDPOINT_SLOTS
+
+# weight of the most recent sample in the moving averages
+EWMA_ALPHA = 0.3
+
+
+@dataclass(kw_only=True, slots=True)
+class Endpoint:
+    url: str
+
+    # moving averages, None until the first response
+    latency: float | None = None  # seconds
+    error_rate: float = 0
+
+    # the last reported database state, None until known
+    timestamp_osm_base: int | None = None
+
+    consecutive_errors: int = 0
+    backoff_until: float = 0  # monotonic
+
+    # held for the duration of each request
+    slots: BoundedSemaphore = field(default_factory=lambda: BoundedSemaphore(OVERPASS_ENDPOINT_SLOTS), repr=False)
+
+    def score(self) -> float:
+        # the expected time to a successful response
+        return (self.latency or 0) / max(1 - self.error_rate, 0.1)
+
+
+class EndpointPool:
+    '''
+    Overpass interpreters ranked by their latency, error rate and freshness.
+    Failing endpoints are backed off exponentially but remain the last resort.
+    '''
+
+    def __init__(self, urls: tuple[str, ...]):
+        assert urls, 'At least one Overpass endpoint is required'
+        self.endpoints = tuple(Endpoint(url=url) for url in urls)
+        self._lock = Lock()
+
+    def candidates(self, min_timestamp: int | None = None) -> list[Endpoint]:
+        '''
+        Return the endpoints at least as fresh as `min_timestamp` in the order of preference, the healthy ones first.
+        '''
+        now = time.monotonic()
+
+        with self._lock:
+            fresh = [e for e in self.endpoints
+                     if min_timestamp is None or e.timestamp_osm_base is None or e.timestamp_osm_base >= min_timestamp]
+
+            # sorted() is stable, ties keep the configured order
+            return sorted(fresh, key=lambda e: (e.backoff_until > now, e.score()))
+
+    def report_success(self, endpoint: Endpoint, elapsed: float, timestamp_osm_base: int | None = None) -> None:
+        with self._lock:
+            endpoint.latency = elapsed if endpoint.latency is None else \
+                EWMA_ALPHA * elapsed + (1 - EWMA_ALPHA) * endpoint.latency
+            endpoint.error_rate *= 1 - EWMA_ALPHA
+            endpoint.consecutive_errors = 0
+            endpoint.backoff_until = 0
+
+            if timestamp_osm_base is not None:
+                endpoint.timestamp_osm_base = max(endpoint.timestamp_osm_base or 0, timestamp_osm_base)
+
+    def report_error(self, endpoint: Endpoint) -> None:
+        with self._lock:
+            endpoint.error_rate = EWMA_ALPHA + (1 - EWMA_ALPHA) * endpoint.error_rate
+            endpoint.consecutive_errors += 1
+            endpoint.backoff_until = time.monotonic() + min(
+                OVERPASS_ENDPOINT_BACKOFF * 2 ** (endpoint.consecutive_errors - 1),
+                OVERPASS_ENDPOINT_MAX_BACKOFF)
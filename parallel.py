@@ -0,0 +1,55 @@
+from collections.abc import Callable, Sequence
+from typing import TYPE_CHECKING
+
+from config import PARALLEL_MIN_ITEMS, PROCESSES
+
+if TYPE_CHECKING:
+    from concurrent.futures import ProcessPoolExecutor
+
+_executor: 'ProcessPoolExecutor | None' = None
+
+
+def get_executor(size: int) -> 'ProcessPoolExecutor | None':
+    '''
+    Get the shared process pool, or None if the work of this size should run in-process.
+    '''
+    global _executor
+
+    if PROCESSES <= 1 or size < PARALLEL_MIN_ITEMS:
+        return None
+
+    if _executor is None:
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+
+        # forking a process with running threads is unsafe
+        _executor = ProcessPoolExecutor(PROCESSES, mp_context=multiprocessing.get_context('forkserver'))
+
+    return _executor
+
+
+def shard_by_changeset(changeset_ids: Sequence[int]) -> list[list[int]]:
+    '''
+    Partition the item positions into PROCESSES shards, keeping each changeset in a single shard.
+    '''
+    shards = [[] for _ in range(PROCESSES)]
+
+    for i, changeset_id in enumerate(changeset_ids):
+        shards[changeset_id % PROCESSES].append(i)
+
+    return [s for s in shards if s]
+
+
+def map_sharded(executor: 'ProcessPoolExecutor', fn: Callable[[list], list], items: list, changeset_ids: Sequence[int]) -> list:
+    '''
+    Apply `fn` to the items sharded by changeset. `fn` must return one result per item.
+    The results are returned in the original order.
+    '''
+    shards = shard_by_changeset(changeset_ids)
+    result = [None] * len(items)
+
+    for shard, shard_result in zip(shards, executor.map(fn, [[items[i] for i in s] for s in shards])):
+        for i, r in zip(shard, shard_result, strict=True):
+            result[i] = r
+
+    return result
@@ -0,0 +1,293 @@
+import struct
+import zlib
+from collections.abc import Callable, Iterator
+from dataclasses import dataclass
+from pathlib import Path
+
+from aliases import ElementType, Tags
+
+MEMBER_TYPES: tuple[ElementType, ...] = ('node', 'way', 'relation')
+
+
+@dataclass(frozen=True, kw_only=True, slots=True)
+class PbfHeader:
+    replication_sequence: int | None
+    replication_url: str | None
+
+
+@dataclass(frozen=True, kw_only=True, slots=True)
+class PbfElement:
+    type: ElementType
+    id: int
+    tags: Tags
+
+    # node only
+    lat: float = 0
+    lon: float = 0
+
+    # way only
+    nodes: tuple[int, ...] = ()
+
+    # relation only, (type, ref, role)
+    members: tuple[tuple[ElementType, int, str], ...] = ()
+
+
+def _varint(buf: memoryview, pos: int) -> tuple[int, int]:
+    result = 0
+    shift = 0
+
+    while True:
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7F) << shift
+
+        if not b & 0x80:
+            return result, pos
+
+        shift += 7
+
+
+def _zigzag(value: int) -> int:
+    return (value >> 1) ^ -(value & 1)
+
+
+def _int64(value: int) -> int:
+    # negative values are encoded in two's complement
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def _fields(buf: memoryview) -> Iterator[tuple[int, int | memoryview]]:
+    '''
+    Iterate over the (field number, value) pairs of a protobuf message.
+    Length-delimited values are returned as memoryviews, the others as unsigned integers.
+    '''
+    pos = 0
+    end = len(buf)
+
+    while pos < end:
+        key, pos = _varint(buf, pos)
+        field, wire_type = key >> 3, key & 0x7
+
+        if wire_type == 0:
+            value, pos = _varint(buf, pos)
+        elif wire_type == 1:
+            value = int.from_bytes(buf[pos:pos + 8], 'little')
+            pos += 8
+        elif wire_type == 2:
+            size, pos = _varint(buf, pos)
+            value = buf[pos:pos + size]
+            pos += size
+        elif wire_type == 5:
+            value = int.from_bytes(buf[pos:pos + 4], 'little')
+            pos += 4
+        else:
+            raise ValueError(f'Unsupported protobuf wire type {wire_type}')
+
+        yield field, value
+
+
+def _packed(buf: memoryview) -> list[int]:
+    result = []
+    pos = 0
+
+    while pos < len(buf):
+        value, pos = _varint(buf, pos)
+        result.append(value)
+
+    return result
+
+
+def _packed_delta(buf: memoryview) -> list[int]:
+    result = []
+    value = 0
+
+    for v in _packed(buf):
+        value += _zigzag(v)
+        result.append(value)
+
+    return result
+
+
+def _read_blobs(path: Path) -> Iterator[tuple[str, memoryview]]:
+    with open(path, 'rb') as f:
+        while size_bytes := f.read(4):
+            header_size, = struct.unpack('>I', size_bytes)
+            blob_type = ''
+            data_size = 0
+
+            for field, value in _fields(memoryview(f.read(header_size))):
+                if field == 1:
+                    blob_type = bytes(value).decode()
+                elif field == 3:
+                    data_size = value
+
+            data = None
+
+            for field, value in _fields(memoryview(f.read(data_size))):
+                if field == 1:
+                    data = bytes(value)
+                elif field == 3:
+                    data = zlib.decompress(value)
+
+            if data is None:
+                raise ValueError('Unsupported PBF blob compression, only raw and zlib are supported')
+
+            yield blob_type, memoryview(data)
+
+
+def _parse_header(buf: memoryview) -> PbfHeader:
+    sequence = None
+    url = None
+
+    for field, value in _fields(buf):
+        if field == 33:
+            sequence = value
+        elif field == 34:
+            url = bytes(value).decode()
+
+    return PbfHeader(replication_sequence=sequence, replication_url=url)
+
+
+def _tags(strings: list[str], keys: list[int], vals: list[int]) -> Tags:
+    return {strings[k]: strings[v] for k, v in zip(keys, vals)}
+
+
+def _parse_block(buf: memoryview) -> Iterator[PbfElement]:
+    strings = []
+    groups = []
+    granularity = 100
+    lat_offset = 0
+    lon_offset = 0
+
+    for field, value in _fields(buf):
+        if field == 1:
+            strings = [bytes(s).decode() for f, s in _fields(value) if f == 1]
+        elif field == 2:
+            groups.append(value)
+        elif field == 17:
+            granularity = value
+        elif field == 19:
+            lat_offset = _int64(value)
+        elif field == 20:
+            lon_offset = _int64(value)
+
+    def coord(offset: int, value: int) -> float:
+        return (offset + granularity * value) / 1_000_000_000
+
+    for group in groups:
+        for field, value in _fields(group):
+            if field == 1:
+                yield _parse_node(value, strings, coord, lat_offset, lon_offset)
+            elif field == 2:
+                yield from _parse_dense(value, strings, coord, lat_offset, lon_offset)
+            elif field == 3:
+                yield _parse_way(value, strings)
+            elif field == 4:
+                yield _parse_relation(value, strings)
+
+
+def _parse_node(buf: memoryview, strings: list[str], coord: Callable[[int, int], float],
+                lat_offset: int, lon_offset: int) -> PbfElement:
+    element_id = lat = lon = 0
+    keys = vals = []
+
+    for field, value in _fields(buf):
+        if field == 1:
+            element_id = _zigzag(value)
+        elif field == 2:
+            keys = _packed(value)
+        elif field == 3:
+            vals = _packed(value)
+        elif field == 8:
+            lat = _zigzag(value)
+        elif field == 9:
+            lon = _zigzag(value)
+
+    return PbfElement(type='node', id=element_id, tags=_tags(strings, keys, vals),
+                      lat=coord(lat_offset, lat), lon=coord(lon_offset, lon))
+
+
+def _parse_dense(buf: memoryview, strings: list[str], coord: Callable[[int, int], float],
+                 lat_offset: int, lon_offset: int) -> Iterator[PbfElement]:
+    ids = lats = lons = keys_vals = []
+
+    for field, value in _fields(buf):
+        if field == 1:
+            ids = _packed_delta(value)
+        elif field == 8:
+            lats = _packed_delta(value)
+        elif field == 9:
+            lons = _packed_delta(value)
+        elif field == 10:
+            keys_vals = _packed(value)
+
+    pos = 0
+
+    for element_id, lat, lon in zip(ids, lats, lons):
+        tags = {}
+
+        # the key-value pairs of each node are terminated by 0
+        while pos < len(keys_vals) and keys_vals[pos] != 0:
+            tags[strings[keys_vals[pos]]] = strings[keys_vals[pos + 1]]
+            pos += 2
+
+        pos += 1
+
+        yield PbfElement(type='node', id=element_id, tags=tags,
+                         lat=coord(lat_offset, lat), lon=coord(lon_offset, lon))
+
+
+def _parse_way(buf: memoryview, strings: list[str]) -> PbfElement:
+    element_id = 0
+    keys = vals = refs = []
+
+    for field, value in _fields(buf):
+        if field == 1:
+            element_id = value
+        elif field == 2:
+            keys = _packed(value)
+        elif field == 3:
+            vals = _packed(value)
+        elif field == 8:
+            refs = _packed_delta(value)
+
+    return PbfElement(type='way', id=element_id, tags=_tags(strings, keys, vals), nodes=tuple(refs))
+
+
+def _parse_relation(buf: memoryview, strings: list[str]) -> PbfElement:
+    element_id = 0
+    keys = vals = roles = refs = types = []
+
+    for field, value in _fields(buf):
+        if field == 1:
+            element_id = value
+        elif field == 2:
+            keys = _packed(value)
+        elif field == 3:
+            vals = _packed(value)
+        elif field == 8:
+            roles = _packed(value)
+        elif field == 9:
+            refs = _packed_delta(value)
+        elif field == 10:
+            types = _packed(value)
+
+    members = tuple((MEMBER_TYPES[t], ref, strings[role]) for t, ref, role in zip(types, refs, roles))
+    return PbfElement(type='relation', id=element_id, tags=_tags(strings, keys, vals), members=members)
+
+
+def read_pbf(path: Path) -> tuple[PbfHeader, Iterator[PbfElement]]:
+    '''
+    Read an .osm.pbf file, returning its header and the lazily parsed elements in the file order
+    (nodes, then ways, then relations).
+    '''
+    blobs = _read_blobs(path)
+    blob_type, data = next(blobs)
+    assert blob_type == 'OSMHeader', f'Unexpected first PBF blob {blob_type!r}'
+
+    def elements() -> Iterator[PbfElement]:
+        for blob_type, data in blobs:
+            if blob_type == 'OSMData':
+                yield from _parse_block(data)
+
+    return _parse_header(data), elements()
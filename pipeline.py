@@ -0,0 +1,95 @@
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from threading import Lock
+
+from category import Category
+from check import Check
+from checks import OVERPASS_CATEGORIES
+from osmapi import OsmApi
+from overpass_entry import OverpassEntry
+from region import Region
+
+
+class Pipeline:
+    '''
+    Map the checks over the entries as the windows and tiles arrive,
+    prefetching the changesets and users of the issues in the background.
+    A single-request ingestion arrives all at once, leaving nothing to overlap with.
+    '''
+
+    def __init__(self, osm: OsmApi, workers: int):
+        self.osm = osm
+        self._executor = ThreadPoolExecutor(workers)
+        self._lock = Lock()
+
+        # matched checks by category, for each element version
+        self._checks: dict[str, dict[tuple[int, int], list[Check]]] = {c.identifier: {} for c in OVERPASS_CATEGORIES}
+        self._changesets: dict[int, Future] = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        # the pending prefetches are useless now
+        self._executor.shutdown(cancel_futures=True)
+
+    def feed(self, region: Region, entries: list[OverpassEntry]) -> None:
+        '''
+        Called from the query threads with the entries of each window or tile.
+        '''
+        changeset_ids = set()
+
+        for cat in OVERPASS_CATEGORIES:
+            if not region.has_category(cat.identifier):
+                continue
+
+            selected = {(e.uid, e.timestamp): [] for e in entries}
+
+            for check, issues in cat.map_checks(entries).items():
+                for i in issues:
+                    selected[(i.uid, i.timestamp)].append(check)
+                    changeset_ids.add(i.changeset_id)
+
+            with self._lock:
+                self._checks[cat.identifier].update(selected)
+
+        with self._lock:
+            for changeset_id in changeset_ids - self._changesets.keys():
+                self._changesets[changeset_id] = self._executor.submit(self._prefetch, changeset_id)
+
+    def _prefetch(self, changeset_id: int) -> None:
+        changeset = self.osm.get_changeset(changeset_id)
+        self._executor.submit(self.osm.get_user, changeset['uid'])
+
+    def map_checks(self, cat: Category, entries: list[OverpassEntry]) -> dict[Check, list[OverpassEntry]]:
+        '''
+        Same as `Category.map_checks`, reusing the checks matched during the ingestion.
+        '''
+        with self._lock:
+            selected = {(e.uid, e.timestamp): checks for e in entries
+                        if (checks := self._checks[cat.identifier].get((e.uid, e.timestamp))) is not None}
+
+        if missing := [e for e in entries if (e.uid, e.timestamp) not in selected]:
+            for e in missing:
+                selected[(e.uid, e.timestamp)] = []
+
+            for check, issues in cat.map_checks(missing).items():
+                for i in issues:
+                    selected[(i.uid, i.timestamp)].append(check)
+
+        result = {}
+
+        for c in cat.checks:
+            if value := [e for e in entries if c in selected[(e.uid, e.timestamp)]]:
+                result[c] = value
+
+        return result
+
+    def join_changesets(self) -> None:
+        '''
+        Wait for the changeset prefetches, so that they are not requested twice.
+        The failed ones are requested again, and fail properly, later on.
+        '''
+        with self._lock:
+            futures = list(self._changesets.values())
+
+        wait(futures)
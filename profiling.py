@@ -0,0 +1,112 @@
+import cProfile
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass
+from functools import wraps
+
+from config import PROFILE_DIR
+
+
+@dataclass(slots=True)
+class _Frame:
+    name: str
+    profiler: cProfile.Profile | None
+    peak: int = 0
+
+
+_stack: list[_Frame] = []
+_seq = 0
+
+
+@contextmanager
+def _profile(name: str):
+    global _seq
+    _seq += 1
+    seq = _seq
+
+    if not tracemalloc.is_tracing():
+        PROFILE_DIR.mkdir(parents=True, exist_ok=True)
+        tracemalloc.start()
+
+    if _stack:
+        # nested stage - remember the parent peak before resetting it
+        parent = _stack[-1]
+        parent.peak = max(parent.peak, tracemalloc.get_traced_memory()[1])
+
+    tracemalloc.reset_peak()
+
+    # only one cProfile profiler can be active at a time, the outermost one collects nested stages
+    profiler = cProfile.Profile() if not any(f.profiler for f in _stack) else None
+    frame = _Frame(name, profiler)
+    _stack.append(frame)
+
+    time_start = time.perf_counter()
+
+    if profiler is not None:
+        profiler.enable()
+
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+
+        elapsed = time.perf_counter() - time_start
+        frame.peak = max(frame.peak, tracemalloc.get_traced_memory()[1])
+        _stack.pop()
+
+        if _stack:
+            _stack[-1].peak = max(_stack[-1].peak, frame.peak)
+
+        # the stage names contain dots, with_suffix() would cut them
+        if profiler is not None:
+            profiler.dump_stats(PROFILE_DIR / f'{seq:03d}-{name}.prof')
+
+        tracemalloc.take_snapshot().dump(str(PROFILE_DIR / f'{seq:03d}-{name}.snapshot'))
+
+        with open(PROFILE_DIR / 'summary.tsv', 'a') as f:
+            f.write(f'{seq}\t{name}\t{elapsed:.3f}\t{frame.peak}\n')
+
+        print(f'⏱️ Profiled {name}: {elapsed:.1F} sec, peak {frame.peak / 1024 / 1024:.1F} MiB')
+
+
+def profile_stage(name: str):
+    '''
+    Profile the CPU time and peak memory of the wrapped block.
+    Results are written to PROFILE_DIR, does nothing if it's not set.
+    '''
+    if PROFILE_DIR is None:
+        return nullcontext()
+
+    return _profile(name)
+
+
+def record_metric(name: str, **values) -> None:
+    '''
+    Append a row of named values to PROFILE_DIR/metrics.tsv, does nothing if it's not set.
+    '''
+    if PROFILE_DIR is None:
+        return
+
+    PROFILE_DIR.mkdir(parents=True, exist_ok=True)
+
+    with open(PROFILE_DIR / 'metrics.tsv', 'a') as f:
+        f.write('\t'.join((name, *(f'{k}={v}' for k, v in values.items()))) + '\n')
+
+
+def profiled(name: str):
+    '''
+    Decorator variant of profile_stage. The function is returned unchanged if profiling is disabled.
+    '''
+    def decorator(func):
+        if PROFILE_DIR is None:
+            return func
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with _profile(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+    return decorator
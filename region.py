@@ -0,0 +1,16 @@
+from dataclasses import dataclass
+
+from aliases import Identifier
+
+
+@dataclass(frozen=True, kw_only=True, slots=True)
+class Region:
+    identifier: Identifier
+    relation: int
+    bbox: dict[str, float]
+
+    # category identifiers to check, None for all
+    categories: tuple[Identifier, ...] | None = None
+
+    def has_category(self, cat: Identifier) -> bool:
+        return self.categories is None or cat in self.categories
@@ -1,80 +1,404 @@
 import fcntl
 import json
-from dataclasses import asdict
+import sqlite3
+from dataclasses import dataclass
 from time import time
 from typing import IO
 
-from aliases import Identifier
+from aliases import ElementType, Identifier, Tags
 from check import Check
-from checks import ALL_CHECKS
-from config import STATE_MAX_BACKLOG, STATE_MAX_DIFF, STATE_PATH
-from overpass_entry import OverpassEntry
+from checks import ALL_CATEGORIES_BY_ID, ALL_CHECKS_BY_ID
+from config import (ADIFF_SEQUENCE_INTERVAL, CATCHUP, CHANGESET_IDLE_TIMEOUT, CHANGESET_MAX_AGE, LEGACY_STATE_PATH,
+                    OVERPASS_ADIFF, REGIONS, STATE_MAX_BACKLOG, STATE_MAX_DIFF, STATE_PATH)
+from overpass_entry import OverpassEntry, Point, Size
+from region import Region
+from utils import parse_timestamp
 
+# append-only, each script upgrades the schema by one version
+MIGRATIONS = (
+    '''
+    CREATE TABLE meta (
+        key TEXT PRIMARY KEY,
+        value NOT NULL
+    );
 
-class State:
+    CREATE TABLE rescheduled_issue (
+        category TEXT NOT NULL,
+        changeset_id INTEGER NOT NULL,
+        check_id TEXT NOT NULL,
+        element_type TEXT NOT NULL,
+        element_id INTEGER NOT NULL,
+        timestamp INTEGER NOT NULL,
+        tags TEXT NOT NULL,
+        PRIMARY KEY (category, changeset_id, check_id, element_type, element_id)
+    ) WITHOUT ROWID;
+    ''',
+    '''
+    CREATE TABLE rescheduled_changeset (
+        changeset_id INTEGER PRIMARY KEY,
+        created_at INTEGER NOT NULL,
+        last_activity INTEGER NOT NULL,
+        changes_count INTEGER NOT NULL,
+        polled_at INTEGER NOT NULL,
+        next_poll INTEGER NOT NULL
+    );
+    ''',
+    '''
+    CREATE TABLE cursor (
+        region TEXT PRIMARY KEY,
+        state INTEGER NOT NULL,
+        density REAL
+    );
+
+    INSERT INTO cursor (region, state, density)
+    SELECT 'PL', value, (SELECT value FROM meta WHERE key = 'density') FROM meta WHERE key = 'state';
+
+    DELETE FROM meta WHERE key IN ('state', 'density');
+    ''',
+    '''
+    CREATE TABLE element_history (
+        element_type TEXT NOT NULL,
+        element_id INTEGER NOT NULL,
+        timestamp INTEGER NOT NULL,
+        tags TEXT,
+        PRIMARY KEY (element_type, element_id, timestamp)
+    ) WITHOUT ROWID;
+    ''',
+    '''
+    CREATE TABLE deferred_issue (
+        category TEXT NOT NULL,
+        check_id TEXT NOT NULL,
+        element_type TEXT NOT NULL,
+        element_id INTEGER NOT NULL,
+        changeset_id INTEGER NOT NULL,
+        timestamp INTEGER NOT NULL,
+        tags TEXT NOT NULL,
+        min_lat REAL NOT NULL,
+        min_lon REAL NOT NULL,
+        max_lat REAL NOT NULL,
+        max_lon REAL NOT NULL,
+        width REAL NOT NULL,
+        height REAL NOT NULL,
+        PRIMARY KEY (category, check_id, element_type, element_id)
+    ) WITHOUT ROWID;
+    ''',
+)
+
+
+def _needed_tags(cat: Identifier, check: Check, tags: Tags) -> Tags:
+    '''
+    Only keep the tags that can still affect the outcome: the ones selected by the category or the check.
+    '''
+    category = ALL_CATEGORIES_BY_ID[cat]
+    return {
+        k: v for k, v in tags.items()
+        if category.is_selected({k: v}, partial=True) or check.is_selected({k: v}, partial=True)
+    }
+
+
+def predict_close(created_at: int, last_activity: int) -> int:
+    '''
+    Predict when an open changeset can be closed at the earliest, assuming no explicit close.
+    '''
+    # still open, so it must have been active within the idle timeout
+    last_activity = max(last_activity, int(time()) - CHANGESET_IDLE_TIMEOUT)
+    return min(created_at + CHANGESET_MAX_AGE, last_activity + CHANGESET_IDLE_TIMEOUT)
+
+
+@dataclass(kw_only=True, slots=True)
+class Cursor:
+    region: Region
     start_ts: int
     end_ts: int
-    _rescheduled_issues: dict[Identifier, dict[int, dict[str, list[dict]]]]
+
+    # changed elements per second, running average
+    density: float | None
+
+    def configure_end_ts(self, value: int) -> None:
+        self.end_ts = value
+
+        # catch-up mode is limited only by the backlog
+        if not CATCHUP and self.end_ts - self.start_ts > STATE_MAX_DIFF:
+            self.end_ts = self.start_ts + STATE_MAX_DIFF
+
+        # track the diffs sequence by sequence, a partial one is queried in the next run
+        if OVERPASS_ADIFF:
+            self.end_ts = max(self.start_ts, self.end_ts - self.end_ts % ADIFF_SEQUENCE_INTERVAL)
+
+    def update_density(self, elements: int, seconds: int) -> None:
+        if seconds <= 0:
+            return
+
+        density = elements / seconds
+        self.density = density if self.density is None else (self.density + density) / 2
+
+
+class StateLockedError(Exception):
+    pass
+
+
+class State:
+    cursors: dict[Identifier, Cursor]
+    _history_keys: set[tuple[ElementType, int, int]] = set()
+    _db: sqlite3.Connection
     _fd: IO
 
     def __enter__(self):
-        if not STATE_PATH.is_file():
-            with open(STATE_PATH, 'x') as f:
-                f.write('0')
-
-        # open for rw to ensure permissions
-        self._fd = open(STATE_PATH, 'r+')
-        fcntl.flock(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        # open for writing to ensure permissions
+        self._fd = open(STATE_PATH, 'a')
 
         try:
-            data = json.load(self._fd)
-            assert isinstance(data, dict)
-        except Exception:
-            self._fd.seek(0)
-            data = {'state': int(self._fd.read().strip())}
+            fcntl.flock(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self._fd.close()
+            raise StateLockedError(f'{STATE_PATH} is locked by another run') from None
+
+        self._db = sqlite3.connect(STATE_PATH)
+        self._db.execute('PRAGMA journal_mode = WAL')
+        self._migrate()
+
+        if self._db.execute('SELECT 1 FROM cursor').fetchone() is None:
+            legacy_state = self._import_legacy_state()
+        else:
+            legacy_state = 0
 
-        state = data['state']
         now = int(time())
+        self.cursors = {}
 
-        self.start_ts = max(now - STATE_MAX_BACKLOG, state)
-        self.end_ts = self.start_ts
-        self._rescheduled_issues = data.get('rescheduled_issues', {})
+        for region in REGIONS:
+            row = self._db.execute('SELECT state, density FROM cursor WHERE region = ?', (region.identifier,)).fetchone()
+            state, density = row if row is not None else (legacy_state, None)
+            start_ts = max(now - STATE_MAX_BACKLOG, state)
+            self.cursors[region.identifier] = Cursor(region=region, start_ts=start_ts, end_ts=start_ts, density=density)
 
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
+        # uncommitted changes are rolled back
+        self._db.close()
         self._fd.close()
 
-    def configure_end_ts(self, value: int) -> None:
-        self.end_ts = value
+    def _migrate(self) -> None:
+        version = self._db.execute('PRAGMA user_version').fetchone()[0]
 
-        if self.end_ts - self.start_ts > STATE_MAX_DIFF:
-            self.end_ts = self.start_ts + STATE_MAX_DIFF
+        for i, script in enumerate(MIGRATIONS[version:], version + 1):
+            self._db.executescript(f'BEGIN; {script}; PRAGMA user_version = {i}; COMMIT;')
+
+    def _import_legacy_state(self) -> int:
+        if not LEGACY_STATE_PATH.is_file():
+            return 0
+
+        with open(LEGACY_STATE_PATH) as f:
+            try:
+                data = json.load(f)
+                assert isinstance(data, dict)
+            except Exception:
+                f.seek(0)
+                data = {'state': int(f.read().strip())}
+
+        for cat, cat_issues in data.get('rescheduled_issues', {}).items():
+            for changeset_id, changeset_issues in cat_issues.items():
+                self.reschedule_issues(cat, int(changeset_id), {
+                    ALL_CHECKS_BY_ID[check_identifier]: [OverpassEntry(**d) for d in check_issues_d]
+                    for check_identifier, check_issues_d in changeset_issues.items()
+                })
+
+        print(f'📦 Imported legacy state from {LEGACY_STATE_PATH}')
+        return data['state']
 
     def merge_rescheduled_issues(self, cat: Identifier, issues: dict[int, dict[Check, list[OverpassEntry]]]) -> int:
-        cat_issues = self._rescheduled_issues.get(cat, {})
+        '''
+        Merge the rescheduled issues whose changesets may have been closed since.
+        Changesets that are already being processed in this run are always merged.
+        '''
+        now = int(time())
+        rows = self._db.execute(
+            'SELECT i.changeset_id, i.check_id, i.element_type, i.element_id, i.timestamp, i.tags, c.next_poll '
+            'FROM rescheduled_issue i LEFT JOIN rescheduled_changeset c USING (changeset_id) '
+            'WHERE i.category = ?', (cat,)).fetchall()
 
-        for changeset_id, changeset_issues in cat_issues.items():
-            changeset_id = int(changeset_id)
+        max_start_ts = max(c.start_ts for c in self.cursors.values())
+        changeset_ids = set()
+        waiting_ids = set()
 
-            for check_identifier, check_issues_d in changeset_issues.items():
-                check = next(c for c in ALL_CHECKS if c.identifier == check_identifier)
-                check_issues = [OverpassEntry(**d) for d in check_issues_d]
-                assert all(i.timestamp <= self.start_ts for i in check_issues)
-                issues[changeset_id][check].extend(check_issues)
+        for changeset_id, check_identifier, element_type, element_id, timestamp, tags, next_poll in rows:
+            assert timestamp <= max_start_ts
 
-        self._rescheduled_issues[cat] = {}
-        return len(cat_issues)
+            if next_poll is not None and next_poll > now and changeset_id not in issues:
+                waiting_ids.add(changeset_id)
+                continue
 
-    def reschedule_issues(self, cat: Identifier, changeset_id: int, issues: dict[Check, list[OverpassEntry]]) -> None:
-        self._rescheduled_issues.setdefault(cat, {})
-        self._rescheduled_issues[cat].setdefault(changeset_id, {})
+            issues[changeset_id][ALL_CHECKS_BY_ID[check_identifier]].append(OverpassEntry(
+                timestamp=timestamp,
+                changeset_id=changeset_id,
+                element_type=element_type,
+                element_id=element_id,
+                tags=json.loads(tags),
+                nodes=[],
+                bb_min=Point(0, 0),
+                bb_max=Point(0, 0),
+                bb_size=Size(0, 0),
+            ))
+
+            changeset_ids.add(changeset_id)
+
+        self._db.executemany(
+            'DELETE FROM rescheduled_issue WHERE category = ? AND changeset_id = ?',
+            ((cat, changeset_id) for changeset_id in changeset_ids))
+
+        if waiting_ids:
+            print(f'💤 Waiting for {len(waiting_ids)} open changeset{"" if len(waiting_ids) == 1 else "s"}')
+
+        return len(changeset_ids)
+
+    def schedule_poll(self, changeset: dict, last_activity: int) -> None:
+        '''
+        Remember when the open changeset should be polled again.
+        `last_activity` is the latest known edit timestamp in the changeset.
+        '''
+        now = int(time())
+        changeset_id = changeset['id']
+        created_at = parse_timestamp(changeset['created_at'])
+        changes_count = changeset['changes_count']
+
+        row = self._db.execute(
+            'SELECT last_activity, changes_count, polled_at FROM rescheduled_changeset WHERE changeset_id = ?',
+            (changeset_id,)).fetchone()
+
+        if row is not None:
+            last_activity = max(last_activity, row[0])
+
+            # edited since the last poll
+            if changes_count != row[1]:
+                last_activity = max(last_activity, row[2])
+
+        next_poll = predict_close(created_at, last_activity)
+
+        self._db.execute(
+            'INSERT OR REPLACE INTO rescheduled_changeset '
+            '(changeset_id, created_at, last_activity, changes_count, polled_at, next_poll) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (changeset_id, created_at, last_activity, changes_count, now, next_poll))
+
+    def _expire_rescheduled(self) -> None:
+        # the changeset was closed long ago, the feedback would be stale
+        expired = self._db.execute(
+            'SELECT changeset_id FROM rescheduled_changeset WHERE created_at < ?',
+            (int(time()) - CHANGESET_MAX_AGE - STATE_MAX_BACKLOG,)).fetchall()
+
+        if expired:
+            print(f'🗑️ Expired {len(expired)} rescheduled changeset{"" if len(expired) == 1 else "s"}')
+            self._db.executemany('DELETE FROM rescheduled_issue WHERE changeset_id = ?', expired)
+            self._db.executemany('DELETE FROM deferred_issue WHERE changeset_id = ?', expired)
+
+        self._db.execute(
+            'DELETE FROM deferred_issue WHERE timestamp < ?',
+            (int(time()) - CHANGESET_MAX_AGE - STATE_MAX_BACKLOG,))
+
+        self._db.execute(
+            'DELETE FROM rescheduled_changeset '
+            'WHERE changeset_id NOT IN (SELECT changeset_id FROM rescheduled_issue) '
+            'AND changeset_id NOT IN (SELECT changeset_id FROM deferred_issue)')
 
+    def reschedule_issues(self, cat: Identifier, changeset_id: int, issues: dict[Check, list[OverpassEntry]]) -> None:
         for check, check_issues in issues.items():
             assert all(changeset_id == i.changeset_id for i in check_issues)
-            self._rescheduled_issues[cat][changeset_id] \
-                .setdefault(check.identifier, []) \
-                .extend(asdict(i) for i in check_issues)
+
+            self._db.executemany(
+                'INSERT OR REPLACE INTO rescheduled_issue '
+                '(category, changeset_id, check_id, element_type, element_id, timestamp, tags) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)', (
+                    (cat, changeset_id, check.identifier, i.element_type, i.element_id, i.timestamp,
+                     json.dumps(_needed_tags(cat, check, i.tags), separators=(',', ':')))
+                    for i in check_issues
+                ))
+
+    def defer_issues(self, cat: Identifier, issues: dict[Check, list[OverpassEntry]]) -> None:
+        '''
+        Postpone the issues that were not post-filtered in time to the next run.
+        Unlike the rescheduled issues, they are stored in full to be post-filtered later.
+        '''
+        for check, check_issues in issues.items():
+            self._db.executemany(
+                'INSERT OR REPLACE INTO deferred_issue '
+                '(category, check_id, element_type, element_id, changeset_id, timestamp, tags, '
+                'min_lat, min_lon, max_lat, max_lon, width, height) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', (
+                    (cat, check.identifier, i.element_type, i.element_id, i.changeset_id, i.timestamp,
+                     json.dumps(i.tags, separators=(',', ':')), *i.bb_min, *i.bb_max, *i.bb_size)
+                    for i in check_issues
+                ))
+
+    def merge_deferred_issues(self, cat: Identifier, issues: dict[Check, list[OverpassEntry]]) -> int:
+        '''
+        Merge the issues deferred by the previous runs, the freshly queried ones take precedence.
+        Issues of the open changesets wait for the next poll, unless the changeset is being processed in this run.
+        '''
+        now = int(time())
+        rows = self._db.execute(
+            'SELECT i.check_id, i.element_type, i.element_id, i.changeset_id, i.timestamp, i.tags, '
+            'i.min_lat, i.min_lon, i.max_lat, i.max_lon, i.width, i.height, c.next_poll '
+            'FROM deferred_issue i LEFT JOIN rescheduled_changeset c USING (changeset_id) '
+            'WHERE i.category = ?', (cat,)).fetchall()
+
+        known = {check: set(check_issues) for check, check_issues in issues.items()}
+        running_ids = {i.changeset_id for check_issues in issues.values() for i in check_issues}
+        changeset_ids = set()
+        merged = 0
+
+        for (check_identifier, element_type, element_id, changeset_id, timestamp, tags,
+             min_lat, min_lon, max_lat, max_lon, width, height, next_poll) in rows:
+            if next_poll is not None and next_poll > now and changeset_id not in running_ids:
+                continue
+
+            changeset_ids.add(changeset_id)
+            check = ALL_CHECKS_BY_ID[check_identifier]
+            entry = OverpassEntry(
+                timestamp=timestamp,
+                changeset_id=changeset_id,
+                element_type=element_type,
+                element_id=element_id,
+                tags=json.loads(tags),
+                nodes=[],
+                bb_min=Point(min_lat, min_lon),
+                bb_max=Point(max_lat, max_lon),
+                bb_size=Size(width, height),
+            )
+
+            if entry not in known.setdefault(check, set()):
+                known[check].add(entry)
+                issues.setdefault(check, []).append(entry)
+                merged += 1
+
+        self._db.executemany(
+            'DELETE FROM deferred_issue WHERE category = ? AND changeset_id = ?',
+            ((cat, changeset_id) for changeset_id in changeset_ids))
+
+        return merged
+
+    def load_history(self) -> dict[tuple[ElementType, int, int], Tags | None]:
+        '''
+        Load the element versions preceding the edits, as fetched by the previous runs.
+        '''
+        history = {
+            (element_type, element_id, timestamp): json.loads(tags) if tags is not None else None
+            for element_type, element_id, timestamp, tags in self._db.execute(
+                'SELECT element_type, element_id, timestamp, tags FROM element_history')
+        }
+
+        self._history_keys = set(history)
+        return history
+
+    def save_history(self, history: dict[tuple[ElementType, int, int], Tags | None]) -> None:
+        self._db.executemany(
+            'INSERT OR IGNORE INTO element_history (element_type, element_id, timestamp, tags) VALUES (?, ?, ?, ?)',
+            ((*key, json.dumps(tags, separators=(',', ':')) if tags is not None else None)
+             for key, tags in history.items() if key not in self._history_keys))
+
+        # edits this old are no longer queried
+        self._db.execute(
+            'DELETE FROM element_history WHERE timestamp < ?',
+            (int(time()) - CHANGESET_MAX_AGE - STATE_MAX_BACKLOG,))
 
     # TODO:
     # def add_to_summary(self, changeset_id: int, issues: dict[Check, list[OverpassEntry]]) -> None:
@@ -87,10 +411,9 @@ class State:
     #             .extend(asdict(i) for i in check_issues)
 
     def write_state(self):
-        self._fd.seek(0)
-        self._fd.truncate(0)
+        self._expire_rescheduled()
+        self._db.executemany(
+            'INSERT OR REPLACE INTO cursor (region, state, density) VALUES (?, ?, ?)',
+            ((identifier, c.end_ts, c.density) for identifier, c in self.cursors.items()))
 
-        json.dump({
-            'state': self.end_ts,
-            'rescheduled_issues': self._rescheduled_issues
-        }, self._fd, indent=2)
+        self._db.commit()
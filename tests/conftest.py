@@ -0,0 +1,72 @@
+import json
+import socket
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+
+import pytest
+
+from utils import format_timestamp
+
+
+class OverpassStandIn:
+    '''
+    A local Overpass interpreter answering every query with the given status and database state.
+    '''
+
+    def __init__(self, timestamp_osm_base: int, status: int = 200):
+        self.timestamp_osm_base = timestamp_osm_base
+        self.status = status
+        self.requests = 0
+
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers['Content-Length']))
+                stand_in.requests += 1
+
+                body = json.dumps({
+                    'osm3s': {'timestamp_osm_base': format_timestamp(stand_in.timestamp_osm_base)},
+                    'elements': [],
+                }).encode()
+
+                self.send_response(stand_in.status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_port}/api/interpreter'
+        Thread(target=self.server.serve_forever, args=(0.05,), daemon=True).start()
+
+    def close(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def overpass_stand_in():
+    stand_ins = []
+
+    def factory(timestamp_osm_base: int, status: int = 200) -> OverpassStandIn:
+        stand_ins.append(OverpassStandIn(timestamp_osm_base, status))
+        return stand_ins[-1]
+
+    yield factory
+
+    for s in stand_ins:
+        s.close()
+
+
+@pytest.fixture
+def down_url() -> str:
+    # nothing listens on a port that was just released
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+
+    return f'http://127.0.0.1:{port}/api/interpreter'
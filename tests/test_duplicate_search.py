@@ -0,0 +1,136 @@
+import random
+from types import SimpleNamespace
+
+import pytest
+
+from duplicate_search import EQUAL_TAGS, AddressIndex, bbox_distance, check_whitelist, duplicate_search_many
+from overpass import _local_duplicates
+from overpass_entry import OverpassEntry, Point, Size
+
+
+def pairwise_duplicate_search(entry: OverpassEntry, ref: list[OverpassEntry]) -> list[OverpassEntry]:
+    '''
+    The original pairwise scan, the reference for the index.
+    '''
+    return [
+        e for e in ref
+        if e != entry
+        and check_whitelist(e.tags)
+        and all(e.tags.get(t, None) == entry.tags.get(t, None) for t in EQUAL_TAGS)
+    ]
+
+
+def random_entries(rng: random.Random, n: int) -> list[OverpassEntry]:
+    entries = []
+
+    for element_id in range(1, n + 1):
+        tags = {'addr:housenumber': rng.choice('12')} if rng.random() < 0.9 else {}
+
+        if rng.random() < 0.7:
+            tags['addr:street'] = rng.choice(('Foo', 'Bar'))
+        else:
+            tags['addr:place'] = rng.choice(('Foo', 'Baz'))
+
+        if rng.random() < 0.3:
+            tags['addr:unit'] = 'A'
+        if rng.random() < 0.2:
+            tags[rng.choice(('building', 'name', 'shop', 'amenity'))] = 'yes'
+
+        lat = 52 + rng.random() * 0.02
+        lon = 21 + rng.random() * 0.02
+        span = rng.choice((0, 0.0005))
+
+        entries.append(OverpassEntry(
+            timestamp=0,
+            changeset_id=1,
+            element_type=rng.choice(('node', 'way')),
+            element_id=element_id,
+            tags=tags,
+            nodes=[],
+            bb_min=Point(lat, lon),
+            bb_max=Point(lat + span, lon + span),
+            bb_size=Size(0, 0),
+        ))
+
+    return entries
+
+
+def uids(entries: list[OverpassEntry]) -> list[int]:
+    return sorted(e.uid for e in entries)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_duplicate_search_many_matches_pairwise_scan(seed):
+    rng = random.Random(seed)
+    entries = random_entries(rng, 200)
+    issues = [e for e in entries if 'addr:housenumber' in e.tags][:50]
+    pairs = [(issue, rng.sample(entries, 40) + [issue]) for issue in issues]
+
+    for (entry, ref), result in zip(pairs, duplicate_search_many(pairs)):
+        assert uids(result) == uids(pairwise_duplicate_search(entry, ref))
+
+        # the entries of the own references are returned
+        assert all(any(r is e for r in ref) for e in result)
+
+
+@pytest.mark.parametrize('radius', (0, 50, 500))
+def test_address_index_matches_pairwise_scan_within_radius(radius):
+    entries = random_entries(random.Random(radius), 300)
+    index = AddressIndex(entries, cell_size=0.005)
+
+    for entry in entries:
+        expected = [
+            e for e in pairwise_duplicate_search(entry, entries)
+            if 'addr:housenumber' in e.tags and bbox_distance(entry, e) <= radius
+        ]
+
+        assert uids(index.search(entry, radius)) == uids(expected)
+
+
+def test_address_index_spans_cell_borders():
+    def make_entry(element_id: int, lat: float) -> OverpassEntry:
+        return OverpassEntry(
+            timestamp=0,
+            changeset_id=1,
+            element_type='node',
+            element_id=element_id,
+            tags={'addr:housenumber': '1', 'addr:street': 'Foo'},
+            nodes=[],
+            bb_min=Point(lat, 21),
+            bb_max=Point(lat, 21),
+            bb_size=Size(0, 0),
+        )
+
+    left, right = make_entry(1, 51.9999), make_entry(2, 52.0001)
+    index = AddressIndex([left, right], cell_size=0.01)
+
+    assert index.search(left, 50) == [right]
+    assert index.search(left, 10) == []
+
+
+def test_local_duplicates_are_within_the_query_radius():
+    def make_entry(element_id: int, element_type: str, span: float, changeset_id: int = 1) -> OverpassEntry:
+        return OverpassEntry(
+            timestamp=0,
+            changeset_id=changeset_id,
+            element_type=element_type,
+            element_id=element_id,
+            tags={'addr:housenumber': '1', 'addr:street': 'Foo'},
+            nodes=[],
+            bb_min=Point(52 - span, 21 - span),
+            bb_max=Point(52 + span, 21 + span),
+            bb_size=Size(span * 2 * 68_000, span * 2 * 111_000),
+        )
+
+    issue = make_entry(1, 'node', 0)
+    building = make_entry(2, 'way', 0.0002, changeset_id=2)
+    overpass = SimpleNamespace(changed_index=AddressIndex([issue, building]))
+
+    result, remaining = _local_duplicates(overpass, [issue])
+    assert (uids(result), remaining) == (uids([issue, building]), [])
+
+    # the outline of a large building may be far from the node inside, the query decides
+    large_building = make_entry(2, 'way', 0.005)
+    overpass = SimpleNamespace(changed_index=AddressIndex([issue, large_building]))
+
+    assert _local_duplicates(overpass, [issue]) == ([], [issue])
@@ -0,0 +1,83 @@
+import time
+from types import SimpleNamespace
+
+from checks import ALL_CATEGORIES_BY_ID, ALL_CHECKS_BY_ID
+from main import filter_post_fn, notify
+from overpass_entry import OverpassEntry, Point, Size
+
+DUPLICATED = ALL_CHECKS_BY_ID['DUPLICATED']
+BAD_POSTCODE_FORMAT = ALL_CHECKS_BY_ID['BAD_POSTCODE_FORMAT']
+
+
+def make_entry(element_id: int, changeset_id: int) -> OverpassEntry:
+    return OverpassEntry(
+        timestamp=0,
+        changeset_id=changeset_id,
+        element_type='node',
+        element_id=element_id,
+        tags={'addr:housenumber': '1', 'addr:postcode': '123'},
+        nodes=[],
+        bb_min=Point(52, 21),
+        bb_max=Point(52, 21),
+        bb_size=Size(0, 0),
+    )
+
+
+class OverpassStub:
+    '''
+    Resolves the post queries of the changesets in `resolved_ids`, the others run out of time.
+    '''
+
+    def __init__(self, resolved_ids: set[int]):
+        self.resolved_ids = resolved_ids
+
+    def query_fused(self, tasks, deadline=None):
+        return ([[i for i in issues if i.changeset_id in self.resolved_ids] for _, issues in tasks],
+                [[i for i in issues if i.changeset_id not in self.resolved_ids] for _, issues in tasks])
+
+
+def test_deferred_changesets_are_deferred_whole():
+    resolved, unresolved = make_entry(1, 1), make_entry(2, 2)
+    other_resolved, other_unresolved = make_entry(3, 1), make_entry(4, 2)
+    issues = {DUPLICATED: [resolved, unresolved], BAD_POSTCODE_FORMAT: [other_resolved, other_unresolved]}
+
+    deferred = filter_post_fn(OverpassStub({1}), issues)
+
+    assert issues == {DUPLICATED: [resolved], BAD_POSTCODE_FORMAT: [other_resolved]}
+    assert deferred == {DUPLICATED: [unresolved], BAD_POSTCODE_FORMAT: [other_unresolved]}
+
+
+def test_nothing_deferred():
+    issues = {DUPLICATED: [make_entry(1, 1)], BAD_POSTCODE_FORMAT: [make_entry(2, 2)]}
+    expected = {c: list(i) for c, i in issues.items()}
+
+    assert filter_post_fn(OverpassStub({1, 2}), issues) == {}
+    assert issues == expected
+
+
+def test_notify_stops_the_running_verifications_past_the_deadline():
+    deadline = time.monotonic() + 0.1
+    requests = []
+
+    def get_changeset(changeset_id):
+        requests.append(changeset_id)
+        time.sleep(0.2)
+        return {'id': changeset_id, 'open': False, 'uid': 1}
+
+    def is_editing_tags(cat, issues):
+        requests.append('is_editing_tags')
+        return True
+
+    osm = SimpleNamespace(get_changeset=get_changeset)
+    overpass = SimpleNamespace(is_editing_tags=is_editing_tags)
+    rescheduled = []
+    s = SimpleNamespace(reschedule_issues=lambda cat, changeset_id, issues: rescheduled.append(changeset_id))
+    groups = {changeset_id: {BAD_POSTCODE_FORMAT: [make_entry(changeset_id, changeset_id)]}
+              for changeset_id in range(1, 11)}
+
+    notify(osm, overpass, None, s, ALL_CATEGORIES_BY_ID['ADDRESS'], groups, deadline)
+
+    # only the first round of requests was made
+    assert 'is_editing_tags' not in requests
+    assert len(requests) < len(groups)
+    assert sorted(rescheduled) == list(groups)
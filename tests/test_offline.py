@@ -0,0 +1,192 @@
+import struct
+import zlib
+from pathlib import Path
+
+import pytest
+
+from offline import OfflineStore
+from overpass_entry import OverpassEntry, Point, Size
+from pbf import PbfElement, PbfHeader, read_pbf
+
+# lat, lon
+NODES = {
+    1: (52.0, 21.0),
+    2: (52.0002, 21.0002), 3: (52.0002, 21.0004), 4: (52.0004, 21.0004), 5: (52.0004, 21.0002),
+    6: (52.001, 21.0), 7: (52.001, 21.001),
+    8: (53.0, 22.0),
+    9: (51.99, 20.99), 10: (51.99, 21.01), 11: (52.01, 21.01), 12: (52.01, 20.99),
+}
+
+NODE_TAGS = {
+    1: {'addr:housenumber': '1', 'addr:street': 'Foo'},
+    8: {'place': 'village', 'name': 'Far'},
+}
+
+WAYS = {
+    10: ([2, 3, 4, 5, 2], {'building': 'yes', 'addr:housenumber': '1', 'addr:street': 'Foo'}),
+    11: ([6, 7], {'highway': 'residential', 'name': 'Foo'}),
+    12: ([9, 10, 11, 12, 9], {}),
+}
+
+RELATIONS = {
+    20: ([('way', 12, 'outer')], {'type': 'multipolygon', 'place': 'village', 'name': 'Wieś'}),
+}
+
+
+def varint(value: int) -> bytes:
+    result = b''
+
+    while True:
+        b = value & 0x7F
+        value >>= 7
+
+        if not value:
+            return result + bytes((b,))
+
+        result += bytes((b | 0x80,))
+
+
+def zigzag(value: int) -> int:
+    return value << 1 if value >= 0 else (-value << 1) - 1
+
+
+def field(number: int, value: int | bytes) -> bytes:
+    if isinstance(value, int):
+        return varint(number << 3) + varint(value)
+
+    return varint(number << 3 | 2) + varint(len(value)) + value
+
+
+def packed(values: list[int]) -> bytes:
+    return b''.join(varint(v) for v in values)
+
+
+def packed_delta(values: list[int]) -> bytes:
+    return packed([zigzag(v - p) for v, p in zip(values, [0, *values])])
+
+
+def blob(blob_type: str, data: bytes, *, compress: bool) -> bytes:
+    body = field(2, len(data)) + field(3, zlib.compress(data)) if compress else field(1, data)
+    header = field(1, blob_type.encode()) + field(3, len(body))
+    return struct.pack('>I', len(header)) + header + body
+
+
+def write_pbf(path: Path, *, replication: tuple[int, str] | None = None) -> None:
+    strings = ['']
+
+    def sid(s: str) -> int:
+        if s not in strings:
+            strings.append(s)
+        return strings.index(s)
+
+    node_ids = sorted(NODES)
+    keys_vals = []
+
+    for n in node_ids:
+        for k, v in NODE_TAGS.get(n, {}).items():
+            keys_vals += [sid(k), sid(v)]
+        keys_vals.append(0)
+
+    dense = field(1, packed_delta(node_ids)) + \
+        field(8, packed_delta([round(NODES[n][0] * 10_000_000) for n in node_ids])) + \
+        field(9, packed_delta([round(NODES[n][1] * 10_000_000) for n in node_ids])) + \
+        field(10, packed(keys_vals))
+
+    ways = b''.join(field(3, field(1, way_id) +
+                             field(2, packed([sid(k) for k in tags])) +
+                             field(3, packed([sid(v) for v in tags.values()])) +
+                             field(8, packed_delta(refs)))
+                    for way_id, (refs, tags) in WAYS.items())
+
+    relations = b''.join(field(4, field(1, relation_id) +
+                                  field(2, packed([sid(k) for k in tags])) +
+                                  field(3, packed([sid(v) for v in tags.values()])) +
+                                  field(8, packed([sid(role) for _, _, role in members])) +
+                                  field(9, packed_delta([ref for _, ref, _ in members])) +
+                                  field(10, packed([('node', 'way', 'relation').index(t) for t, _, _ in members])))
+                         for relation_id, (members, tags) in RELATIONS.items())
+
+    block = field(1, b''.join(field(1, s.encode()) for s in strings)) + \
+        field(2, field(2, dense)) + field(2, ways) + field(2, relations)
+
+    header = field(4, b'OsmSchema-V0.6') + field(4, b'DenseNodes')
+
+    if replication is not None:
+        header += field(33, replication[0]) + field(34, replication[1].encode())
+
+    path.write_bytes(blob('OSMHeader', header, compress=False) + blob('OSMData', block, compress=True))
+
+
+def make_issue(element_type: str, lat: float, lon: float) -> OverpassEntry:
+    return OverpassEntry(
+        timestamp=0,
+        changeset_id=1,
+        element_type=element_type,
+        element_id=100,
+        tags={'addr:housenumber': '1', 'addr:street': 'Foo', 'addr:place': 'Wieś'},
+        nodes=[],
+        bb_min=Point(lat, lon),
+        bb_max=Point(lat, lon),
+        bb_size=Size(0, 0),
+    )
+
+
+def test_read_pbf(tmp_path):
+    path = tmp_path / 'extract.osm.pbf'
+    write_pbf(path, replication=(1234, 'https://example.com/replication/minute'))
+
+    header, elements = read_pbf(path)
+    elements = {(e.type, e.id): e for e in elements}
+
+    assert header == PbfHeader(replication_sequence=1234, replication_url='https://example.com/replication/minute')
+    assert len(elements) == len(NODES) + len(WAYS) + len(RELATIONS)
+
+    for node_id, (lat, lon) in NODES.items():
+        e = elements[('node', node_id)]
+        assert (e.lat, e.lon) == (pytest.approx(lat), pytest.approx(lon))
+        assert e.tags == NODE_TAGS.get(node_id, {})
+
+    for way_id, (refs, tags) in WAYS.items():
+        assert elements[('way', way_id)] == PbfElement(type='way', id=way_id, tags=tags, nodes=tuple(refs))
+
+    assert elements[('relation', 20)] == PbfElement(type='relation', id=20, tags=RELATIONS[20][1],
+                                                    members=(('way', 12, 'outer'),))
+
+
+@pytest.fixture
+def store(tmp_path) -> OfflineStore:
+    path = tmp_path / 'extract.osm.pbf'
+    write_pbf(path)
+
+    store = OfflineStore(tmp_path / 'offline.db')
+    store.sync(path)
+    return store
+
+
+def test_query_fused(store):
+    node_issue = make_issue('node', 52.0, 21.0)
+    way_issue = make_issue('way', 52.0003, 21.0003)
+    tasks = {0: ('duplicates', None), 1: ('street_names', 500), 2: ('place_mistype', None)}
+
+    sections = dict(store.query_fused([([node_issue], [0, 1, 2]), ([way_issue], [0])], tasks))
+
+    def ids(t: int, issue: OverpassEntry) -> list[tuple[str, int]]:
+        return sorted((e['type'], e['id']) for e in sections[(t, (issue.uid,))])
+
+    # the other kind only
+    assert ids(0, node_issue) == [('way', 10)]
+    assert ids(0, way_issue) == [('node', 1)]
+
+    assert ids(1, node_issue) == [('way', 11)]
+    assert ids(2, node_issue) == [('relation', 20)]
+    assert sections[(2, (node_issue.uid,))][0]['tags']['name'] == 'Wieś'
+
+
+def test_query_fused_radius(store):
+    # about 220 m from the street
+    far_issue = make_issue('node', 52.003, 21.0005)
+
+    sections = dict(store.query_fused([([far_issue], [0, 1])], {0: ('street_names', 500), 1: ('street_names', 50)}))
+
+    assert [e['id'] for e in sections[(0, (far_issue.uid,))]] == [11]
+    assert sections[(1, (far_issue.uid,))] == []
@@ -0,0 +1,36 @@
+import pytest
+
+import outbox
+from outbox import Outbox
+
+
+@pytest.fixture(autouse=True)
+def outbox_path(tmp_path, monkeypatch):
+    monkeypatch.setattr(outbox, 'OUTBOX_PATH', tmp_path / 'outbox.db')
+    return tmp_path / 'outbox.db'
+
+
+def test_dry_run_writes_nothing(outbox_path, monkeypatch):
+    monkeypatch.setattr(outbox, 'DRY_RUN', True)
+
+    with Outbox() as o:
+        assert o.put('ADDRESS', 1, 'text')
+        assert o.lease() is None
+
+    assert not outbox_path.exists()
+
+
+def test_message_is_put_once(monkeypatch):
+    monkeypatch.setattr(outbox, 'DRY_RUN', False)
+
+    with Outbox() as o:
+        assert o.put('ADDRESS', 1, 'text')
+        assert not o.put('ADDRESS', 1, 'other text')
+
+        message = o.lease()
+        assert (message.changeset_id, message.text, message.attempts) == (1, 'text', 1)
+
+        # leased until sent
+        assert o.lease() is None
+        o.sent(message)
+        assert o.lease() is None
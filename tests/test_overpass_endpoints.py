@@ -0,0 +1,109 @@
+import pytest
+
+import overpass
+from overpass import Overpass
+from overpass_cache import OverpassCache
+from overpass_endpoints import EndpointPool
+
+BASE = 1_700_000_000
+QUERY = '[out:json][timeout:30];'
+
+
+@pytest.fixture(autouse=True)
+def no_busy_retries(monkeypatch):
+    monkeypatch.setattr(overpass, 'OVERPASS_BUSY_RETRIES', 0)
+
+
+def make_overpass(*urls: str) -> Overpass:
+    o = Overpass()
+    o.endpoints = EndpointPool(urls)
+    return o
+
+
+def test_probe_skips_down_endpoint_and_picks_freshest(overpass_stand_in, down_url):
+    lagging = overpass_stand_in(BASE - 600)
+    fresh = overpass_stand_in(BASE)
+    o = make_overpass(down_url, lagging.url, fresh.url)
+
+    assert o.get_timestamp_osm_base() == BASE
+
+    down, *_ = o.endpoints.endpoints
+    assert down.consecutive_errors == 1
+    assert down.timestamp_osm_base is None
+
+
+def test_lagging_endpoint_serves_only_older_windows(overpass_stand_in):
+    lagging = overpass_stand_in(BASE - 600)
+    fresh = overpass_stand_in(BASE)
+    o = make_overpass(lagging.url, fresh.url)
+    o.get_timestamp_osm_base()
+
+    # make the lagging endpoint the preferred one otherwise
+    lagging_endpoint, fresh_endpoint = o.endpoints.endpoints
+    lagging_endpoint.latency = 0.001
+    fresh_endpoint.latency = 10
+    lagging.requests = fresh.requests = 0
+
+    o.end_ts = BASE - 60
+    o._post(QUERY, 30)
+    assert (lagging.requests, fresh.requests) == (0, 1)
+
+    o.end_ts = BASE - 900
+    o._post(QUERY, 30)
+    assert (lagging.requests, fresh.requests) == (1, 1)
+
+
+def test_failover_from_failing_endpoint(overpass_stand_in):
+    failing = overpass_stand_in(BASE, status=504)
+    fresh = overpass_stand_in(BASE)
+    o = make_overpass(failing.url, fresh.url)
+
+    data = o._post(QUERY, 30)
+    assert data['osm3s']['timestamp_osm_base'] == '2023-11-14T22:13:20Z'
+    assert (failing.requests, fresh.requests) == (1, 1)
+
+    # backed off, the next query goes straight to the healthy endpoint
+    failing_endpoint, fresh_endpoint = o.endpoints.endpoints
+    assert o.endpoints.candidates() == [fresh_endpoint, failing_endpoint]
+
+    o._post(QUERY, 30)
+    assert (failing.requests, fresh.requests) == (1, 2)
+
+
+def test_no_endpoint_fresh_enough(overpass_stand_in):
+    lagging = overpass_stand_in(BASE - 600)
+    o = make_overpass(lagging.url)
+    o.get_timestamp_osm_base()
+    o.end_ts = BASE
+
+    with pytest.raises(AssertionError, match='fresh enough'):
+        o._post(QUERY, 30)
+
+
+def test_dry_run_replays_only_fresh_enough_state(overpass_stand_in, tmp_path, monkeypatch):
+    monkeypatch.setattr(overpass, 'DRY_RUN', True)
+    fresh = overpass_stand_in(BASE)
+    o = make_overpass(fresh.url)
+    o.cache = OverpassCache(tmp_path, 1024 * 1024)
+    o.cache.set_timestamp_osm_base(BASE - 600)
+
+    assert o.get_timestamp_osm_base(BASE - 900) == BASE - 600
+    assert fresh.requests == 0
+
+    # behind the cursors, refreshed
+    assert o.get_timestamp_osm_base(BASE - 300) == BASE
+    assert o.cache.get_timestamp_osm_base() == BASE
+    assert fresh.requests == 1
+
+
+def test_busy_endpoint_is_retried(overpass_stand_in, monkeypatch):
+    monkeypatch.setattr(overpass, 'OVERPASS_BUSY_RETRIES', 2)
+    monkeypatch.setattr(overpass, 'OVERPASS_BUSY_BACKOFF', 0)
+    busy = overpass_stand_in(BASE, status=429)
+    o = make_overpass(busy.url)
+
+    with pytest.raises(Exception) as e:
+        o._post(QUERY, 30)
+
+    assert overpass.status_code(e.value) == 429
+    assert busy.requests == 3
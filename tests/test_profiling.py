@@ -0,0 +1,22 @@
+import tracemalloc
+
+import profiling
+
+
+def test_stage_names_are_kept(tmp_path, monkeypatch):
+    monkeypatch.setattr(profiling, 'PROFILE_DIR', tmp_path)
+    monkeypatch.setattr(profiling, '_seq', 0)
+
+    try:
+        with profiling.profile_stage('ADDRESS.map_checks'):
+            with profiling.profile_stage('ADDRESS.notify'):
+                pass
+    finally:
+        tracemalloc.stop()
+
+    assert sorted(p.name for p in tmp_path.iterdir()) == [
+        '001-ADDRESS.map_checks.prof',
+        '001-ADDRESS.map_checks.snapshot',
+        '002-ADDRESS.notify.snapshot',
+        'summary.tsv',
+    ]
@@ -0,0 +1,91 @@
+import re
+from itertools import chain, combinations
+
+import pytest
+
+from checks import OVERPASS_CATEGORIES
+from config import REGIONS
+from overpass import _build_filter, build_query, compile_selectors
+from region import Region
+
+FILTER_RE = re.compile(r'\["((?:[^"\\]|\\.)*)"\]|\[~"((?:[^"\\]|\\.)*)"~"\."\]')
+
+# every selected key, with the wildcards made concrete, and some unrelated ones
+KEYS = sorted({
+    s.replace('*', 'x')
+    for c in chain(OVERPASS_CATEGORIES, *(cat.checks for cat in OVERPASS_CATEGORIES))
+    if isinstance(c.selectors, tuple)
+    for s in c.selectors
+} | {'addr:x', 'amenity', 'building'})
+
+
+def unescape(s: str) -> str:
+    return re.sub(r'\\(.)', r'\1', s)
+
+
+def filter_matches(f: str, tags: dict) -> bool:
+    '''
+    Evaluate an Overpass tag filter the way the server does.
+    '''
+    assert ''.join(m.group() for m in FILTER_RE.finditer(f)) == f, f'Unexpected filter {f!r}'
+
+    for key, pattern in FILTER_RE.findall(f):
+        if key and unescape(key) not in tags:
+            return False
+        if pattern and not any(re.search(unescape(pattern), k) for k in tags):
+            return False
+
+    return True
+
+
+def selecting_checks(region: Region, tags: dict) -> list:
+    return [
+        check
+        for cat in OVERPASS_CATEGORIES if region.has_category(cat.identifier)
+        if not cat.selectors or cat.is_selected(tags)
+        for check in cat.checks if check.is_selected(tags)
+    ]
+
+
+@pytest.mark.parametrize('region', [
+    REGIONS[0],
+    Region(identifier='T', relation=1, bbox=REGIONS[0].bbox, categories=('SYNTAX', 'TAGS_COMBINATION')),
+], ids=['all', 'subset'])
+def test_filters_select_exactly_the_checked_elements(region):
+    bbox_filters, filters = compile_selectors(region)
+
+    for n in range(4):
+        for keys in combinations(KEYS, n):
+            tags = dict.fromkeys(keys, 'v')
+            checks = selecting_checks(region, tags)
+
+            assert any(filter_matches(f, tags) for f in bbox_filters + filters) == bool(checks), tags
+
+            # the post-filtered checks need the bounding box
+            if any(c.has_post for c in checks):
+                assert any(filter_matches(f, tags) for f in bbox_filters), tags
+
+
+def test_filters_skip_excluded_categories():
+    region = Region(identifier='T', relation=1, bbox=REGIONS[0].bbox, categories=('SYNTAX',))
+    bbox_filters, filters = compile_selectors(region)
+
+    assert bbox_filters == []
+    assert sorted(filters) == ['["contact:website"]', '["url"]', '["website"]']
+
+
+def test_build_filter():
+    assert _build_filter(('addr:city',), ('addr:*', 'name:*')) == '["addr:city"][~"^name:.*$"~"."]'
+    assert _build_filter(('a"b',), ()) == '["a\\"b"]'
+    assert filter_matches(_build_filter((), ('name:*',)), {'name:pl': 'x'})
+    assert not filter_matches(_build_filter((), ('name:*',)), {'old_name:pl': 'x'})
+
+
+def test_build_query_selects_by_filter():
+    query = build_query(1_700_000_000, 1_700_000_060, timeout=300, relation=49715, bbox=REGIONS[0].bbox,
+                        filters=(['["addr:housenumber"]'], ['["website"]']))
+
+    assert 'nwr(changed:"2023-11-14T22:13:20Z","2023-11-14T22:14:20Z")(area)->.c;' in query
+    assert '(nwr.c["addr:housenumber"];)->.b;' in query
+    assert '((nwr.c["website"];); - .b;)->.m;' in query
+    assert query.endswith('.b out meta bb;.m out meta;')
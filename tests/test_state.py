@@ -0,0 +1,197 @@
+import json
+import sqlite3
+from time import time
+
+import pytest
+
+import state
+from checks import ALL_CHECKS_BY_ID
+from config import CHANGESET_IDLE_TIMEOUT, CHANGESET_MAX_AGE, STATE_MAX_BACKLOG
+from overpass_entry import OverpassEntry, Point, Size
+from state import MIGRATIONS, State, predict_close
+from utils import format_timestamp, group_by_changeset
+
+CATEGORY = 'ADDRESS'
+CHECK = ALL_CHECKS_BY_ID['BAD_POSTCODE_FORMAT']
+TAGS = {'addr:housenumber': '1', 'addr:postcode': '123', 'name': 'Foo'}
+
+
+@pytest.fixture(autouse=True)
+def state_dir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(state, 'STATE_PATH', tmp_path / 'state.db')
+    monkeypatch.setattr(state, 'LEGACY_STATE_PATH', tmp_path / 'state.json')
+    return tmp_path
+
+
+def make_entry(element_id: int, changeset_id: int, timestamp: int) -> OverpassEntry:
+    return OverpassEntry(
+        timestamp=timestamp,
+        changeset_id=changeset_id,
+        element_type='node',
+        element_id=element_id,
+        tags=TAGS,
+        nodes=[],
+        bb_min=Point(52.0, 21.0),
+        bb_max=Point(52.1, 21.1),
+        bb_size=Size(10, 20),
+    )
+
+
+def past_timestamp(s: State) -> int:
+    # the rescheduled issues always precede the cursors
+    return min(c.start_ts for c in s.cursors.values()) - 60
+
+
+def make_changeset(changeset_id: int, created_at: int, changes_count: int = 1) -> dict:
+    return {'id': changeset_id, 'created_at': format_timestamp(created_at), 'changes_count': changes_count}
+
+
+def test_migrates_from_meta_cursor(state_dir):
+    db = sqlite3.connect(state_dir / 'state.db')
+    db.executescript(f'{MIGRATIONS[0]}; {MIGRATIONS[1]}; PRAGMA user_version = 2;')
+    db.executemany('INSERT INTO meta (key, value) VALUES (?, ?)', (('state', 1_700_000_000), ('density', 0.5)))
+    db.commit()
+    db.close()
+
+    with State() as s:
+        assert s._db.execute('PRAGMA user_version').fetchone()[0] == len(MIGRATIONS)
+        assert s._db.execute('SELECT region, state, density FROM cursor').fetchall() == [('PL', 1_700_000_000, 0.5)]
+        assert s._db.execute('SELECT * FROM meta').fetchall() == []
+        assert s.cursors['PL'].density == 0.5
+
+
+def test_imports_legacy_state(state_dir):
+    timestamp = int(time()) - 60
+    (state_dir / 'state.json').write_text(json.dumps({
+        'state': timestamp,
+        'rescheduled_issues': {CATEGORY: {'7': {CHECK.identifier: [
+            {'timestamp': timestamp - 60, 'changeset_id': 7, 'element_type': 'node', 'element_id': 1, 'tags': TAGS,
+             'nodes': [], 'bb_min': [0, 0], 'bb_max': [0, 0], 'bb_size': [0, 0]},
+        ]}}},
+    }))
+
+    with State() as s:
+        assert s.cursors['PL'].start_ts == timestamp
+        assert s._db.execute('SELECT changeset_id, element_id FROM rescheduled_issue').fetchall() == [(7, 1)]
+
+
+def test_rescheduled_issues_are_merged_once():
+    with State() as s:
+        timestamp = past_timestamp(s)
+        s.reschedule_issues(CATEGORY, 7, {CHECK: [make_entry(1, 7, timestamp), make_entry(2, 7, timestamp)]})
+        s.write_state()
+
+    with State() as s:
+        groups = group_by_changeset({})
+        assert s.merge_rescheduled_issues(CATEGORY, groups) == 1
+
+        issues = groups[7][CHECK]
+        assert [i.element_id for i in issues] == [1, 2]
+        assert issues[0].timestamp == timestamp
+
+        # only the tags that can still affect the check are kept
+        assert issues[0].tags == {'addr:housenumber': '1', 'addr:postcode': '123'}
+
+        assert s.merge_rescheduled_issues(CATEGORY, group_by_changeset({})) == 0
+
+
+def test_open_changeset_waits_for_poll():
+    now = int(time())
+
+    with State() as s:
+        timestamp = past_timestamp(s)
+        s.reschedule_issues(CATEGORY, 7, {CHECK: [make_entry(1, 7, timestamp)]})
+        s.schedule_poll(make_changeset(7, now - 60), now)
+        s.write_state()
+
+    with State() as s:
+        assert s.merge_rescheduled_issues(CATEGORY, group_by_changeset({})) == 0
+
+        # processed in this run anyway
+        groups = group_by_changeset({CHECK: [make_entry(2, 7, now)]})
+        assert s.merge_rescheduled_issues(CATEGORY, groups) == 1
+        assert [i.element_id for i in groups[7][CHECK]] == [2, 1]
+
+
+def test_predict_close():
+    now = int(time())
+
+    # closed by the max age before going idle
+    assert predict_close(now - CHANGESET_MAX_AGE + 60, now) == now + 60
+
+    # still open, so active within the idle timeout at least, it may close any moment now
+    assert predict_close(now - 600, now - 3 * CHANGESET_IDLE_TIMEOUT) == pytest.approx(now, abs=5)
+
+
+def test_schedule_poll_tracks_activity():
+    now = int(time())
+
+    with State() as s:
+        s.schedule_poll(make_changeset(7, now - 600, changes_count=1), now - 300)
+        polled_at, next_poll = s._db.execute(
+            'SELECT polled_at, next_poll FROM rescheduled_changeset WHERE changeset_id = 7').fetchone()
+        assert next_poll == now - 300 + CHANGESET_IDLE_TIMEOUT
+
+        # edited since the last poll, so at least as recently as that
+        s._db.execute('UPDATE rescheduled_changeset SET polled_at = ?', (now - 100,))
+        s.schedule_poll(make_changeset(7, now - 600, changes_count=2), now - 300)
+        last_activity, next_poll = s._db.execute(
+            'SELECT last_activity, next_poll FROM rescheduled_changeset WHERE changeset_id = 7').fetchone()
+        assert last_activity == now - 100
+        assert next_poll == now - 100 + CHANGESET_IDLE_TIMEOUT
+
+
+def test_expires_stale_changesets():
+    now = int(time())
+    created_at = now - CHANGESET_MAX_AGE - STATE_MAX_BACKLOG - 60
+
+    with State() as s:
+        s.reschedule_issues(CATEGORY, 7, {CHECK: [make_entry(1, 7, created_at)]})
+        s.defer_issues(CATEGORY, {CHECK: [make_entry(2, 7, created_at)]})
+        s.schedule_poll(make_changeset(7, created_at), created_at)
+        s.write_state()
+
+    with State() as s:
+        for table in ('rescheduled_issue', 'deferred_issue', 'rescheduled_changeset'):
+            assert s._db.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0] == 0
+
+
+def test_deferred_issues_are_merged_in_full():
+    with State() as s:
+        timestamp = past_timestamp(s)
+        s.defer_issues(CATEGORY, {CHECK: [make_entry(1, 7, timestamp), make_entry(2, 8, timestamp)]})
+        s.write_state()
+
+    with State() as s:
+        fresh = make_entry(2, 8, timestamp + 60)
+        issues = {CHECK: [fresh]}
+        assert s.merge_deferred_issues(CATEGORY, issues) == 1
+
+        # the freshly queried issue takes precedence
+        deferred, kept = sorted(issues[CHECK], key=lambda i: i.element_id)
+        assert kept is fresh
+        assert deferred.tags == TAGS
+        assert (deferred.bb_min, deferred.bb_max, deferred.bb_size) == ((52.0, 21.0), (52.1, 21.1), (10, 20))
+
+        assert s.merge_deferred_issues(CATEGORY, {}) == 0
+
+
+def test_deferred_issues_of_open_changesets_wait():
+    now = int(time())
+
+    with State() as s:
+        timestamp = past_timestamp(s)
+        s.defer_issues(CATEGORY, {CHECK: [make_entry(1, 7, timestamp)]})
+        s.schedule_poll(make_changeset(7, now - 60), now)
+        s.write_state()
+
+    with State() as s:
+        issues = {}
+        assert s.merge_deferred_issues(CATEGORY, issues) == 0
+        assert issues == {}
+
+        # processed in this run anyway
+        issues = {CHECK: [make_entry(2, 7, now)]}
+        assert s.merge_deferred_issues(CATEGORY, issues) == 1
+        assert [i.element_id for i in issues[CHECK]] == [2, 1]
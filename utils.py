@@ -1,16 +1,22 @@
 import functools
 import re
+import time
 from collections import defaultdict
 from datetime import UTC, datetime, timezone
-
-from requests import Session
+from typing import TYPE_CHECKING
 
 from check import Check
 from config import USER_AGENT
 from overpass_entry import OverpassEntry
 
+if TYPE_CHECKING:
+    from requests import Session
+
+
+def get_http_client(*, headers: dict | None = None) -> 'Session':
+    # requests is slow to import, runs without any work to do should not pay for it
+    from requests import Session
 
-def get_http_client(*, headers: dict | None = None) -> Session:
     if not headers:
         headers = {}
 
@@ -20,6 +26,10 @@ def get_http_client(*, headers: dict | None = None) -> Session:
     return s
 
 
+def is_overdue(deadline: float | None) -> bool:
+    return deadline is not None and time.monotonic() >= deadline
+
+
 def parse_timestamp(ts: str) -> int:
     date_format = '%Y-%m-%dT%H:%M:%SZ'
     return int(datetime.strptime(ts, date_format).replace(tzinfo=timezone.utc).timestamp())
@@ -55,3 +65,31 @@ def group_by_changeset(issues: dict[Check, list[OverpassEntry]]) -> dict[int, di
             grouped[i.changeset_id][check].append(i)
 
     return grouped
+
+
+def hilbert_index(lat: float, lon: float, order: int = 16) -> int:
+    '''
+    Position of the point along a Hilbert curve over the world, nearby points mostly get nearby positions.
+    '''
+    n = 1 << order
+    x = min(int((lon + 180) / 360 * n), n - 1)
+    y = min(int((lat + 90) / 180 * n), n - 1)
+    result = 0
+    s = n >> 1
+
+    while s:
+        rx = int((x & s) > 0)
+        ry = int((y & s) > 0)
+        result += s * s * ((3 * rx) ^ ry)
+
+        # rotate the quadrant
+        if not ry:
+            if rx:
+                x = n - 1 - x
+                y = n - 1 - y
+
+            x, y = y, x
+
+        s >>= 1
+
+    return result
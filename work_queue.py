@@ -0,0 +1,202 @@
+import hashlib
+import json
+import sqlite3
+from dataclasses import dataclass
+from time import time
+
+from aliases import Identifier
+from check import Check
+from checks import ALL_CHECKS_BY_ID
+from config import DRY_RUN, QUEUE_PATH, WORK_LEASE, WORK_MAX_ATTEMPTS
+from overpass_entry import OverpassEntry, Point, Size
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS work_unit (
+    id INTEGER PRIMARY KEY,
+    key TEXT NOT NULL UNIQUE,
+    category TEXT NOT NULL,
+    changeset_id INTEGER NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    not_before INTEGER NOT NULL DEFAULT 0,
+    lease_owner TEXT,
+    lease_until INTEGER NOT NULL DEFAULT 0,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    finished_at INTEGER,
+    result TEXT
+);
+
+CREATE INDEX IF NOT EXISTS work_unit_pending_idx ON work_unit (status, not_before);
+'''
+
+
+@dataclass(frozen=True, kw_only=True, slots=True)
+class WorkUnit:
+    id: int
+    category: Identifier
+    changeset_id: int
+    issues: dict[Check, list[OverpassEntry]]
+
+
+def _dump_entry(e: OverpassEntry) -> list:
+    return [e.timestamp, e.element_type, e.element_id, e.tags, *e.bb_min, *e.bb_max, *e.bb_size]
+
+
+def _load_entry(changeset_id: int, d: list) -> OverpassEntry:
+    timestamp, element_type, element_id, tags, min_lat, min_lon, max_lat, max_lon, width, height = d
+
+    return OverpassEntry(
+        timestamp=timestamp,
+        changeset_id=changeset_id,
+        element_type=element_type,
+        element_id=element_id,
+        tags=tags,
+        nodes=[],
+        bb_min=Point(min_lat, min_lon),
+        bb_max=Point(max_lat, max_lon),
+        bb_size=Size(width, height),
+    )
+
+
+def _load_unit(unit_id: int, cat: Identifier, changeset_id: int, payload: str) -> WorkUnit:
+    return WorkUnit(
+        id=unit_id,
+        category=cat,
+        changeset_id=changeset_id,
+        issues={
+            ALL_CHECKS_BY_ID[check_identifier]: [_load_entry(changeset_id, d) for d in check_issues]
+            for check_identifier, check_issues in json.loads(payload).items()
+        })
+
+
+class WorkQueue:
+    '''
+    Per-changeset work units shared by the coordinator and any number of workers.
+    Units are leased for WORK_LEASE seconds, an expired lease makes the unit available again.
+    In a dry run, units are only read and their status is never changed.
+    '''
+    _db: sqlite3.Connection
+    _dry_run_last_id: int = 0
+
+    def __enter__(self):
+        self._db = sqlite3.connect(QUEUE_PATH, timeout=60, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode = WAL')
+        self._db.executescript(SCHEMA)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._db.close()
+
+    def enqueue_all(self, cat: Identifier, groups: dict[int, dict[Check, list[OverpassEntry]]]) -> int:
+        self._db.execute('BEGIN')
+
+        try:
+            enqueued = sum(self._enqueue(cat, changeset_id, issues) for changeset_id, issues in groups.items())
+        except Exception:
+            self._db.execute('ROLLBACK')
+            raise
+
+        self._db.execute('COMMIT')
+        return enqueued
+
+    def _enqueue(self, cat: Identifier, changeset_id: int, issues: dict[Check, list[OverpassEntry]]) -> bool:
+        payload = json.dumps({
+            check.identifier: sorted(_dump_entry(i) for i in check_issues)
+            for check, check_issues in sorted(issues.items(), key=lambda t: t[0].identifier)
+        }, separators=(',', ':'))
+
+        # the same work enqueued again (e.g. after a coordinator crash) is ignored
+        key = hashlib.sha256(f'{cat}:{changeset_id}:{payload}'.encode()).hexdigest()
+
+        cursor = self._db.execute(
+            'INSERT OR IGNORE INTO work_unit (key, category, changeset_id, payload) VALUES (?, ?, ?, ?)',
+            (key, cat, changeset_id, payload))
+
+        return cursor.rowcount > 0
+
+    def lease(self, owner: str, limit: int = 1) -> list[WorkUnit]:
+        '''
+        Lease up to `limit` units of the same category, so that their post queries can be batched together.
+        '''
+        now = int(time())
+        rows = []
+        category = None
+
+        if DRY_RUN:
+            while len(rows) < limit:
+                row = self._db.execute(
+                    'SELECT id, category, changeset_id, payload FROM work_unit '
+                    'WHERE status = \'pending\' AND not_before <= ? AND id > ? AND category = coalesce(?, category) '
+                    'ORDER BY id LIMIT 1', (now, self._dry_run_last_id, category)).fetchone()
+
+                if row is None:
+                    break
+
+                self._dry_run_last_id = row[0]
+                category = row[1]
+                rows.append(row)
+
+            return [_load_unit(*row) for row in rows]
+
+        self._db.execute('BEGIN IMMEDIATE')
+
+        try:
+            while len(rows) < limit:
+                row = self._db.execute(
+                    'SELECT id, category, changeset_id, payload, attempts FROM work_unit '
+                    'WHERE status = \'pending\' AND not_before <= ? AND lease_until <= ? '
+                    'AND category = coalesce(?, category) '
+                    'ORDER BY not_before, id LIMIT 1', (now, now, category)).fetchone()
+
+                if row is None:
+                    break
+
+                unit_id, cat, changeset_id, payload, attempts = row
+
+                if attempts >= WORK_MAX_ATTEMPTS:
+                    print(f'💀 Gave up on work unit {unit_id}: {cat} {changeset_id}')
+                    self._db.execute(
+                        'UPDATE work_unit SET status = \'failed\', finished_at = ? WHERE id = ?', (now, unit_id))
+                    continue
+
+                # lease it, the next units are then picked from its category only
+                self._db.execute(
+                    'UPDATE work_unit SET lease_owner = ?, lease_until = ?, attempts = attempts + 1 WHERE id = ?',
+                    (owner, now + WORK_LEASE, unit_id))
+
+                category = cat
+                rows.append(row[:4])
+        finally:
+            self._db.execute('COMMIT')
+
+        return [_load_unit(*row) for row in rows]
+
+    def complete(self, unit: WorkUnit, owner: str, result: str) -> bool:
+        '''
+        Mark the unit as done. Returns False if the lease was lost in the meantime.
+        '''
+        if DRY_RUN:
+            return True
+
+        cursor = self._db.execute(
+            'UPDATE work_unit SET status = \'done\', result = ?, finished_at = ?, lease_until = 0 '
+            'WHERE id = ? AND lease_owner = ? AND status = \'pending\'',
+            (result, int(time()), unit.id, owner))
+
+        return cursor.rowcount > 0
+
+    def defer(self, unit: WorkUnit, owner: str, not_before: int) -> None:
+        if DRY_RUN:
+            return
+
+        self._db.execute(
+            'UPDATE work_unit SET not_before = ?, lease_until = 0, attempts = 0 '
+            'WHERE id = ? AND lease_owner = ? AND status = \'pending\'',
+            (not_before, unit.id, owner))
+
+    def purge(self, max_age: int) -> None:
+        if DRY_RUN:
+            return
+
+        self._db.execute(
+            'DELETE FROM work_unit WHERE status != \'pending\' AND finished_at < ?', (int(time()) - max_age,))